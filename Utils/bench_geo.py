@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+##############################################################################
+# Micro-benchmark of the O4_Geo_Utils conversions : the scalar (math) functions
+# called point by point, against the _vec (NumPy) kernels called once on the
+# same points, and on a single point (their per call overhead). Also checks
+# that both flavours agree. Fixed inputs, run from anywhere :
+#     python3 Utils/bench_geo.py [nbr_points]
+##############################################################################
+import os
+import sys
+import time
+import numpy
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src'))
+import O4_Geo_Utils as GEO
+
+def timed(function,repeat=3):
+    # best of repeat runs, in seconds
+    best=None
+    for _ in range(repeat):
+        timer=time.perf_counter()
+        result=function()
+        elapsed=time.perf_counter()-timer
+        best=elapsed if best is None else min(best,elapsed)
+    return (best,result)
+
+def main(nbr_points=100000):
+    rng=numpy.random.default_rng(14)
+    lat=rng.uniform(-80,80,nbr_points)
+    lon=rng.uniform(-180,180,nbr_points)
+    zl=17
+    (pix_x,pix_y)=GEO.wgs84_to_pix_vec(lat,lon,zl)
+    (til_x,til_y)=GEO.wgs84_to_orthogrid_vec(lat,lon,zl)
+    til_x=til_x//16; til_y=til_y//16
+    (lat_l,lon_l,pix_x_l,pix_y_l,til_x_l,til_y_l)=(a.tolist() for a in (lat,lon,pix_x,pix_y,til_x,til_y))
+    # name, scalar loop, vectorized call, single point scalar call, single point _vec call
+    cases=[
+        ('gtile_to_wgs84',
+            lambda: [GEO.gtile_to_wgs84(x,y,zl) for (x,y) in zip(til_x_l,til_y_l)],
+            lambda: GEO.gtile_to_wgs84_vec(til_x,til_y,zl),
+            lambda: GEO.gtile_to_wgs84(til_x_l[0],til_y_l[0],zl),
+            lambda: GEO.gtile_to_wgs84_vec(til_x_l[0],til_y_l[0],zl)),
+        ('wgs84_to_pix',
+            lambda: [GEO.wgs84_to_pix(a,b,zl) for (a,b) in zip(lat_l,lon_l)],
+            lambda: GEO.wgs84_to_pix_vec(lat,lon,zl),
+            lambda: GEO.wgs84_to_pix(lat_l[0],lon_l[0],zl),
+            lambda: GEO.wgs84_to_pix_vec(lat_l[0],lon_l[0],zl)),
+        ('wgs84_to_gtile',
+            lambda: [GEO.wgs84_to_gtile(a,b,zl) for (a,b) in zip(lat_l,lon_l)],
+            lambda: GEO.wgs84_to_gtile_vec(lat,lon,zl),
+            lambda: GEO.wgs84_to_gtile(lat_l[0],lon_l[0],zl),
+            lambda: GEO.wgs84_to_gtile_vec(lat_l[0],lon_l[0],zl)),
+        ('pix_to_wgs84',
+            lambda: [GEO.pix_to_wgs84(x,y,zl) for (x,y) in zip(pix_x_l,pix_y_l)],
+            lambda: GEO.pix_to_wgs84_vec(pix_x,pix_y,zl),
+            lambda: GEO.pix_to_wgs84(pix_x_l[0],pix_y_l[0],zl),
+            lambda: GEO.pix_to_wgs84_vec(pix_x_l[0],pix_y_l[0],zl)),
+        ('wgs84_to_orthogrid',
+            lambda: [GEO.wgs84_to_orthogrid(a,b,zl) for (a,b) in zip(lat_l,lon_l)],
+            lambda: GEO.wgs84_to_orthogrid_vec(lat,lon,zl),
+            lambda: GEO.wgs84_to_orthogrid(lat_l[0],lon_l[0],zl),
+            lambda: GEO.wgs84_to_orthogrid_vec(lat_l[0],lon_l[0],zl)),
+        ('st_coord',
+            lambda: [GEO.st_coord(a,b,16*x,16*y,zl,None) for (a,b,x,y) in zip(lat_l,lon_l,til_x_l,til_y_l)],
+            lambda: GEO.st_coord_vec(lat,lon,16*til_x,16*til_y,zl),
+            lambda: GEO.st_coord(lat_l[0],lon_l[0],16*til_x_l[0],16*til_y_l[0],zl,None),
+            lambda: GEO.st_coord_vec(lat_l[0],lon_l[0],16*til_x_l[0],16*til_y_l[0],zl)),
+    ]
+    print("Python",sys.version.split()[0],", NumPy",numpy.__version__,",",nbr_points,"points at ZL",zl)
+    print('{:20s}{:>14s}{:>14s}{:>10s}{:>14s}{:>14s}{:>12s}'.format('function','scalar loop','_vec batch','speedup','scalar 1pt','_vec 1pt','max diff'))
+    for (name,scalar_loop,vec_batch,scalar_one,vec_one) in cases:
+        (t_loop,scalar_results)=timed(scalar_loop)
+        (t_vec,vec_results)=timed(vec_batch)
+        (t_one,_)=timed(lambda: [scalar_one() for _ in range(10000)])
+        (t_vec_one,_)=timed(lambda: [vec_one() for _ in range(10000)])
+        diff=numpy.abs(numpy.array(scalar_results,dtype=numpy.float64)-numpy.column_stack(vec_results)).max()
+        print('{:20s}{:>11.1f} ms{:>11.2f} ms{:>9.0f}x{:>11.2f} us{:>11.2f} us{:>12.2g}'.format(
+            name,1e3*t_loop,1e3*t_vec,t_loop/t_vec,1e2*t_one,1e2*t_vec_one,diff))
+
+if __name__=='__main__':
+    main(int(sys.argv[1]) if len(sys.argv)>1 else 100000)
@@ -0,0 +1,62 @@
+import numpy
+
+##############################################################################
+# Separable box and hat (triangular) filters computed with running sums, in
+# time independent of the kernel width. Both act as numpy.convolve(...,'same')
+# with the normalized kernel along each axis (zero padding outside), the
+# result of each pass being stored back into the array itself, so that
+# integer arrays are truncated after each pass as they used to be.
+##############################################################################
+
+# number of lines filtered at once (memory of the running sums vs numpy overhead)
+strip_lines=512
+
+##############################################################################
+def filter_lines(lines,width,hat):
+    # a box is a difference of cumulative sums, a hat of half width w (a box of
+    # width w convolved with itself) a second difference of twice cumulated sums
+    (n,l)=lines.shape
+    w=width
+    before=w+1 if hat else w//2+1
+    acc=numpy.zeros((n,l+2*w if hat else l+w),dtype=numpy.int64 if lines.dtype.kind in 'biu' else numpy.float64)
+    acc[:,before:before+l]=lines
+    numpy.cumsum(acc,axis=1,out=acc)
+    if not hat:
+        # even widths are centered as numpy.convolve does (one more value before)
+        return (acc[:,w:w+l]-acc[:,:l])/w
+    numpy.cumsum(acc,axis=1,out=acc)
+    return (acc[:,2*w:2*w+l]-2*acc[:,w:w+l]+acc[:,:l])/w**2
+##############################################################################
+
+##############################################################################
+def separable_filter(array,width,hat,axes):
+    # 2D arrays, filtered by strips of lines (columns are transposed first,
+    # running sums are much faster along contiguous memory)
+    for axis in axes:
+        for start in range(0,array.shape[1-axis],strip_lines):
+            if axis==1:
+                array[start:start+strip_lines]=filter_lines(array[start:start+strip_lines],width,hat)
+            else:
+                lines=numpy.ascontiguousarray(array[:,start:start+strip_lines].T)
+                array[:,start:start+strip_lines]=filter_lines(lines,width,hat).T
+    return array
+##############################################################################
+
+##############################################################################
+def box_filter(array,width,axes=(1,0)):
+    """
+    In place convolution with a normalized box of the given width.
+    """
+    if width<=1: return array
+    return separable_filter(array,int(width),False,axes)
+##############################################################################
+
+##############################################################################
+def hat_filter(array,width,axes=(1,0)):
+    """
+    In place convolution with the normalized hat 1,2,...,width,...,2,1 of
+    length 2*width-1 (the kernel used for mask blurs and DEM smoothing).
+    """
+    if width<=1: return array
+    return separable_filter(array,int(width),True,axes)
+##############################################################################
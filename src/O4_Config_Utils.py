@@ -10,6 +10,7 @@ import O4_OSM_Utils as OSM
 import O4_Vector_Map as VMAP
 import O4_Imagery_Utils as IMG
 import O4_Tile_Utils as TILE
+import O4_Mesh_IO as MESHIO
 import O4_Overlay_Utils as OVL
 
 
@@ -18,17 +19,25 @@ cfg_vars={
     'verbosity':             {'module':'UI','type':int,'default':1,'values':(0,1,2,3),'hint':'Verbosity determines the amount of information about the whole process which is printed on screen.  Critical errors, if any, are reported in all states as well as in the Log. Values above 1 are probably only useful for for debug purposes.'},  
     'cleaning_level':        {'module':'UI','type':int,'default':1,'values':(0,1,2,3),'hint':'Determines which temporary files are removed. Level 3 erases everything except the config and what is needed for X-Plane; Level 2 erases everything except what is needed to redo the current step only; Level 1 allows you to redo any prior step; Level 0 keeps every single file.'}, 
     'overpass_server_choice':{'module':'OSM','type':str,'default':'random','values':['random']+sorted(OSM.overpass_servers.keys()),'hint':'The (country) of the Overpass OSM server used to grab vector data. It can be modified on the fly (as all _Application_ variables) in case of problem with a particular server.'},
+    'osm_binary_cache':      {'module':'OSM','type':bool,'default':True,'hint':'When set, OSM data cached in OSM_data is also stored in an already parsed binary form (.o4osm files next to the .osm.bz2 ones), which later runs load instead of parsing the XML again. The XML files remain the reference: if one of them is newer (e.g. edited in JOSM) the binary file is rebuilt from it.'},
     'skip_downloads':        {'module':'TILE','type':bool,'default':False,'hint':'Will only build the DSF and TER files but not the textures (neither download nor convert). This could be useful in cases where imagery cannot be shared.'},
     'skip_converts':         {'module':'TILE','type':bool,'default':False,'hint':'Imagery will be downloaded but not converted from jpg to dds. Some user prefer to postprocess imagery with third party softwares prior to the dds conversion. In that case Step 3 needs to be run a second time after the retouch work.'}, 
     'max_convert_slots':     {'module':'TILE','type':int,'default':4,'values':(1,2,3,4,5,6,7,8),'hint':'Number of parallel threads for dds conversion. Should be mainly dictated by the number of cores in your CPU.'},
+    'dds_encoder':           {'module':'IMG','type':str,'default':'nvcompress','values':('nvcompress','numpy'),'hint':'Tool used to convert the orthophotos into DDS textures. "nvcompress" is the external Nvidia texture tool, "numpy" is an in-process encoder which does not need temporary files nor the spawning of a new process for each texture, at a possibly lower quality than nvcompress (not benchmarked against it).'},
+    'max_batch_workers':     {'module':'TILE','type':int,'default':1,'values':(1,2,3,4,6,8,12,16,24,32),'hint':'Number of tiles built simultaneously (each one in its own process) during batch builds from the Earth tiles map. A value of 1 keeps the legacy sequential behaviour. Steps 1, 2 and 3 are further limited internally to avoid overloading the OSM and imagery servers and the memory, and when masks are built Step 2.5 waits for the meshes of all the tiles.'},
+    'binary_mesh':           {'module':'MESHIO','type':bool,'default':False,'hint':'When set, a binary copy (.mesh.bin) of each mesh file is stored next to it and used in place of the text version by the masks and DSF steps (as well as the masks of neighbouring tiles), which avoids parsing large meshes again and again. The text mesh remains the reference, the binary copy is ignored (and rebuilt) as soon as the text file changes.'},
+    'elevation_cache':       {'module':'DEM','type':bool,'default':False,'hint':'When set, elevation files are decoded once (including the resampling of 3" data and the reading of GeoTiffs) and stored as raw arrays in Elevation_data/Cache, which later steps and neighbouring tiles then map from disk instead of decoding again. Costs about 50MB of disk per elevation file, see elevation_cache_size.'},
+    'elevation_cache_size':  {'module':'DEM','type':int,'default':4000,'hint':'Size (in MB) of the elevation cache (Elevation_data/Cache). When full, the least recently used decoded files are removed. Zero means no limit, the directory must then be purged by hand.'},
     'check_tms_response':    {'module':'IMG','type':bool,'default':True,'hint':'When set, internal server errors (HTTP [500] and the likes) yields new requests, if not a white texture is used in place.'},
     'http_timeout':          {'module':'IMG','type':float,'default':10,'hint':'Delay before we decide that a http request is timed out.'},
     'max_connect_retries':   {'module':'IMG','type':int,'default':5,'hint':'How much times do we try again after a failed connection for imagery request. Only used if check_tms_response is set to True.'},
     'max_baddata_retries':   {'module':'IMG','type':int,'default':5,'hint':'How much times do we try again after an internal server error for an imagery request. Only used if check_tms_response is set to True.'},
+    'raw_tile_cache_size':   {'module':'IMG','type':int,'default':0,'hint':'Size (in MB) of the on-disk cache of individual provider tiles (Raw_tiles directory), used for TMS and WMTS providers. Textures that need to be built again (e.g. after a change of zones or zoomlevels) then only download the tiles which are not in the cache yet. When full, the least recently used tiles are removed. Zero disables the cache.'},
     'ovl_exclude_pol'    :   {'module':'OVL','type':list,'default':[0],'hint':'Indices of polygon types which one would like to left aside in the extraction of overlays. The list of these indices in front of their name can be obtained by running the "extract overlay" process with verbosity = 2 (skip facades that can be numerous) or 3. Index 0 corresponds to beaches in Global and HD sceneries. Strings can be used in places of indices, in that case any polygon_def that contains that string is excluded, and the string can begin with a ! to invert the matching. As an exmaple, ["!.for"] would exclude everything but forests.'},
     'ovl_exclude_net'    :   {'module':'OVL','type':list,'default':[],'hint':'Indices of road types which one would like to left aside in the extraction of overlays. The list of these indices is can be in the roads.net file within X-Plane Resources, but some sceneries use their own corresponding net definition file. Powerlines have index 22001 in XP11 roads.net default file.'},
     'custom_scenery_dir':    {'type':str,'default':'','hint':'Your X-Plane Custom Scenery. Used only for "1-click" creation (or deletion) of symbolic links from Ortho4XP tiles to there.'},
     'custom_overlay_src':    {'module':'OVL','type':str,'default':'','hint':'The directory containing the sceneries with the overlays you would like to extract. You need to select the level of directory just _ABOVE_ Earth nav data.'},
+    'osm_extract_dir':       {'module':'OSM','type':str,'default':'','hint':'A directory containing regional OSM extracts in the .osm.pbf format (e.g. from Geofabrik). Each extract needs the .poly file of its region next to it (e.g. france.poly for france-latest.osm.pbf, also provided by Geofabrik), it is then indexed once (in OSM_data/Extract_index, this can take a while for large ones) and used instead of Overpass, with no network access, for the tiles entirely within that polygon. Other tiles still use Overpass. Remove the cached OSM data of a tile to build it from a new extract.'},
     # Vector
     'apt_smoothing_pix':   {'type':int,  'default':8,'hint':"How much gaussian blur is applied to the elevation raster for the look up of altitude over airports. Unit is the evelation raster pixel size."},
     'road_level':          {'type':int,'default':1,'values':(0,1,2,3,4,5),'hint':'Allows to level the mesh along roads and railways. Zero means nothing such is included; "1" looks for banking ways among motorways, primary and secondary roads and railway tracks; "2" adds tertiary roads; "3" brings residential and unclassified roads; "4" takes service roads, and 5 finishes with tracks. Purge the small_roads.osm cached data if you change your mind in between the levels 2-5.'},
@@ -81,10 +90,10 @@ cfg_vars={
 }
 
 list_app_vars=['verbosity','cleaning_level','overpass_server_choice',
-               'skip_downloads','skip_converts','max_convert_slots','check_tms_response',
-               'http_timeout','max_connect_retries','max_baddata_retries','ovl_exclude_pol','ovl_exclude_net','custom_scenery_dir','custom_overlay_src']
-gui_app_vars_short=list_app_vars[:-2]
-gui_app_vars_long=list_app_vars[-2:]
+               'skip_downloads','skip_converts','max_convert_slots','dds_encoder','max_batch_workers','binary_mesh','elevation_cache','elevation_cache_size','osm_binary_cache','check_tms_response',
+               'http_timeout','max_connect_retries','max_baddata_retries','raw_tile_cache_size','ovl_exclude_pol','ovl_exclude_net','custom_scenery_dir','custom_overlay_src','osm_extract_dir']
+gui_app_vars_short=list_app_vars[:-3]
+gui_app_vars_long=list_app_vars[-3:]
 
 list_vector_vars=['apt_smoothing_pix','road_level','road_banking_limit','lane_width','max_levelled_segs','water_simplification','min_area','max_area','clean_bad_geometries','mesh_zl']
 list_mesh_vars=['curvature_tol','apt_curv_tol','apt_curv_ext','coast_curv_tol','coast_curv_ext','limit_tris','hmin','min_angle','sea_smoothing_mode','water_smoothing','iterate']
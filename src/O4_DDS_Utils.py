@@ -0,0 +1,177 @@
+import os
+import struct
+import numpy
+
+##############################################################################
+# In-process DXT1 (BC1) and DXT5 (BC3) encoder with box filtered mipmaps,
+# working directly on the in-memory image.
+# Color endpoints are first the corners of the block bounding box, inset by 
+# 1/16 of its extent and oriented along the dominant correlation between 
+# channels (as in most real-time encoders), indices follow the projection of 
+# the pixels on the axis between the (565 quantized) endpoints. The endpoints
+# are then refit by least squares to the pixels given these indices, and the
+# refit kept for the blocks whose error it lowers.
+##############################################################################
+
+# number of rows of 4x4 blocks encoded at once (memory vs numpy overhead)
+strip_blocks=64
+# position of a color along the endpoints axis -> weight of the second endpoint
+weights=numpy.array([0,1/3,2/3,1],dtype=numpy.float32)
+
+##############################################################################
+def image_to_blocks(array):
+    # (h,w,c) array -> (h//4*w//4,c,16), blocks and their pixels in row major order,
+    # channels first so that reductions over pixels are contiguous
+    (h,w,c)=array.shape
+    return numpy.ascontiguousarray(array.reshape((h//4,4,w//4,4,c)).transpose(0,2,4,1,3)).reshape((-1,c,16))
+##############################################################################
+
+##############################################################################
+def to_565(colors):
+    colors=colors.astype(numpy.int32)
+    r=(colors[:,0]*31+127)//255
+    g=(colors[:,1]*63+127)//255
+    b=(colors[:,2]*31+127)//255
+    return (r<<11)|(g<<5)|b
+##############################################################################
+
+##############################################################################
+def from_565(c565):
+    r=(c565>>11)&31; g=(c565>>5)&63; b=c565&31
+    return numpy.stack(((r<<3)|(r>>2),(g<<2)|(g>>4),(b<<3)|(b>>2)),axis=1).astype(numpy.float32)
+##############################################################################
+
+##############################################################################
+def fit_positions(pixels,c0,c1):
+    # orders the 565 endpoints for the four colors mode (c0>c1), returns them with
+    # the positions of the pixels along their axis (0 for c0 to 3 for c1) and the
+    # squared error of the block
+    swap=c0<c1
+    (c0,c1)=(numpy.where(swap,c1,c0),numpy.where(swap,c0,c1))
+    e0=from_565(c0); e1=from_565(c1)
+    axis=e1-e0
+    norm=numpy.einsum('nc,nc->n',axis,axis)
+    norm[norm==0]=1
+    diff=pixels-e0[:,:,None]
+    dot=numpy.einsum('ncp,nc->np',diff,axis)
+    pos=numpy.clip(numpy.round(3*dot/norm[:,None]),0,3).astype(numpy.uint32)
+    pos[c0==c1]=0
+    # |diff-w.axis|^2 summed over the pixels, for the weights w=pos/3 
+    w=weights[pos]
+    error=numpy.einsum('ncp,ncp->n',diff,diff)+(w*(w*norm[:,None]-2*dot)).sum(axis=1)
+    return (c0,c1,pos,error)
+##############################################################################
+
+##############################################################################
+def encode_color_blocks(blocks):
+    # blocks : (n,3,16) uint8, returns (n,8) uint8
+    pixels=blocks.astype(numpy.float32)
+    cmin=pixels.min(axis=2)
+    cmax=pixels.max(axis=2)
+    inset=(cmax-cmin)/16
+    cmin+=inset; cmax-=inset
+    # red and blue anti-correlated with green : use the other diagonal of the box
+    centered=pixels-pixels.mean(axis=2,keepdims=True)
+    for channel in (0,2):
+        flip=(centered[:,channel]*centered[:,1]).sum(axis=1)<0
+        (cmin[flip,channel],cmax[flip,channel])=(cmax[flip,channel],cmin[flip,channel])
+    (c0,c1,pos,error)=fit_positions(pixels,to_565(numpy.round(cmax)),to_565(numpy.round(cmin)))
+    # least squares endpoints a, b minimizing the sum of |(1-w)a+wb-p|^2 for the 
+    # weights w=pos/3 (2x2 normal equations per block, singular if all w agree)
+    w=weights[pos]; v=1-w
+    (vv,vw,ww)=(numpy.einsum('np,np->n',v,v),numpy.einsum('np,np->n',v,w),numpy.einsum('np,np->n',w,w))
+    det=vv*ww-vw*vw
+    solvable=det>1e-3
+    det[~solvable]=1
+    vp=numpy.einsum('ncp,np->nc',pixels,v); wp=numpy.einsum('ncp,np->nc',pixels,w)
+    a=numpy.clip(numpy.round((ww[:,None]*vp-vw[:,None]*wp)/det[:,None]),0,255)
+    b=numpy.clip(numpy.round((vv[:,None]*wp-vw[:,None]*vp)/det[:,None]),0,255)
+    (r0,r1,rpos,rerror)=fit_positions(pixels,to_565(a),to_565(b))
+    better=solvable&(rerror<error)
+    (c0,c1,pos)=(numpy.where(better,r0,c0),numpy.where(better,r1,c1),numpy.where(better[:,None],rpos,pos))
+    # positions along the axis c0, 2/3c0+1/3c1, 1/3c0+2/3c1, c1 have indices 0, 2, 3, 1
+    idx=numpy.array([0,2,3,1],dtype=numpy.uint32)[pos]
+    out=numpy.empty((len(blocks),4),dtype='<u2')
+    out[:,0]=c0; out[:,1]=c1
+    out[:,2:]=(idx<<(2*numpy.arange(16,dtype=numpy.uint32))).sum(axis=1,dtype=numpy.uint32).astype('<u4').view('<u2').reshape((-1,2))
+    return out.view(numpy.uint8)
+##############################################################################
+
+##############################################################################
+def encode_alpha_blocks(alpha):
+    # alpha : (n,16) uint8, returns (n,8) uint8, always in the 8 alphas mode
+    a0=alpha.max(axis=1).astype(numpy.int32)
+    a1=alpha.min(axis=1).astype(numpy.int32)
+    span=a0-a1
+    span[span==0]=1
+    pos=numpy.round((a0[:,None]-alpha)*7/span[:,None]).astype(numpy.uint64)
+    # positions a0, 6/7a0+1/7a1, ..., a1 have indices 0, 2, 3, 4, 5, 6, 7, 1
+    idx=numpy.array([0,2,3,4,5,6,7,1],dtype=numpy.uint64)[pos]
+    idx[a0==a1]=0
+    bits=(idx<<(3*numpy.arange(16,dtype=numpy.uint64))).sum(axis=1,dtype=numpy.uint64)
+    out=numpy.empty((len(alpha),8),dtype=numpy.uint8)
+    out[:,0]=a0; out[:,1]=a1
+    out[:,2:]=bits.astype('<u8').view(numpy.uint8).reshape((-1,8))[:,:6]
+    return out
+##############################################################################
+
+##############################################################################
+def encode_level(array,dxt5):
+    # array : (h,w,3 or 4) uint8 with h and w multiple of 4
+    out=[]
+    for row in range(0,array.shape[0],4*strip_blocks):
+        blocks=image_to_blocks(array[row:row+4*strip_blocks])
+        color=encode_color_blocks(blocks[:,:3])
+        if dxt5:
+            out.append(numpy.hstack((encode_alpha_blocks(blocks[:,3]),color)).tobytes())
+        else:
+            out.append(color.tobytes())
+    return b''.join(out)
+##############################################################################
+
+##############################################################################
+def pad_to_blocks(array):
+    # mipmaps smaller than a block are padded by replication
+    (h,w)=array.shape[:2]
+    if h%4 or w%4:
+        array=numpy.pad(array,((0,-h%4),(0,-w%4),(0,0)),mode='edge')
+    return array
+##############################################################################
+
+##############################################################################
+def downsample(array):
+    # 2x2 box filter (2x1 once a side is down to a single pixel)
+    array=array.astype(numpy.uint16)
+    if array.shape[0]>1: array=array[0::2]+array[1::2]
+    else: array=2*array
+    if array.shape[1]>1: array=array[:,0::2]+array[:,1::2]
+    else: array=2*array
+    return ((array+2)//4).astype(numpy.uint8)
+##############################################################################
+
+##############################################################################
+def dds_header(width,height,nbr_mipmaps,dxt5):
+    linear_size=max(1,(width+3)//4)*max(1,(height+3)//4)*(16 if dxt5 else 8)
+    # flags : CAPS, HEIGHT, WIDTH, PIXELFORMAT, MIPMAPCOUNT, LINEARSIZE
+    header=struct.pack('<4s7I44x',b'DDS ',124,0x1|0x2|0x4|0x1000|0x20000|0x80000,height,width,linear_size,0,nbr_mipmaps)
+    # pixel format : FOURCC
+    header+=struct.pack('<2I4s5I',32,0x4,b'DXT5' if dxt5 else b'DXT1',0,0,0,0,0)
+    # caps : COMPLEX, TEXTURE, MIPMAP
+    header+=struct.pack('<5I',0x8|0x1000|0x400000,0,0,0,0)
+    return header
+##############################################################################
+
+##############################################################################
+def write_dds(im,file_name,dxt5=False):
+    # im is a PIL image, its alpha channel is only used for DXT5
+    array=numpy.asarray(im.convert('RGBA' if dxt5 else 'RGB'))
+    (height,width)=array.shape[:2]
+    nbr_mipmaps=max(width,height).bit_length()
+    with open(file_name+'.tmp','wb') as f:
+        f.write(dds_header(width,height,nbr_mipmaps,dxt5))
+        for level in range(nbr_mipmaps):
+            if level: array=downsample(array)
+            f.write(encode_level(pad_to_blocks(array),dxt5))
+    os.replace(file_name+'.tmp',file_name)
+    return 1
+##############################################################################
@@ -4,6 +4,8 @@ import time
 import requests
 import zipfile
 import itertools
+import threading
+import json
 from math import sqrt
 import array
 import numpy
@@ -15,6 +17,7 @@ except:
 from PIL import Image
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
+import O4_Blur_Utils as BLUR
 
 available_sources=(
                  'View','Viewfinderpanoramas (J. de Ferranti) - mostly worldwide',
@@ -26,6 +29,11 @@ available_sources=(
                  
 global_sources = ('View','SRTM','ALOS')
 
+# decoded elevation files are kept in Elevation_data/Cache and mapped from there
+elevation_cache=False
+# in MB, the least recently used decoded files are removed beyond it (0 = no limit)
+elevation_cache_size=4000
+
 ##############################################################################
 class DEM():
     def __init__(self,lat,lon,source='',fill_nodata=True,info_only=False):
@@ -43,7 +51,7 @@ class DEM():
         if fill_nodata=="to zero":
             self.nodata_to_zero()
         elif fill_nodata:
-            if not fill_nodata_values_with_nearest_neighbor(self.alt_dem,self.nodata):
+            if not fill_nodata_values(self.alt_dem,self.nodata):
                 UI.vprint(1,"   INFO: Dataset contains too much no_data to be filled.")
                 self.nodata_to_zero()
             
@@ -164,38 +172,41 @@ class DEM():
             if tmp != subdem.nodata: return tmp
         return self.alt_nostrict(node)     
         
-    def alt_vec_nostrict(self,way):
+    def alt_vec_nostrict(self,way,dtype=numpy.float64):
+        # same triangular interpolation as alt_nostrict, for a whole array of nodes
         Nx=self.nxdem-1
         Ny=self.nydem-1
-        x,y=way[:,0],way[:,1]
-        x=numpy.maximum.reduce([x,self.x0*numpy.ones(x.shape)])
-        x=numpy.minimum.reduce([x,self.x1*numpy.ones(x.shape)])
-        y=numpy.maximum.reduce([y,self.y0*numpy.ones(y.shape)])
-        y=numpy.minimum.reduce([y,self.y1*numpy.ones(y.shape)])
+        x=numpy.clip(way[:,0],self.x0,self.x1)
+        y=numpy.clip(way[:,1],self.y0,self.y1)
         px=(x-self.x0)/(self.x1-self.x0)*Nx
         py=(y-self.y0)/(self.y1-self.y0)*Ny
-        nx=px.astype(numpy.uint16)
-        Nminusny=Ny-py.astype(numpy.uint16)
+        nx=px.astype(numpy.int64)
+        Nminusny=Ny-py.astype(numpy.int64)
         rx=px-nx
         ry=py+Nminusny-Ny
-        t1=[self.alt_dem[i][j] for i,j in zip(Nminusny,nx)]
-        t2=[self.alt_dem[i][j] for i,j in zip((Nminusny-1)*(Nminusny>=1),(nx+1)*(nx<Nx)+Nx*(nx==Nx))]
-        t3=[self.alt_dem[i][j] for i,j in zip(Nminusny,(nx+1)*(nx<Nx)+Nx*(nx==Nx))]
-        t4=[self.alt_dem[i][j] for i,j in zip((Nminusny-1)*(Nminusny>=1),nx)]
-        return ((1-rx)*t1+ry*t2+(rx-ry)*t3)*(rx>=ry)+((1-ry)*t1+rx*t2+(ry-rx)*t4)*(rx<ry)
+        nx1=numpy.minimum(nx+1,Nx)
+        Nminusny1=numpy.maximum(Nminusny-1,0)
+        t1=self.alt_dem[Nminusny,nx]
+        t2=self.alt_dem[Nminusny1,nx1]
+        t3=self.alt_dem[Nminusny,nx1]
+        t4=self.alt_dem[Nminusny1,nx]
+        upper=rx>=ry
+        return numpy.where(upper,(1-rx)*t1+ry*t2+(rx-ry)*t3,(1-ry)*t1+rx*t2+(ry-rx)*t4).astype(dtype,copy=False)
         
-    def alt_vec_strict(self,way):
+    def alt_vec_strict(self,way,dtype=numpy.float64):
         x,y=way[:,0],way[:,1]
-        mask=(x>=self.x0)*(x<=self.x1)*(y>=self.y0)*(y<=self.y1)
-        nx=numpy.round((x-self.x0)/(self.x1-self.x0)*(self.nxdem-1)).astype(numpy.uint16)
-        Nminusny=numpy.round((self.y1-y)/(self.y1-self.y0)*(self.nydem-1)).astype(numpy.uint16)
-        return numpy.array([self.alt_dem[i][j] if k else self.nodata for i,j,k in zip(Nminusny,nx,mask)])
+        mask=(x>=self.x0)&(x<=self.x1)&(y>=self.y0)&(y<=self.y1)
+        nx=numpy.clip(numpy.round((x-self.x0)/(self.x1-self.x0)*(self.nxdem-1)),0,self.nxdem-1).astype(numpy.int64)
+        Nminusny=numpy.clip(numpy.round((self.y1-y)/(self.y1-self.y0)*(self.nydem-1)),0,self.nydem-1).astype(numpy.int64)
+        return numpy.where(mask,self.alt_dem[Nminusny,nx].astype(dtype),dtype(self.nodata))
     
-    def alt_vec_composite(self,way):
-        tmp=self.alt_vec_nostrict(way)
+    def alt_vec_composite(self,way,dtype=numpy.float64):
+        # later subdems take precedence over earlier ones, all over the base dem
+        tmp=self.alt_vec_nostrict(way,dtype)
         for subdem in self.subdems:
-            tmp2=subdem.alt_vec_strict(way)
-            tmp[tmp2!=subdem.nodata]=tmp2[tmp2!=subdem.nodata]
+            tmp2=subdem.alt_vec_strict(way,dtype)
+            has_data=tmp2!=subdem.nodata
+            tmp[has_data]=tmp2[has_data]
         return tmp     
             
 ###############################################################################
@@ -251,7 +262,11 @@ def build_combined_raster(source,lat,lon,info_only):
 
 ##############################################################################
 def read_elevation_from_file(file_name,lat,lon,info_only=False,base_if_error=3601):
+    if elevation_cache and not info_only:
+        elevation=read_cached_elevation(file_name,lat,lon)
+        if elevation: return elevation
     alt_dem=None
+    decoded=False
     if file_name[-4:].lower()=='.hgt':
         x0=y0=0; x1=y1=1; epsg=4326; nodata=-32768
         try:
@@ -260,8 +275,9 @@ def read_elevation_from_file(file_name,lat,lon,info_only=False,base_if_error=360
             if nxdem==1201:
                 nxdem=nydem=3601
                 if not info_only:
-                    fill_nodata_values_with_nearest_neighbor(alt_dem,nodata)
-                    alt_dem=upsample(alt_dem)
+                    fill_nodata_values(alt_dem,nodata)
+                    alt_dem=resample(alt_dem,(3601,3601))
+            decoded=True
         except:
             UI.lvprint(1,"    ERROR: in reading elevation from", file_name, "-> replaced with zero altitude.") 
             nxdem=nydem=base_if_error
@@ -275,6 +291,7 @@ def read_elevation_from_file(file_name,lat,lon,info_only=False,base_if_error=360
             alt.fromfile(f,nxdem*nydem)
             f.close()
             if not info_only: alt_dem=numpy.asarray(alt,dtype=numpy.float32).reshape((nxdem,nydem))[::-1]
+            decoded=True
         except:
             UI.lvprint(1,"    ERROR: in reading elevation from", file_name, "-> replaced with zero altitude.") 
             nxdem=nydem=base_if_error
@@ -307,6 +324,7 @@ def read_elevation_from_file(file_name,lat,lon,info_only=False,base_if_error=360
             y1=geo[3]+.5*geo[5]-lat
             x1=x0+(nxdem-1)*geo[1] 
             y0=y1+(nydem-1)*geo[5]  
+            decoded=True
         except:
             UI.lvprint(1,"   ERROR: in reading ", file_name, "-> replaced with zero altitude.") 
             nxdem=nydem=base_if_error
@@ -317,8 +335,80 @@ def read_elevation_from_file(file_name,lat,lon,info_only=False,base_if_error=360
         nxdem=nydem=base_if_error
         if not info_only: alt_dem=numpy.zeros((base_if_error,base_if_error),dtype=numpy.float32)
         x0=y0=0; x1=y1=1; epsg=4326; nodata=-32768
+    if elevation_cache and decoded and not info_only:
+        write_cached_elevation(file_name,lat,lon,(epsg,x0,y0,x1,y1,nodata,nxdem,nydem,alt_dem))
     return (epsg,x0,y0,x1,y1,nodata,nxdem,nydem,alt_dem)
 ##############################################################################    
+
+##############################################################################
+def read_cached_elevation(file_name,lat,lon):
+    cache_name=FNAMES.elevation_cache(file_name,lat,lon)
+    try:
+        if os.path.getmtime(cache_name+'.npy')<os.path.getmtime(file_name): return None
+        with open(cache_name+'.txt','r') as f:
+            info=json.load(f)
+        # copy-on-write : the dem can be modified in memory (e.g. nodata filling) without touching the cache
+        alt_dem=numpy.load(cache_name+'.npy',mmap_mode='c')
+        # for the eviction of the least recently used ones
+        os.utime(cache_name+'.txt')
+    except:
+        return None
+    return tuple(info)+(alt_dem,)
+##############################################################################
+
+##############################################################################
+def write_cached_elevation(file_name,lat,lon,elevation):
+    cache_name=FNAMES.elevation_cache(file_name,lat,lon)
+    (epsg,x0,y0,x1,y1,nodata,nxdem,nydem,alt_dem)=elevation
+    # neighbouring tiles built at the same time (batch) may write the same files,
+    # hence unique temporary names, and the metadata last since it validates the array
+    tmp_suffix='.'+str(os.getpid())+'.'+str(threading.get_ident())+'.tmp'
+    try:
+        os.makedirs(FNAMES.Elevation_cache_dir,exist_ok=True)
+        with open(cache_name+'.npy'+tmp_suffix,'wb') as f:
+            numpy.save(f,alt_dem.astype(numpy.float32,copy=False))
+        os.replace(cache_name+'.npy'+tmp_suffix,cache_name+'.npy')
+        with open(cache_name+'.txt'+tmp_suffix,'w') as f:
+            json.dump([int(epsg),x0,y0,x1,y1,nodata,nxdem,nydem],f)
+        os.replace(cache_name+'.txt'+tmp_suffix,cache_name+'.txt')
+    except Exception as e:
+        UI.vprint(2,"    WARNING: could not cache the elevation from",file_name,":",e)
+        for suffix in ('.npy','.txt'):
+            try: os.remove(cache_name+suffix+tmp_suffix)
+            except: pass
+        return
+    if elevation_cache_size: evict_cached_elevations()
+##############################################################################
+
+##############################################################################
+def evict_cached_elevations():
+    # down to 90% of elevation_cache_size, least recently used first (the .txt
+    # is touched when read). Files still mapped elsewhere (Windows) are kept. 
+    content=[]
+    try:
+        for file_name in os.listdir(FNAMES.Elevation_cache_dir):
+            if file_name[-4:]!='.npy': continue
+            cache_name=os.path.join(FNAMES.Elevation_cache_dir,file_name[:-4])
+            try:
+                content.append((os.path.getmtime(cache_name+'.txt'),os.path.getsize(cache_name+'.npy'),cache_name))
+            except:
+                content.append((0,os.path.getsize(cache_name+'.npy'),cache_name))
+    except:
+        return
+    used=sum(size for (_,size,_) in content)
+    for (_,size,cache_name) in sorted(content):
+        if used<=0.9*elevation_cache_size*2**20: break
+        try:
+            os.remove(cache_name+'.txt')
+        except:
+            pass
+        try:
+            os.remove(cache_name+'.npy')
+            used-=size
+        except:
+            pass
+    UI.vprint(2,"    Elevation cache trimmed to",round(used/2**20,1),"MB.")
+##############################################################################
            
 ##############################################################################
 def ensure_elevation(source,lat,lon,verbose=True):
@@ -486,52 +576,78 @@ def http_request(url,source,verbose=False):
 ##############################################################################
 
 ##############################################################################
-def fill_nodata_values_with_nearest_neighbor(alt_dem,nodata):
-        step=0
-        while (alt_dem==nodata).any():
-            if not step:
-                if numpy.sum(alt_dem==nodata)>=10000:
-                    return 0
-                UI.vprint(2,"    INFO: Elevation file contains voids, trying to fill them recursively by nearest neighbour.")       
-            else:
-                UI.vprint(2,"    ",step)
-            alt10=numpy.roll(alt_dem,1,axis=0)
-            alt10[0]=alt_dem[0]
-            alt20=numpy.roll(alt_dem,-1,axis=0)
-            alt20[-1]=alt_dem[-1]
-            alt01=numpy.roll(alt_dem,1,axis=1)
-            alt01[:,0]=alt_dem[:,0]
-            alt02=numpy.roll(alt_dem,-1,axis=1)
-            alt02[:,-1]=alt_dem[:,-1]
-            atemp=numpy.maximum(alt10,alt20)
-            atemp=numpy.maximum(atemp,alt01)
-            atemp=numpy.maximum(atemp,alt02)
-            alt_dem[alt_dem==nodata]=atemp[alt_dem==nodata]
-            step+=1
-            if step>20:
-                UI.vprint(1,"    WARNING: The raster contain holes that seem to big to be filled... I'm filling the remainder with zero.")
-                alt_dem[alt_dem==nodata]=0
-                break
-        if step: UI.vprint(2,"    Done.")
-        return 1 
+def fill_nodata_values(alt_dem,nodata):
+    # Pull-push (multigrid) interpolation : the valid elevations are averaged
+    # down a pyramid of 2x2 blocks until every void is covered, the coarse
+    # levels are then blended back up into the voids only. Voids of any size
+    # are filled in a single pass, smoothly from their boundary.
+    void=alt_dem==nodata
+    if not void.any(): return 1
+    if void.all(): return 0
+    UI.vprint(2,"    INFO: Elevation file contains voids, filling them by multigrid interpolation.")
+    weights=[(~void).astype(numpy.float32)]
+    values=[numpy.where(void,0,alt_dem).astype(numpy.float32)]
+    while weights[-1].shape[0]>1 or weights[-1].shape[1]>1:
+        (w,v)=(weights[-1],values[-1])
+        (h,l)=w.shape
+        if h%2 or l%2:
+            (w,v)=(numpy.pad(w,((0,h%2),(0,l%2))),numpy.pad(v,((0,h%2),(0,l%2))))
+        wv=w*v
+        w=w[0::2,0::2]+w[1::2,0::2]+w[0::2,1::2]+w[1::2,1::2]
+        wv=wv[0::2,0::2]+wv[1::2,0::2]+wv[0::2,1::2]+wv[1::2,1::2]
+        values.append(numpy.divide(wv,w,out=numpy.zeros_like(wv),where=w>0))
+        weights.append(numpy.minimum(w,1))
+    for level in range(len(values)-2,0,-1):
+        (h,l)=values[level].shape
+        coarse=upsample_by_two(values[level+1])[:h,:l]
+        w=weights[level]
+        values[level]=w*values[level]+(1-w)*coarse
+    # at full resolution only the voids need to be interpolated
+    (i,j)=numpy.nonzero(void)
+    alt_dem[i,j]=upsample_by_two_at(values[1],i,j)
+    UI.vprint(2,"    Done.")
+    return 1 
+##############################################################################
+
+##############################################################################
+def upsample_by_two(array):
+    # bilinear, each pixel being split into four (edges are clamped)
+    padded=numpy.pad(array,1,mode='edge')
+    rows=numpy.empty((2*array.shape[0],padded.shape[1]),dtype=array.dtype)
+    rows[0::2]=0.75*padded[1:-1]+0.25*padded[:-2]
+    rows[1::2]=0.75*padded[1:-1]+0.25*padded[2:]
+    out=numpy.empty((rows.shape[0],2*array.shape[1]),dtype=array.dtype)
+    out[:,0::2]=0.75*rows[:,1:-1]+0.25*rows[:,:-2]
+    out[:,1::2]=0.75*rows[:,1:-1]+0.25*rows[:,2:]
+    return out
+##############################################################################
+
+##############################################################################
+def upsample_by_two_at(array,i,j):
+    # same as upsample_by_two(array)[i,j] for arrays of pixel indices
+    (h,l)=array.shape
+    (ci,cj)=(i//2,j//2)
+    ni=numpy.clip(ci+2*(i%2)-1,0,h-1)
+    nj=numpy.clip(cj+2*(j%2)-1,0,l-1)
+    return 0.75*(0.75*array[ci,cj]+0.25*array[ni,cj])+0.25*(0.75*array[ci,nj]+0.25*array[ni,nj])
 ##############################################################################
 
 ##############################################################################
-def upsample(alt_dem):
-        # only implemented from 1201 to 3601, might be worth upgrading it some day
-        alt_dem_tmp=numpy.zeros((3601,3601),dtype=numpy.float32)
-        for i in range(1201): 
-            alt_dem_tmp[3*i,::3]=alt_dem[i]
-            alt_dem_tmp[3*i,1::3]=2/3*alt_dem[i,:-1]+1/3*alt_dem[i,1:]
-            alt_dem_tmp[3*i,2::3]=1/3*alt_dem[i,:-1]+2/3*alt_dem[i,1:]
-            if i==1200: break
-            alt_dem_tmp[3*i+1,::3]=2/3*alt_dem[i]+1/3*alt_dem[i+1]
-            alt_dem_tmp[3*i+2,::3]=1/3*alt_dem[i]+2/3*alt_dem[i+1]
-            alt_dem_tmp[3*i+1,1::3]=4/9*alt_dem[i][:-1]+2/9*alt_dem[i,1:]+2/9*alt_dem[i+1,:-1]+1/9*alt_dem[i+1,1:]
-            alt_dem_tmp[3*i+2,1::3]=2/9*alt_dem[i][:-1]+1/9*alt_dem[i,1:]+4/9*alt_dem[i+1,:-1]+2/9*alt_dem[i+1,1:]
-            alt_dem_tmp[3*i+1,2::3]=2/9*alt_dem[i][:-1]+4/9*alt_dem[i,1:]+1/9*alt_dem[i+1,:-1]+2/9*alt_dem[i+1,1:]
-            alt_dem_tmp[3*i+2,2::3]=1/9*alt_dem[i][:-1]+2/9*alt_dem[i,1:]+2/9*alt_dem[i+1,:-1]+4/9*alt_dem[i+1,1:]
-        return alt_dem_tmp
+def resample(alt_dem,shape):
+    # separable bilinear resampling to shape=(nydem,nxdem), the corner samples
+    # being kept (e.g. 1201x1201 -> 3601x3601 for 3" to 1" data), columns
+    # first since gathering whole rows is the cheaper of the two passes
+    for axis in (1,0):
+        (n_in,n_out)=(alt_dem.shape[axis],shape[axis])
+        if n_in==n_out: continue
+        pos=numpy.arange(n_out)*((n_in-1)/max(n_out-1,1))
+        i0=numpy.minimum(pos.astype(numpy.int64),max(n_in-2,0))
+        i1=numpy.minimum(i0+1,n_in-1)
+        frac=(pos-i0).astype(numpy.float32)
+        frac_shape=[1,1]; frac_shape[axis]=n_out
+        frac=frac.reshape(frac_shape)
+        alt_dem=(1-frac)*alt_dem.take(i0,axis=axis)+frac*alt_dem.take(i1,axis=axis)
+    return alt_dem
 ##############################################################################
 
 
@@ -539,23 +655,10 @@ def upsample(alt_dem):
 def smoothen(raster,pix_width,mask_im,preserve_boundary=True):
     if not pix_width: return raster
     if not mask_im: return raster
-    tmp = numpy.array(raster)
-    mask_array = numpy.array(mask_im,dtype=numpy.float)/255
-    kernel=numpy.array(range(1,2*(pix_width+1)))
-    kernel[pix_width+1:]=range(pix_width,0,-1)
-    kernel=kernel/(pix_width+1)**2
-    tmp=tmp*mask_array
-    tmpw=numpy.array(mask_array)
-    for i in range(0,len(tmp)):
-        tmp[i]=numpy.convolve(tmp[i],kernel)[pix_width:-pix_width]
-        tmpw[i]=numpy.convolve(tmpw[i],kernel)[pix_width:-pix_width]
-    tmp=tmp.transpose() 
-    tmpw=tmpw.transpose() 
-    for i in range(0,len(tmp)):
-        tmp[i]=numpy.convolve(tmp[i],kernel)[pix_width:-pix_width]
-        tmpw[i]=numpy.convolve(tmpw[i],kernel)[pix_width:-pix_width]
-    tmp=tmp.transpose()
-    tmpw=tmpw.transpose()
+    mask_array = numpy.array(mask_im,dtype=numpy.float32)/255
+    # convolution with a hat function, weighted by the mask
+    tmp=BLUR.hat_filter(raster*mask_array,pix_width+1)
+    tmpw=BLUR.hat_filter(numpy.array(mask_array),pix_width+1)
     tmp[mask_array!=0]=mask_array[mask_array!=0]*tmp[mask_array!=0]/tmpw[mask_array!=0]+(1-mask_array[mask_array!=0])*raster[mask_array!=0]
     if preserve_boundary:
         for i in range(pix_width):
@@ -5,12 +5,12 @@ from math import floor, ceil
 import array
 import numpy
 from PIL import Image, ImageDraw
-from collections import defaultdict
 import struct
 import hashlib
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Mask_Utils as MASK
+import O4_Mesh_IO as MESHIO
 import O4_UI_Utils as UI
 
 quad_init_level=3
@@ -25,73 +25,90 @@ use_test_texture=False
 
 ##############################################################################
 def float2qquad(x):
-    if x>=1: return '111111111111111111111111'
-    return numpy.binary_repr(int(16777216*x)).zfill(24) # 2**24=16777216
+    # 24 bits fixed point coordinates within the tile
+    return numpy.clip((16777216*numpy.asarray(x)).astype(numpy.int64),0,16777215) # 2**24=16777216
 ##############################################################################
 
 ##############################################################################
-class QuadTree(dict):
+# DSF binary encoding of point pools and patch commands, all values little 
+# endian uint16 written in bulk from arrays. 
+##############################################################################
+def encode_pool_planes(pool,nbr_planes):
+    # the pool stores nodes contiguously, the DSF wants it plane by plane,
+    # each plane being preceded by its encoding byte (0=raw)
+    coords=numpy.frombuffer(pool,dtype=numpy.uint16).reshape((-1,nbr_planes))
+    planes=numpy.zeros((nbr_planes,1+2*len(coords)),dtype=numpy.uint8)
+    planes[:,1:]=numpy.ascontiguousarray(coords.T,dtype='<u2').view(numpy.uint8)
+    return planes.tobytes()
+##############################################################################
 
-    class Bucket(dict):
-        def __init__(self):
-            self['size']=0
-            self['idx_nodes']=set()
+##############################################################################
+def encode_patch_triangles(coords,command):
+    # command 23 (PATCH TRIANGLE) : coords is a sequence of indices in the pool
+    # command 24 (PATCH TRIANGLE CROSS-POOL) : coords is a (n,2) array of (pool index, index in pool) 
+    # Commands hold at most 255 coordinates each.
+    coords=numpy.asarray(coords,dtype='<u2')
+    if coords.ndim==1: coords=coords.reshape((-1,1))
+    block_size=2*coords.shape[1]*255
+    blocks=len(coords)//255
+    remainder=len(coords)%255
+    out=numpy.empty((blocks,2+block_size),dtype=numpy.uint8)
+    out[:,0]=command
+    out[:,1]=255
+    out[:,2:]=numpy.ascontiguousarray(coords[:255*blocks]).view(numpy.uint8).reshape((blocks,block_size))
+    if not remainder:
+        return out.tobytes()
+    return out.tobytes()+struct.pack('<BB',command,remainder)+numpy.ascontiguousarray(coords[255*blocks:]).tobytes()
+##############################################################################
 
-    def __init__(self,level,bucket_size):
-        self.bucket_size=bucket_size
-        if level==0:
-            self[('','')]=self.Bucket() 
-        else:
-            for i in range(2**level):
-                for j in range(2**level):
-                    key=(numpy.binary_repr(i).zfill(level),numpy.binary_repr(j).zfill(level))
-                    self[key]=self.Bucket() 
-        self.nodes={}
-        self.levels={}
-        self.last_node=0
-    
-    def split_bucket(self,key):
-        level=len(key[0])+1
-        self[(key[0]+'0',key[1]+'0')]=self.Bucket()
-        self[(key[0]+'0',key[1]+'1')]=self.Bucket()
-        self[(key[0]+'1',key[1]+'0')]=self.Bucket()
-        self[(key[0]+'1',key[1]+'1')]=self.Bucket()
-        for idx in self[key]['idx_nodes']:
-            new_key=(self.nodes[idx][0][:level],self.nodes[idx][1][:level])
-            self[new_key]['idx_nodes'].add(idx)
-            self[new_key]['size']+=1
-            self.levels[idx]+=1
-        del(self[key])
+##############################################################################
+def pool_quadtree(qx,qy,init_level,capacity):
+    # Partition of the nodes (24 bits fixed point coordinates qx,qy) into pools.
+    # We start from the 4**init_level buckets of level init_level, a bucket is split
+    # in four as soon as it would receive more than capacity nodes, and empty 
+    # buckets are dropped. Nodes being inserted in their index order, a bucket 
+    # with more than capacity nodes is split when its (capacity+1)-th node comes, 
+    # and pools are ordered by the time their bucket was created.   
+    # Returns the pool of each node, and the level and coordinates of each pool.  
+    nbr_nodes=len(qx)
+    node_bucket=numpy.zeros(nbr_nodes,dtype=numpy.int64)
+    bucket_level=[]; bucket_x=[]; bucket_y=[]; bucket_order=[]
+    idx=numpy.arange(nbr_nodes)
+    parent_split=numpy.full(nbr_nodes,-1)
+    level=init_level
+    nbr_buckets=0
+    while len(idx):
+        cell=((qx[idx]>>(24-level))<<level)|(qy[idx]>>(24-level))
+        order=numpy.argsort(cell,kind='stable')
+        (idx,cell,parent_split)=(idx[order],cell[order],parent_split[order])
+        (cells,start,count)=numpy.unique(cell,return_index=True,return_counts=True)
+        # nodes at the same position could never be separated
+        split=(count>capacity) & (level<24)
+        leaf=~split
+        (cx,cy)=(cells>>level,cells&(2**level-1))
+        child=cells if level==init_level else 2*(cx&1)+(cy&1)
+        node_leaf=numpy.repeat(leaf,count)
+        node_bucket[idx[node_leaf]]=nbr_buckets+numpy.repeat(numpy.cumsum(leaf)-1,count)[node_leaf]
+        nbr_buckets+=numpy.count_nonzero(leaf)
+        bucket_level.append(numpy.full(numpy.count_nonzero(leaf),level))
+        bucket_x.append(cx[leaf]); bucket_y.append(cy[leaf])
+        bucket_order.append(numpy.column_stack((parent_split[start[leaf]],numpy.full(numpy.count_nonzero(leaf),level),child[leaf])))
+        parent_split=numpy.repeat(numpy.where(split,idx[numpy.minimum(start+capacity,len(idx)-1)],-1),count)[~node_leaf]
+        idx=idx[~node_leaf]
+        level+=1
+    bucket_order=numpy.concatenate(bucket_order)
+    bucket_to_pool=numpy.empty(nbr_buckets,dtype=numpy.int64)
+    bucket_to_pool[numpy.lexsort(bucket_order.T[::-1])]=numpy.arange(nbr_buckets)
+    pool_to_bucket=numpy.argsort(bucket_to_pool)
+    return (bucket_to_pool[node_bucket],numpy.concatenate(bucket_level)[pool_to_bucket],numpy.concatenate(bucket_x)[pool_to_bucket],numpy.concatenate(bucket_y)[pool_to_bucket])
+##############################################################################
 
-    def insert(self,bx,by,level):
-        while True:
-            key=(bx[:level],by[:level])
-            if key in self:
-                break
-            level+=1
-        if self[key]['size']<self.bucket_size:
-            self[key]['idx_nodes'].add(self.last_node)
-            self[key]['size']+=1
-            self.nodes[self.last_node]=(bx,by)
-            self.levels[self.last_node]=level
-            self.last_node+=1
-        else:
-            self.split_bucket(key)
-            self.insert(bx,by,level+1)
-    
-    def clean(self):
-        for key in list(self.keys()):
-            if not self[key]['size']:
-                del(self[key])
-                
-    
-    def statistics(self):
-        lengths=numpy.array([self[key]['size'] for key in self])
-        depths=numpy.array([len(key[0]) for key in self])
-        UI.vprint(1,"     Number of buckets:",len(lengths))
-        UI.vprint(1,"     Average depth:",depths.mean(),", Average bucket size:",lengths.mean())
-        UI.vprint(1,"     Largest depth:",numpy.max(depths))
-    
+##############################################################################
+def pool_quadtree_statistics(node_pool,pool_level):
+    lengths=numpy.bincount(node_pool,minlength=len(pool_level))
+    UI.vprint(1,"     Number of buckets:",len(lengths))
+    UI.vprint(1,"     Average depth:",pool_level.mean(),", Average bucket size:",lengths.mean())
+    UI.vprint(1,"     Largest depth:",numpy.max(pool_level))
 ##############################################################################
 
 ##############################################################################
@@ -231,46 +248,37 @@ def build_dsf(tile,download_queue):
        quad_capacity=quad_capacity_low
     else:
        quad_capacity=quad_capacity_high
-    pool_quadtree=QuadTree(quad_init_level,quad_capacity)
-    f_mesh=open(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon),"r")
-    mesh_version=float(f_mesh.readline().strip().split()[-1])
-    for i in range(3):
-        f_mesh.readline()
-    nbr_nodes=int(f_mesh.readline())
-    node_coords=numpy.zeros(5*nbr_nodes,'float')
-    for i in range(nbr_nodes):
-        node_coords[5*i:5*i+3]=[float(x) for x in f_mesh.readline().split()[:3]]
-        pool_quadtree.insert(float2qquad(node_coords[5*i]-tile.lon),float2qquad(node_coords[5*i+1]-tile.lat),quad_init_level)
-    pool_quadtree.clean()
-    pool_quadtree.statistics()
+    mesh=MESHIO.read_mesh_file(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon))
+    mesh_version=mesh.mesh_version
+    nbr_nodes=len(mesh.vertices)
+    node_coords=mesh.node_coords()
+    qx=float2qquad(node_coords[0::5]-tile.lon)
+    qy=float2qquad(node_coords[1::5]-tile.lat)
+    (node_pool,pool_level,pool_x,pool_y)=pool_quadtree(qx,qy,quad_init_level,quad_capacity)
+    pool_quadtree_statistics(node_pool,pool_level)
     # 
-    pool_nbr=len(pool_quadtree)
-    idx_node_to_idx_pool={}
-    idx_pool=0
-    key_to_idx_pool={}
-    for key in pool_quadtree:
-        key_to_idx_pool[key]=idx_pool
-        for idx_node in pool_quadtree[key]['idx_nodes']:
-            idx_node_to_idx_pool[idx_node]=idx_pool
-        idx_pool+=1
-    #
-    for i in range(3):
-        f_mesh.readline()
-    for i in range(nbr_nodes):
-        node_coords[5*i+3:5*i+5]=[float(x) for x in f_mesh.readline().split()[:2]]
+    pool_nbr=len(pool_level)
     # altitutes are encoded in .mesh files with a 100000 scaling factor 
     node_coords[2::5]*=100000
-    # pools params and nodes uint16 coordinates in pools 
-    pool_param={}
+    # pools params and nodes uint16 coordinates in pools : the 16 bits following
+    # the pool level in the 24 bits ones
     node_icoords = numpy.zeros(5*nbr_nodes,'uint16')
-    for key in pool_quadtree:
-        level=len(key[0])
-        plist=sorted(list(pool_quadtree[key]['idx_nodes']))
-        node_icoords[[5*idx_node for idx_node in plist]]=[int(pool_quadtree.nodes[idx_node][0][level:level+16],2) for idx_node in plist]
-        node_icoords[[5*idx_node+1 for idx_node in plist]]=[int(pool_quadtree.nodes[idx_node][1][level:level+16],2) for idx_node in plist]
-        altitudes=numpy.array([node_coords[5*idx_node+2] for idx_node in plist])
-        altmin=floor(altitudes.min())
-        altmax=ceil(altitudes.max())
+    node_level=pool_level[node_pool]
+    node_shift=numpy.maximum(8-node_level,0)
+    node_bits=numpy.minimum(16,24-node_level)
+    node_icoords[0::5]=(qx>>node_shift)&((1<<node_bits)-1)
+    node_icoords[1::5]=(qy>>node_shift)&((1<<node_bits)-1)
+    del qx, qy, node_level, node_shift, node_bits
+    altitudes=node_coords[2::5]
+    pool_altmin=numpy.full(pool_nbr,numpy.inf)
+    pool_altmax=numpy.full(pool_nbr,-numpy.inf)
+    numpy.minimum.at(pool_altmin,node_pool,altitudes)
+    numpy.maximum.at(pool_altmax,node_pool,altitudes)
+    pool_param={}
+    pool_inv_stp=numpy.zeros(pool_nbr)
+    for idx_pool in range(pool_nbr):
+        altmin=floor(pool_altmin[idx_pool])
+        altmax=ceil(pool_altmax[idx_pool])
         if altmax-altmin < 770:
             scale_z=771   # 65535=771*85
             inv_stp=85
@@ -283,12 +291,14 @@ def build_dsf(tile,download_queue):
         else:
             scale_z=13107 # 65535=13107*5
             inv_stp=5
-        scal_x=scal_y=2**(-level)    
-        node_icoords[[5*idx_node+2 for idx_node in plist]]=numpy.round((altitudes-altmin)*inv_stp)
-        pool_param[key_to_idx_pool[key]]=(scal_x,tile.lon+int(key[0],2)*scal_x,scal_y,tile.lat+int(key[1],2)*scal_y,scale_z,altmin,2,-1,2,-1,1,0,1,0,1,0,1,0)
+        pool_altmin[idx_pool]=altmin
+        pool_inv_stp[idx_pool]=inv_stp
+        scal_x=scal_y=2**(-int(pool_level[idx_pool]))
+        pool_param[idx_pool]=(scal_x,tile.lon+int(pool_x[idx_pool])*scal_x,scal_y,tile.lat+int(pool_y[idx_pool])*scal_y,scale_z,altmin,2,-1,2,-1,1,0,1,0,1,0,1,0)
+    node_icoords[2::5]=numpy.round((altitudes-pool_altmin[node_pool])*pool_inv_stp[node_pool])
+    del altitudes, pool_altmin, pool_altmax, pool_inv_stp
     node_icoords[3::5]=numpy.round((1+tile.normal_map_strength*node_coords[3::5])/2*65535)
     node_icoords[4::5]=numpy.round((1-tile.normal_map_strength*node_coords[4::5])/2*65535)
-    node_icoords=array.array('H',node_icoords)
     
     ##########################
     dico_terrains={}
@@ -305,307 +315,247 @@ def build_dsf(tile,download_queue):
     dsf_pool_plane=7*numpy.ones(dsf_pool_nbr,'int')
     dsf_pool_plane[pool_nbr:2*pool_nbr]=9
     dsf_pool_plane[2*pool_nbr:3*pool_nbr]=5
-    textured_nodes={}
-    len_textured_nodes=0
-    textured_tris={}
-    total_cross_pool=0
     ##########################
         
     bPROP=bTERT=bOBJT=bPOLY=bNETW=bDEMN=bGEOD=bDEMS=bCMDS=b'' 
     nbr_dsfpools_yet_in=0
     dico_terrains={'terrain_Water':0}
     bTERT=bytes("terrain_Water\0",'ascii')
-    textured_tris[0]=defaultdict(lambda: array.array('H'))
     
     # Next, we go through the Triangle section of the mesh file and build DSF 
     # mesh points (these take into accound texture as well), point pools, etc. 
     has_water = 7 if mesh_version>=1.3 else 3
     
-    for i in range(0,2): # skip 2 lines
-        f_mesh.readline()
-    nbr_tris=int(f_mesh.readline()) # read nbr of tris
-    step=nbr_tris//100+1
+    # Triangles of mixed types are set for water in priority (to avoid water cut by solid roads), and others are set for type=0 
+    tri_types=mesh.tri_types & has_water
+    tri_types=numpy.where(tri_types>0,numpy.where((tri_types>1) | bool(tile.use_masks_for_inland),2,1),0)
+    # First sea water (or equivalent) tris, second land and inland water tris 
+    tri_order=numpy.concatenate((numpy.nonzero(tri_types==2)[0],numpy.nonzero(tri_types<2)[0]))
+    tri_nodes=mesh.tris[tri_order][:,[0,2,1]].astype(numpy.int64)     # beware of ordering for orientation ! 
+    tri_types=tri_types[tri_order]
+    del mesh, tri_order
+    node_lonlat=node_coords.reshape((-1,5))[:,:2]
+    node_icoords=node_icoords.reshape((-1,5))
+    bary_lon=(node_lonlat[tri_nodes[:,0],0]+node_lonlat[tri_nodes[:,2],0]+node_lonlat[tri_nodes[:,1],0])/3
+    bary_lat=(node_lonlat[tri_nodes[:,0],1]+node_lonlat[tri_nodes[:,2],1]+node_lonlat[tri_nodes[:,1],1])/3
+    # some triangles could be reduced to nothing by the pool snapping, those with
+    # a terrain of their own are skipped (possible killer to X-Plane's drapping 
+    # of roads ?) together with their water counterparts    
+    tri_ipos=node_pool[tri_nodes]*2**32+node_icoords[tri_nodes,0].astype(numpy.int64)*65536+node_icoords[tri_nodes,1]
+    snapped=(tri_ipos[:,0]==tri_ipos[:,1]) | (tri_ipos[:,1]==tri_ipos[:,2]) | (tri_ipos[:,2]==tri_ipos[:,0])
+    del tri_ipos
+    UI.progress_bar(1,10)
+    if UI.red_flag: UI.vprint(1,"DSF construction interrupted."); return 0   
     
-    tri_list=[]
-    for i in range(nbr_tris):
-        # look for the texture that will possibly cover the tri
-        (n1,n2,n3,tri_type)=[int(x)-1 for x in f_mesh.readline().split()[:4]]
-        tri_type+=1
-        # Triangles of mixed types are set for water in priority (to avoid water cut by solid roads), and others are set for type=0 
-        tri_type = (tri_type & has_water) and (2*((tri_type & has_water)>1 or tile.use_masks_for_inland) or 1)
-        tri_list.append((n1,n2,n3,tri_type))
-    f_mesh.close()
+    # 1) Texture of each tri, from its barycenter orthogrid key 
+    (til_x,til_y)=GEO.wgs84_to_orthogrid_vec(bary_lat,bary_lon,tile.mesh_zl)
+    (grid_keys,tri_grid)=numpy.unique(til_x*2**32+til_y,return_inverse=True)
+    tri_grid=tri_grid.ravel()
+    textures=[]
+    texture_ids={}
+    grid_texture=numpy.zeros(len(grid_keys),dtype=numpy.int64)
+    for (k,grid_key) in enumerate(grid_keys.tolist()):
+        texture_attributes=dico_customzl[(grid_key>>32,grid_key&0xffffffff)]
+        if texture_attributes not in texture_ids:
+            texture_ids[texture_attributes]=len(textures)
+            textures.append(texture_attributes)
+        grid_texture[k]=texture_ids[texture_attributes]
+    tri_terrain_key=3*grid_texture[tri_grid]+tri_types
+    del til_x, til_y, grid_keys, tri_grid, grid_texture
+    # II. Low resolution texture with global coverage for sea tris         
+    low_res_sea=bool((tile.experimental_water & 2) or tile.add_low_res_sea_ovl)
+    nbr_sea_tris=numpy.count_nonzero(tri_types==2) if low_res_sea else 0
+    if nbr_sea_tris:
+        #sea_zl=int(IMG.providers_dict['SEA']['max_zl'])
+        sea_zl=experimental_water_zl
+        (til_x,til_y)=GEO.wgs84_to_orthogrid_vec(bary_lat[:nbr_sea_tris],bary_lon[:nbr_sea_tris],sea_zl)
+        (sea_keys,sea_tri_key)=numpy.unique(til_x*2**32+til_y,return_inverse=True)
+        sea_tri_key=sea_tri_key.ravel()
+        del til_x, til_y
+        # the first tri of each key which is not snapped is sure to use it, snapped ones 
+        # before it only do if they end up without a terrain of their own
+        sea_first=numpy.full(len(sea_keys),nbr_sea_tris)
+        unsnapped=numpy.nonzero(~snapped[:nbr_sea_tris])[0]
+        numpy.minimum.at(sea_first,sea_tri_key[unsnapped],unsnapped)
+        sea_cand=numpy.nonzero(numpy.arange(nbr_sea_tris)<=sea_first[sea_tri_key])[0]
+        del sea_first, unsnapped
+    del bary_lat, bary_lon
     
-    i=0
-    # First sea water (or equivalent) tris 
-    for tri in [tri for tri in tri_list if tri[3]==2]:
-        (n1,n2,n3,tri_type)=tri
-        if i%step==0:
-            UI.progress_bar(1,int(i/step*0.9))
-            if UI.red_flag: UI.vprint(1,"DSF construction interrupted."); return 0   
-        i+=1   
-        bary_lon=(node_coords[5*n1]+node_coords[5*n2]+node_coords[5*n3])/3
-        bary_lat=(node_coords[5*n1+1]+node_coords[5*n2+1]+node_coords[5*n3+1])/3
-        texture_attributes=dico_customzl[GEO.wgs84_to_orthogrid(bary_lat,bary_lon,tile.mesh_zl)]
-        # The entries for the terrain and texture main dictionnaries
-        terrain_attributes=(texture_attributes,tri_type)
-        # Do we need to build new terrain file(s) ?       
-        if terrain_attributes in dico_terrains: 
-            terrain_idx=dico_terrains[terrain_attributes]
-        else:
-            needs_new_terrain=False
-            # if not we need to check with masks values
-            if terrain_attributes not in skipped_terrains_for_masking:
+    # 2) Terrains, created in the order of their first use by a tri  
+    def new_terrain(texture_attributes,tri_type,is_overlay,check_g2xpl,force_download=False):
+        nonlocal bTERT
+        terrain_idx=len(dico_terrains)
+        if is_overlay: overlay_terrains.add(terrain_idx)
+        dico_terrains[(texture_attributes,tri_type)]=terrain_idx
+        texture_file_name=FNAMES.dds_file_name_from_attributes(*texture_attributes)
+        # do we need to download a new texture ?       
+        if texture_attributes not in treated_textures:
+            if (not os.path.isfile(os.path.join(tile.build_dir,'textures',texture_file_name))) or force_download:
+                if not check_g2xpl or 'g2xpl' not in texture_attributes[3]:
+                    download_queue.put(texture_attributes)
+                elif os.path.isfile(os.path.join(tile.build_dir,'textures',texture_file_name.replace('dds','partial.dds'))):
+                    texture_file_name=texture_file_name.replace('dds','partial.dds')
+                    UI.vprint(1,"   Texture file "+texture_file_name+" already present.")
+                else:
+                    UI.vprint(1,"   Missing a required texture, conversion from g2xpl requires texture download.")
+                    download_queue.put(texture_attributes)
+            else:
+                UI.vprint(1,"   Texture file "+texture_file_name+" already present.")
+            treated_textures.add(texture_attributes)
+        terrain_file_name=create_terrain_file(tile,texture_file_name,*texture_attributes,tri_type,is_overlay)
+        bTERT+=bytes('terrain/'+terrain_file_name+'\0','ascii') 
+        return terrain_idx
+    (terrain_keys,terrain_first)=numpy.unique(tri_terrain_key,return_index=True)
+    candidates=[(2*first,0,terrain_key) for (terrain_key,first) in zip(terrain_keys.tolist(),terrain_first.tolist())]
+    if nbr_sea_tris:
+        candidates+=[(2*tri_idx+1,1,tri_idx) for tri_idx in sea_cand.tolist()]
+    terrain_of_key=numpy.zeros(len(terrain_keys),dtype=numpy.int64)
+    sea_terrain_of_key=numpy.zeros(len(sea_keys) if nbr_sea_tris else 0,dtype=numpy.int64)
+    for (_,low_res,key) in sorted(candidates):
+        if not low_res:
+            texture_attributes=textures[key//3]
+            tri_type=key%3
+            terrain_attributes=(texture_attributes,tri_type)
+            if terrain_attributes in dico_terrains: 
+                terrain_idx=dico_terrains[terrain_attributes]
+            elif tri_type==2:
+                # sea tris only get a terrain of their own if masks are needed
+                terrain_idx=0
                 mask_im=MASK.needs_mask(tile,*texture_attributes)
                 if mask_im:
                     UI.vprint(2,"      Use of an alpha mask.")
-                    needs_new_terrain=True
                     mask_im.save(os.path.join(tile.build_dir,"textures",FNAMES.mask_file(*texture_attributes)))
+                    terrain_idx=new_terrain(texture_attributes,tri_type,True,True,tile.imprint_masks_to_dds)
                 else:
                     skipped_terrains_for_masking.add(terrain_attributes)
                     # clean up potential old masks in the tile dir   
                     try: os.remove(os.path.join(tile.build_dir,"textures",FNAMES.mask_file(*texture_attributes)))
                     except: pass
-            if needs_new_terrain:
-                terrain_idx=len(dico_terrains)
-                textured_tris[terrain_idx]=defaultdict(lambda: array.array('H'))
-                dico_terrains[terrain_attributes]=terrain_idx
-                is_overlay=tri_type==2 or (tri_type==1 and not (tile.experimental_water & 1))
-                if is_overlay: overlay_terrains.add(terrain_idx)
-                texture_file_name=FNAMES.dds_file_name_from_attributes(*texture_attributes)
-                # do we need to download a new texture ?       
-                if texture_attributes not in treated_textures:
-                    if (not os.path.isfile(os.path.join(tile.build_dir,'textures',texture_file_name))) or (tile.imprint_masks_to_dds):
-                        if  'g2xpl' not in texture_attributes[3]:
-                            download_queue.put(texture_attributes)
-                        elif os.path.isfile(os.path.join(tile.build_dir,'textures',texture_file_name.replace('dds','partial.dds'))):
-                            texture_file_name=texture_file_name.replace('dds','partial.dds')
-                            UI.vprint(1,"   Texture file "+texture_file_name+" already present.")
-                        else:
-                            UI.vprint(1,"   Missing a required texture, conversion from g2xpl requires texture download.")
-                            download_queue.put(texture_attributes)
-                    else:
-                        UI.vprint(1,"   Texture file "+texture_file_name+" already present.")
-                    treated_textures.add(texture_attributes)
-                terrain_file_name=create_terrain_file(tile,texture_file_name,*texture_attributes,tri_type,is_overlay)
-                bTERT+=bytes('terrain/'+terrain_file_name+'\0','ascii') 
             else:
-                terrain_idx=0
-        # We put the tri in the right terrain   
-        # First the ones associated to the dico_customzl 
-        if terrain_idx:
-            tri_p=array.array('H')
-            for n in (n1,n3,n2):     # beware of ordering for orientation ! 
-                idx_pool=idx_node_to_idx_pool[n]
-                node_hash=(idx_pool,*node_icoords[5*n:5*n+2],terrain_idx)
-                if node_hash in textured_nodes:
-                    (idx_dsfpool,pos_in_pool)=textured_nodes[node_hash]
-                else:
-                    (s,t)=GEO.st_coord(node_coords[5*n+1],node_coords[5*n],*texture_attributes)
-                    # BEWARE : normal coordinates are pointing (EAST,SOUTH) in X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
-                    if not tile.imprint_masks_to_dds: # border_tex
-                        idx_dsfpool=idx_pool+pool_nbr
-                        # border_tex masks with original normal
-                        dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+5])
-                        dsf_pools[idx_dsfpool].extend((int(round(s*65535)),int(round(t*65535)),int(round(s*65535)),int(round(t*65535))))
-                    else: # dtx5 dds with mask included
-                        idx_dsfpool=idx_pool
-                        dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+5])
-                        dsf_pools[idx_dsfpool].extend((int(round(s*65535)),int(round(t*65535))))
-                    len_textured_nodes+=1
-                    pos_in_pool=dsf_pool_length[idx_dsfpool]
-                    textured_nodes[node_hash]=(idx_dsfpool,pos_in_pool)
-                    dsf_pool_length[idx_dsfpool]+=1
-                tri_p.extend((idx_dsfpool,pos_in_pool))
-            # some triangles could be reduced to nothing by the pool snapping,
-            # we skip thme (possible killer to X-Plane's drapping of roads ?)    
-            if tri_p[:2]==tri_p[2:4] or tri_p[2:4]==tri_p[4:] or tri_p[4:]==tri_p[:2]:
-                continue
-            if tri_p[0]==tri_p[2]==tri_p[4]:
-                textured_tris[terrain_idx][tri_p[0]].extend((tri_p[1],tri_p[3],tri_p[5]))    
-            else:
-                total_cross_pool+=1
-                textured_tris[terrain_idx]['cross-pool'].extend(tri_p)
-        # I. X-Plane water
-        if not (tile.experimental_water & tri_type) :   
-            tri_p=array.array('H')
-            for n in (n1,n3,n2):     # beware of ordering for orientation ! 
-                node_hash=(n,0)
-                if node_hash in textured_nodes:
-                    (idx_dsfpool,pos_in_pool)=textured_nodes[node_hash]
-                else:
-                    idx_dsfpool=idx_node_to_idx_pool[n]+2*pool_nbr
-                    len_textured_nodes+=1
-                    pos_in_pool=dsf_pool_length[idx_dsfpool]
-                    textured_nodes[node_hash]=[idx_dsfpool,pos_in_pool]
-                    #in some cases we might prefer to use normal shading for some sea triangles too (albedo continuity with elevation derived masks) 
-                    #dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+5])
-                    dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+3])
-                    dsf_pools[idx_dsfpool].extend((32768,32768))
-                    dsf_pool_length[idx_dsfpool]+=1
-                tri_p.extend((idx_dsfpool,pos_in_pool))
-            if tri_p[0]==tri_p[2]==tri_p[4]:
-                textured_tris[0][tri_p[0]].extend((tri_p[1],tri_p[3],tri_p[5]))    
-            else:
-                total_cross_pool+=1
-                textured_tris[0]['cross-pool'].extend(tri_p)
-        # II. Low resolution texture with global coverage        
-        if ((tile.experimental_water & 2) or tile.add_low_res_sea_ovl): # experimental water over sea
-            #sea_zl=int(IMG.providers_dict['SEA']['max_zl'])
-            sea_zl=experimental_water_zl
-            (til_x_left,til_y_top)=GEO.wgs84_to_orthogrid(bary_lat,bary_lon,sea_zl)
-            texture_attributes=(til_x_left,til_y_top,sea_zl,'SEA')
-            terrain_attributes=(texture_attributes,tri_type)
-            if terrain_attributes in dico_terrains:
-                terrain_idx=dico_terrains[terrain_attributes]
-            else:
-                terrain_idx=len(dico_terrains)
-                is_overlay= not(tile.experimental_water & 2) and 'ratio_water'
-                if is_overlay: overlay_terrains.add(terrain_idx)
-                textured_tris[terrain_idx]=defaultdict(lambda: array.array('H'))
-                dico_terrains[terrain_attributes]=terrain_idx
-                texture_file_name=FNAMES.dds_file_name_from_attributes(*texture_attributes)
-                # do we need to download a new texture ?       
-                if texture_attributes not in treated_textures:
-                    if not os.path.isfile(os.path.join(tile.build_dir,'textures',texture_file_name)):
-                        download_queue.put(texture_attributes)
-                    else:
-                        UI.vprint(1,"   Texture file "+texture_file_name+" already present.")
-                    treated_textures.add(texture_attributes)
-                terrain_file_name=create_terrain_file(tile,texture_file_name,*texture_attributes,tri_type,is_overlay)
-                bTERT+=bytes('terrain/'+terrain_file_name+'\0','ascii') 
-            # We put the tri in the right terrain   
-            tri_p=array.array('H')
-            for n in (n1,n3,n2):     # beware of ordering for orientation ! 
-                idx_pool=idx_node_to_idx_pool[n]
-                node_hash=(idx_pool,*node_icoords[5*n:5*n+2],terrain_idx)
-                if node_hash in textured_nodes:
-                    (idx_dsfpool,pos_in_pool)=textured_nodes[node_hash]
-                else:
-                    (s,t)=GEO.st_coord(node_coords[5*n+1],node_coords[5*n],*texture_attributes)
-                    # BEWARE : normal coordinates are pointing (EAST,SOUTH) in X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
-                    if (tile.experimental_water & 2):
-                        idx_dsfpool=idx_pool
-                        # normal map texture over flat shading - no overlay
-                        dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+3])
-                        dsf_pools[idx_dsfpool].extend((32768,32768,int(round(s*65535)),int(round(t*65535))))    
-                    else:
-                        idx_dsfpool=idx_pool+pool_nbr
-                        # constant alpha overlay with flat shading
-                        dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+3])
-                        dsf_pools[idx_dsfpool].extend((32768,32768,int(round(s*65535)),int(round(t*65535)),0,int(round(tile.ratio_water*65535))))
-                    len_textured_nodes+=1
-                    pos_in_pool=dsf_pool_length[idx_dsfpool]
-                    textured_nodes[node_hash]=(idx_dsfpool,pos_in_pool)
-                    dsf_pool_length[idx_dsfpool]+=1
-                tri_p.extend((idx_dsfpool,pos_in_pool))
-            if tri_p[0]==tri_p[2]==tri_p[4]:
-                textured_tris[terrain_idx][tri_p[0]].extend((tri_p[1],tri_p[3],tri_p[5]))    
-            else:
-                total_cross_pool+=1
-                textured_tris[terrain_idx]['cross-pool'].extend(tri_p)
-    # Second land and inland water tris 
-    for tri in [tri for tri in tri_list if tri[3]<2]:
-        (n1,n2,n3,tri_type)=tri
-        if i%step==0:
-            UI.progress_bar(1,int(i/step*0.9))
-            if UI.red_flag: UI.vprint(1,"DSF construction interrupted."); return 0   
-        i+=1   
-        bary_lon=(node_coords[5*n1]+node_coords[5*n2]+node_coords[5*n3])/3
-        bary_lat=(node_coords[5*n1+1]+node_coords[5*n2+1]+node_coords[5*n3+1])/3
-        texture_attributes=dico_customzl[GEO.wgs84_to_orthogrid(bary_lat,bary_lon,tile.mesh_zl)]
-        # The entries for the terrain and texture main dictionnaries
-        terrain_attributes=(texture_attributes,tri_type)
-        # Do we need to build new terrain file(s) ?       
-        if terrain_attributes in dico_terrains: 
-            terrain_idx=dico_terrains[terrain_attributes]
+                is_overlay=(tri_type==1 and not (tile.experimental_water & 1))
+                terrain_idx=new_terrain(texture_attributes,tri_type,is_overlay,True)
+            terrain_of_key[numpy.searchsorted(terrain_keys,key)]=terrain_idx
         else:
-            terrain_idx=len(dico_terrains)
-            textured_tris[terrain_idx]=defaultdict(lambda: array.array('H'))
-            dico_terrains[terrain_attributes]=terrain_idx
-            is_overlay=(tri_type==1 and not (tile.experimental_water & 1))
-            if is_overlay: overlay_terrains.add(terrain_idx)
-            texture_file_name=FNAMES.dds_file_name_from_attributes(*texture_attributes)
-            # do we need to download a new texture ?       
-            if texture_attributes not in treated_textures:
-                if (not os.path.isfile(os.path.join(tile.build_dir,'textures',texture_file_name))):
-                    if  'g2xpl' not in texture_attributes[3]:
-                        download_queue.put(texture_attributes)
-                    elif os.path.isfile(os.path.join(tile.build_dir,'textures',texture_file_name.replace('dds','partial.dds'))):
-                        texture_file_name=texture_file_name.replace('dds','partial.dds')
-                        UI.vprint(1,"   Texture file "+texture_file_name+" already present.")
-                    else:
-                        UI.vprint(1,"   Missing a required texture, conversion from g2xpl requires texture download.")
-                        download_queue.put(texture_attributes)
-                else:
-                    UI.vprint(1,"   Texture file "+texture_file_name+" already present.")
-                treated_textures.add(texture_attributes)
-            terrain_file_name=create_terrain_file(tile,texture_file_name,*texture_attributes,tri_type,is_overlay)
-            bTERT+=bytes('terrain/'+terrain_file_name+'\0','ascii') 
-        # We put the tri in the right terrain   
-        # First the ones associated to the dico_customzl 
-        tri_p=array.array('H')
-        for n in (n1,n3,n2):     # beware of ordering for orientation ! 
-            idx_pool=idx_node_to_idx_pool[n]
-            node_hash=(idx_pool,*node_icoords[5*n:5*n+2],terrain_idx)
-            if node_hash in textured_nodes:
-                (idx_dsfpool,pos_in_pool)=textured_nodes[node_hash]
-            else:
-                (s,t)=GEO.st_coord(node_coords[5*n+1],node_coords[5*n],*texture_attributes)
-                # BEWARE : normal coordinates are pointing (EAST,SOUTH) in X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
-                if not tri_type: # land
-                    idx_dsfpool=idx_pool
-                    dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+5])
-                    dsf_pools[idx_dsfpool].extend((int(round(s*65535)),int(round(t*65535))))
-                else: # inland water
-                    if not (tile.experimental_water & 1):
-                        idx_dsfpool=idx_pool+pool_nbr
-                        # constant alpha overlay with flat shading
-                        dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+3])
-                        dsf_pools[idx_dsfpool].extend((32768,32768,int(round(s*65535)),int(round(t*65535)),0,int(round(tile.ratio_water*65535))))
-                    else:
-                        idx_dsfpool=idx_pool
-                        # normal map texture over flat shading - no overlay
-                        dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+3])
-                        dsf_pools[idx_dsfpool].extend((32768,32768,int(round(s*65535)),int(round(t*65535))))
-                len_textured_nodes+=1
-                pos_in_pool=dsf_pool_length[idx_dsfpool]
-                textured_nodes[node_hash]=(idx_dsfpool,pos_in_pool)
-                dsf_pool_length[idx_dsfpool]+=1
-            tri_p.extend((idx_dsfpool,pos_in_pool))
-        # some triangles could be reduced to nothing by the pool snapping,
-        # we skip thme (possible killer to X-Plane's drapping of roads ?)    
-        if tri_p[:2]==tri_p[2:4] or tri_p[2:4]==tri_p[4:] or tri_p[4:]==tri_p[:2]:
-            continue
-        if tri_p[0]==tri_p[2]==tri_p[4]:
-            textured_tris[terrain_idx][tri_p[0]].extend((tri_p[1],tri_p[3],tri_p[5]))    
+            if snapped[key] and terrain_of_key[numpy.searchsorted(terrain_keys,tri_terrain_key[key])]: continue
+            sea_key=int(sea_keys[sea_tri_key[key]])
+            texture_attributes=(sea_key>>32,sea_key&0xffffffff,sea_zl,'SEA')
+            terrain_attributes=(texture_attributes,2)
+            if terrain_attributes in dico_terrains:
+                # already created by a main SEA texture at sea_zl
+                sea_terrain_of_key[sea_tri_key[key]]=dico_terrains[terrain_attributes]
+                continue
+            is_overlay= not(tile.experimental_water & 2) and 'ratio_water'
+            sea_terrain_of_key[sea_tri_key[key]]=new_terrain(texture_attributes,2,is_overlay,False)
+        if UI.red_flag: UI.vprint(1,"DSF construction interrupted."); return 0   
+    tri_terrain=terrain_of_key[numpy.searchsorted(terrain_keys,tri_terrain_key)]
+    del tri_terrain_key
+    UI.progress_bar(1,30)
+    
+    # 3) Textured nodes. Each tri uses up to three of them per node : in its own
+    # terrain, in X-Plane water and in the low resolution sea terrain. A textured
+    # node is identified by its position in the pool and its terrain, and it is
+    # stored in the dsf pools in the order of its first use. 
+    degenerate=snapped & (tri_terrain>0)
+    del snapped
+    tri_xp_water=(tri_types>0) & ((tile.experimental_water & tri_types)==0) & ~degenerate
+    slots=[(0,numpy.nonzero(tri_terrain)[0],tri_terrain[tri_terrain>0]),
+           (1,numpy.nonzero(tri_xp_water)[0],None)]
+    if nbr_sea_tris:
+        slots.append((2,numpy.nonzero(~degenerate[:nbr_sea_tris])[0],sea_terrain_of_key[sea_tri_key][~degenerate[:nbr_sea_tris]]))
+    ev_order=[]; ev_node=[]; ev_slot=[]; ev_terrain=[]; ev_type=[]
+    for (slot,tri_idx,terrain) in slots:
+        ev_order.append(((3*tri_idx+slot)*3)[:,None]+numpy.arange(3))
+        ev_node.append(tri_nodes[tri_idx])
+        ev_slot.append(numpy.full((len(tri_idx),3),slot,dtype=numpy.int8))
+        ev_terrain.append(numpy.zeros((len(tri_idx),3),dtype=numpy.int64) if terrain is None else numpy.repeat(terrain[:,None],3,axis=1))
+        ev_type.append(numpy.repeat(tri_types[tri_idx][:,None],3,axis=1))
+    ev_order=numpy.concatenate([x.ravel() for x in ev_order])
+    ev_sort=numpy.argsort(ev_order,kind='stable')
+    ev_order=ev_order[ev_sort]
+    ev_node=numpy.concatenate([x.ravel() for x in ev_node])[ev_sort]
+    ev_slot=numpy.concatenate([x.ravel() for x in ev_slot])[ev_sort]
+    ev_terrain=numpy.concatenate([x.ravel() for x in ev_terrain])[ev_sort]
+    ev_type=numpy.concatenate([x.ravel() for x in ev_type])[ev_sort]
+    del ev_sort, tri_nodes, tri_types, tri_terrain
+    ev_pool=node_pool[ev_node]
+    ev_key=((ev_terrain*pool_nbr+ev_pool)*65536+node_icoords[ev_node,0])*65536+node_icoords[ev_node,1]
+    ev_key[ev_slot==1]=-1-ev_node[ev_slot==1]
+    (_,tn_first,ev_tn)=numpy.unique(ev_key,return_index=True,return_inverse=True)
+    ev_tn=ev_tn.ravel()
+    del ev_key
+    len_textured_nodes=len(tn_first)
+    tn_node=ev_node[tn_first]
+    tn_slot=ev_slot[tn_first]
+    tn_type=ev_type[tn_first]
+    tn_terrain=ev_terrain[tn_first]
+    tn_icoords=node_icoords[tn_node].astype(numpy.int64)
+    # texture coordinates
+    terrain_textures=numpy.zeros((len(dico_terrains),3))
+    for (terrain_attributes,terrain_idx) in dico_terrains.items():
+        if terrain_idx: terrain_textures[terrain_idx]=terrain_attributes[0][:3]
+    (s,t)=GEO.st_coord_vec(node_lonlat[tn_node,1],node_lonlat[tn_node,0],*terrain_textures[tn_terrain].T)
+    tn_st=numpy.column_stack((numpy.round(s*65535),numpy.round(t*65535))).astype(numpy.int64)
+    del s, t
+    # BEWARE : normal coordinates are pointing (EAST,SOUTH) in X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
+    flat_normal=numpy.full((len_textured_nodes,2),32768,dtype=numpy.int64)
+    water_alpha=numpy.column_stack((numpy.zeros(len_textured_nodes,dtype=numpy.int64),numpy.full(len_textured_nodes,int(round(tile.ratio_water*65535)))))
+    tn_pool=node_pool[tn_node]
+    tn_values=numpy.zeros((len_textured_nodes,9),dtype=numpy.int64)
+    # land, and inland water or sea with normal map texture (7 planes) 
+    case=((tn_slot==0) & (tn_type==0)) | ((tn_slot==0) & (tn_type==2) & bool(tile.imprint_masks_to_dds))
+    tn_values[case,:7]=numpy.hstack((tn_icoords,tn_st))[case]
+    case=((tn_slot==0) & (tn_type==1) & bool(tile.experimental_water & 1)) | ((tn_slot==2) & bool(tile.experimental_water & 2))
+    tn_values[case,:7]=numpy.hstack((tn_icoords[:,:3],flat_normal,tn_st))[case]
+    # sea with border_tex masks and original normal (9 planes)
+    case=(tn_slot==0) & (tn_type==2) & (not tile.imprint_masks_to_dds)
+    tn_values[case]=numpy.hstack((tn_icoords,tn_st,tn_st))[case]
+    tn_pool[case]+=pool_nbr
+    # constant alpha overlay with flat shading (9 planes)
+    case=((tn_slot==0) & (tn_type==1) & (not (tile.experimental_water & 1))) | ((tn_slot==2) & (not (tile.experimental_water & 2)))
+    tn_values[case]=numpy.hstack((tn_icoords[:,:3],flat_normal,tn_st,water_alpha))[case]
+    tn_pool[case]+=pool_nbr
+    # X-Plane water (5 planes)
+    case=(tn_slot==1)
+    tn_values[case,:5]=numpy.hstack((tn_icoords[:,:3],flat_normal))[case]
+    tn_pool[case]+=2*pool_nbr
+    del tn_icoords, tn_st, flat_normal, water_alpha, tn_slot, tn_type, tn_terrain, tn_node
+    # positions in pools follow first use
+    tn_sort=numpy.lexsort((tn_first,tn_pool))
+    (pools_in,pools_start,pools_count)=numpy.unique(tn_pool[tn_sort],return_index=True,return_counts=True)
+    tn_pos=numpy.zeros(len_textured_nodes,dtype=numpy.int64)
+    tn_pos[tn_sort]=numpy.arange(len_textured_nodes)-numpy.repeat(pools_start,pools_count)
+    for (idx_dsfpool,start,count) in zip(pools_in.tolist(),pools_start.tolist(),pools_count.tolist()):
+        values=tn_values[tn_sort[start:start+count],:dsf_pool_plane[idx_dsfpool]]
+        dsf_pools[idx_dsfpool]=array.array('H',values.astype(numpy.uint16).tobytes())
+        dsf_pool_length[idx_dsfpool]=count
+    del tn_values, tn_sort, tn_first
+    UI.progress_bar(1,60)
+    if UI.red_flag: UI.vprint(1,"DSF construction interrupted."); return 0   
+    
+    # 4) Tris in their terrain, either within a single pool or cross-pool 
+    tri_p=numpy.column_stack((tn_pool[ev_tn],tn_pos[ev_tn])).reshape((-1,6))
+    tri_terrain=ev_terrain[::3]
+    kept=(ev_slot[::3]!=0) | ~degenerate[ev_order[::3]//9]
+    tri_p=tri_p[kept]
+    tri_terrain=tri_terrain[kept]
+    del ev_tn, ev_slot, ev_terrain, ev_node, ev_pool, ev_type, ev_order, degenerate, kept
+    cross_pool=(tri_p[:,0]!=tri_p[:,2]) | (tri_p[:,0]!=tri_p[:,4])
+    total_cross_pool=int(numpy.count_nonzero(cross_pool))
+    # the cross-pool "pool" is encoded as dsf_pool_nbr 
+    tri_group=tri_terrain*(dsf_pool_nbr+1)+numpy.where(cross_pool,dsf_pool_nbr,tri_p[:,0])
+    (groups,group_first,group_count)=numpy.unique(tri_group,return_index=True,return_counts=True)
+    tri_sort=numpy.argsort(tri_group,kind='stable')
+    group_start=numpy.concatenate(([0],numpy.cumsum(group_count)[:-1]))
+    textured_tris={terrain_idx:{} for terrain_idx in range(len(dico_terrains))}
+    for k in numpy.lexsort((group_first,groups//(dsf_pool_nbr+1))).tolist():
+        (terrain_idx,idx_dsfpool)=divmod(int(groups[k]),dsf_pool_nbr+1)
+        group_p=tri_p[tri_sort[group_start[k]:group_start[k]+group_count[k]]]
+        if idx_dsfpool==dsf_pool_nbr:
+            textured_tris[terrain_idx]['cross-pool']=array.array('H',group_p.astype(numpy.uint16).tobytes())
         else:
-            total_cross_pool+=1
-            textured_tris[terrain_idx]['cross-pool'].extend(tri_p)
-        if tri_type: # All water effects not related to the full resolution texture 
-            # I. X-Plane water
-            if not (tile.experimental_water & tri_type) :   
-                tri_p=array.array('H')
-                for n in (n1,n3,n2):     # beware of ordering for orientation ! 
-                    node_hash=(n,0)
-                    if node_hash in textured_nodes:
-                        (idx_dsfpool,pos_in_pool)=textured_nodes[node_hash]
-                    else:
-                        idx_dsfpool=idx_node_to_idx_pool[n]+2*pool_nbr
-                        len_textured_nodes+=1
-                        pos_in_pool=dsf_pool_length[idx_dsfpool]
-                        textured_nodes[node_hash]=[idx_dsfpool,pos_in_pool]
-                        #in some cases we might prefer to use normal shading for some sea triangles too (albedo continuity with elevation derived masks) 
-                        #dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+5])
-                        dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+3])
-                        dsf_pools[idx_dsfpool].extend((32768,32768))
-                        dsf_pool_length[idx_dsfpool]+=1
-                    tri_p.extend((idx_dsfpool,pos_in_pool))
-                if tri_p[0]==tri_p[2]==tri_p[4]:
-                    textured_tris[0][tri_p[0]].extend((tri_p[1],tri_p[3],tri_p[5]))    
-                else:
-                    total_cross_pool+=1
-                    textured_tris[0]['cross-pool'].extend(tri_p)
+            textured_tris[terrain_idx][idx_dsfpool]=array.array('H',group_p[:,1::2].astype(numpy.uint16).tobytes())
+    del tri_p, tri_terrain, tri_group, tri_sort
+    UI.progress_bar(1,90)
     
     download_queue.put('quit')
     
@@ -675,20 +625,14 @@ def build_dsf(tile,download_queue):
         if dsf_pool_length[k]==0:
             continue
         f.write(b'LOOP')
-        f.write(struct.pack('<I',13+dsf_pool_plane[k]+2*dsf_pool_plane[k]*dsf_pool_length[k]))
-        f.write(struct.pack('<I',dsf_pool_length[k]))
-        f.write(struct.pack('<B',dsf_pool_plane[k]))
-        for l in range(dsf_pool_plane[k]):
-            f.write(struct.pack('<B',0))
-            for m in range(dsf_pool_length[k]):
-                f.write(struct.pack('<H',dsf_pools[k][dsf_pool_plane[k]*m+l]))
+        f.write(struct.pack('<IIB',13+dsf_pool_plane[k]+2*dsf_pool_plane[k]*dsf_pool_length[k],dsf_pool_length[k],dsf_pool_plane[k]))
+        f.write(encode_pool_planes(dsf_pools[k],dsf_pool_plane[k]))
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k]==0:
             continue
         f.write(b'LACS')
         f.write(struct.pack('<I',8+8*dsf_pool_plane[k]))
-        for l in range(2*dsf_pool_plane[k]):
-            f.write(struct.pack('<f',pool_param[k%pool_nbr][l]))
+        f.write(struct.pack('<'+str(2*dsf_pool_plane[k])+'f',*pool_param[k%pool_nbr][:2*dsf_pool_plane[k]]))
    
     UI.progress_bar(1,95)
     if UI.red_flag: UI.vprint(1,"DSF construction interrupted."); return 0   
@@ -699,10 +643,12 @@ def build_dsf(tile,download_queue):
     # to the stripping :
 
     dico_new_dsf_pool={}
+    new_dsf_pool_idx=numpy.zeros(dsf_pool_nbr,dtype=numpy.uint16)
     new_idx_dsfpool=nbr_dsfpools_yet_in
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k] != 0:
             dico_new_dsf_pool[k]=new_idx_dsfpool
+            new_dsf_pool_idx[k]=new_idx_dsfpool
             new_idx_dsfpool+=1
 
     # DEMS atom
@@ -733,57 +679,22 @@ def build_dsf(tile,download_queue):
     for terrain_idx in textured_tris:
         if len(textured_tris[terrain_idx])==0:
             continue
-        #print("terrain_idx = "+str(terrain_idx))
-        f.write(struct.pack('<B',4))           # SET DEFINITION 16
-        f.write(struct.pack('<H',terrain_idx)) # TERRAIN INDEX
+        f.write(struct.pack('<BH',4,terrain_idx))   # SET DEFINITION 16, TERRAIN INDEX
         flag=1 if terrain_idx not in overlay_terrains else 2   # physical or overlay
         lod=-1 if flag==1 else tile.overlay_lod
         for idx_dsfpool in textured_tris[terrain_idx]:
             if idx_dsfpool != 'cross-pool':
-                f.write(struct.pack('<B',1))                                 # POOL SELECT
-                f.write(struct.pack('<H',dico_new_dsf_pool[idx_dsfpool]))    # POOL INDEX
-                
-                f.write(struct.pack('<B',18))    # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack('<B',flag))  # FLAG
-                f.write(struct.pack('<f',0))     # NEAR LOD
-                f.write(struct.pack('<f',lod))   # FAR LOD
-                
-                blocks=floor(len(textured_tris[terrain_idx][idx_dsfpool])/255)
-                for j in range(blocks):
-                    f.write(struct.pack('<B',23))   # PATCH TRIANGLE
-                    f.write(struct.pack('<B',255))  # COORDINATE COUNT
-
-                    for k in range(255):
-                        f.write(struct.pack('<H',textured_tris[terrain_idx][idx_dsfpool][255*j+k]))  # COORDINATE IDX
-                remaining_tri_p=len(textured_tris[terrain_idx][idx_dsfpool])%255
-                if remaining_tri_p != 0:
-                    f.write(struct.pack('<B',23))               # PATCH TRIANGLE
-                    f.write(struct.pack('<B',remaining_tri_p))  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(struct.pack('<H',textured_tris[terrain_idx][idx_dsfpool][255*blocks+k]))  # COORDINATE IDX
+                f.write(struct.pack('<BH',1,dico_new_dsf_pool[idx_dsfpool]))  # POOL SELECT, POOL INDEX
+                f.write(struct.pack('<BBff',18,flag,0,lod))                   # TERRAIN PATCH FLAGS AND LOD, FLAG, NEAR LOD, FAR LOD
+                f.write(encode_patch_triangles(textured_tris[terrain_idx][idx_dsfpool],23))   # PATCH TRIANGLE
             else:  # idx_dsfpool == 'cross-pool'
                 pool_idx_init=textured_tris[terrain_idx][idx_dsfpool][0]
-                f.write(struct.pack('<B',1))                                   # POOL SELECT
-                f.write(struct.pack('<H',dico_new_dsf_pool[pool_idx_init]))    # POOL INDEX
-                f.write(struct.pack('<B',18))    # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack('<B',flag))  # FLAG
-                f.write(struct.pack('<f',0))     # NEAR LOD
-                f.write(struct.pack('<f',lod))   # FAR LOD
-                
-                blocks=floor(len(textured_tris[terrain_idx][idx_dsfpool])/510)
-                for j in range(blocks):
-                    f.write(struct.pack('<B',24))   # PATCH TRIANGLE CROSS-POOL
-                    f.write(struct.pack('<B',255))  # COORDINATE COUNT
-                    for k in range(255):
-                        f.write(struct.pack('<H',dico_new_dsf_pool[textured_tris[terrain_idx][idx_dsfpool][510*j+2*k]]))    # POOL IDX
-                        f.write(struct.pack('<H',textured_tris[terrain_idx][idx_dsfpool][510*j+2*k+1]))                     # POS_IN_POOL IDX
-                remaining_tri_p=int((len(textured_tris[terrain_idx][idx_dsfpool])%510)/2)
-                if remaining_tri_p != 0:
-                    f.write(struct.pack('<B',24))               # PATCH TRIANGLE CROSS-POOL
-                    f.write(struct.pack('<B',remaining_tri_p))  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(struct.pack('<H',dico_new_dsf_pool[textured_tris[terrain_idx][idx_dsfpool][510*blocks+2*k]]))   # POOL IDX
-                        f.write(struct.pack('<H',textured_tris[terrain_idx][idx_dsfpool][510*blocks+2*k+1]))                    # POS_IN_PO0L IDX
+                f.write(struct.pack('<BH',1,dico_new_dsf_pool[pool_idx_init]))  # POOL SELECT, POOL INDEX
+                f.write(struct.pack('<BBff',18,flag,0,lod))                      # TERRAIN PATCH FLAGS AND LOD, FLAG, NEAR LOD, FAR LOD
+                coords=numpy.frombuffer(textured_tris[terrain_idx][idx_dsfpool],dtype=numpy.uint16)
+                coords=coords[:2*(len(coords)//2)].reshape((-1,2)).copy()
+                coords[:,0]=new_dsf_pool_idx[coords[:,0]]
+                f.write(encode_patch_triangles(coords,24))   # PATCH TRIANGLE CROSS-POOL
     
     UI.progress_bar(1,98)
     if UI.red_flag: UI.vprint(1,"DSF construction interrupted."); return 0   
@@ -1,5 +1,6 @@
 import os
 import sys
+import zlib
 from math import floor
 
 g2xpl_16_prefix=''
@@ -11,9 +12,12 @@ Provider_dir  =  os.path.join(Ortho4XP_dir, 'Providers')
 Extent_dir    =  os.path.join(Ortho4XP_dir, 'Extents')
 Filter_dir    =  os.path.join(Ortho4XP_dir, 'Filters')
 OSM_dir       =  os.path.join(Ortho4XP_dir, 'OSM_data')
+OSM_index_dir =  os.path.join(OSM_dir, 'Extract_index')
 Mask_dir      =  os.path.join(Ortho4XP_dir, 'Masks')
 Imagery_dir   =  os.path.join(Ortho4XP_dir, 'Orthophotos')
+Raw_tile_dir  =  os.path.join(Ortho4XP_dir, 'Raw_tiles')
 Elevation_dir =  os.path.join(Ortho4XP_dir, 'Elevation_data')
+Elevation_cache_dir = os.path.join(Elevation_dir, 'Cache')
 Geotiff_dir   =  os.path.join(Ortho4XP_dir, 'Geotiffs')
 Patch_dir     =  os.path.join(Ortho4XP_dir, 'Patches')
 Utils_dir     =  os.path.join(Ortho4XP_dir, 'Utils')
@@ -111,6 +115,12 @@ def custom_water_dir(lat, lon):
     return os.path.join(OSM_dir,long_latlon(lat,lon),'custom_water')
 def osm_cached(lat, lon, cached_suffix):
     return os.path.join(OSM_dir,long_latlon(lat,lon),short_latlon(lat,lon)+'_'+cached_suffix+'.osm.bz2')
+def osm_binary_cached(lat, lon, cached_suffix):
+    return os.path.join(OSM_dir,long_latlon(lat,lon),short_latlon(lat,lon)+'_'+cached_suffix+'.o4osm')
+def osm_extract_index_dir(extract_name):
+    return os.path.join(OSM_index_dir,extract_name)
+def osm_extract_bucket(index_dir, lat, lon, osm_type, key):
+    return os.path.join(index_dir,long_latlon(lat,lon),short_latlon(lat,lon)+'_'+osm_type+'_'+key+'.npz')
 def osm_old_cached(lat, lon, query):
     subtags=query.split('"')
     return os.path.join(OSM_dir,long_latlon(lat,lon),short_latlon(lat,lon)+'_'+\
@@ -135,6 +145,13 @@ def elevation_data(source,lat, lon):
         return os.path.join(Elevation_dir,long_latlon(lat,lon)+'_NED1','w001001.adf') 
 ##############################################################################
 
+##############################################################################
+def elevation_cache(file_name,lat,lon):
+    # the decoded raster depends on the tile it is read for (through x0,y0,x1,y1)
+    return os.path.join(Elevation_cache_dir,os.path.basename(file_name).replace('.','_')+'_'+\
+            format(zlib.crc32(os.path.abspath(file_name).encode()),'08x')+'_'+short_latlon(lat,lon))
+##############################################################################
+
 ##############################################################################
 def generic_tif(lat, lon):
     return base_file_name(lat,lon)+'.tif'
@@ -157,6 +174,11 @@ def mask_file(til_x_left,til_y_top,zoomlevel,provider_code):
     return str(til_y_top)+"_"+str(til_x_left)+"_ZL"+str(zoomlevel)+".png"   
 ##############################################################################
 
+##############################################################################
+def raw_tile_file(provider_code,provider_key,tilematrix,til_x,til_y):
+    return os.path.join(Raw_tile_dir,provider_code+'_'+provider_key,str(tilematrix),str(til_y),str(til_x))
+##############################################################################
+
 ##############################################################################
 def jpeg_file_name_from_attributes(til_x_left,til_y_top,zoomlevel,provider_code):
     if provider_code=='g2xpl_16':
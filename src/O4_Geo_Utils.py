@@ -1,4 +1,6 @@
 from math import log, tan, pi, atan, exp, cos, sin, sqrt, atan2
+import threading
+import numpy
 import pyproj
 
 earth_radius = 6378137
@@ -16,18 +18,52 @@ def dist(A,B):
     return 2*earth_radius*atan2(sqrt(a),sqrt(1-a))
 
 epsg={}
-epsg['4326']=pyproj.Proj(init='epsg:4326')
-epsg['3857']=pyproj.Proj(init='epsg:3857')
-    
+epsg['4326']=pyproj.CRS('epsg:4326')
+epsg['3857']=pyproj.CRS('epsg:3857')
+
+# Transformers are costly to set up, they are built once per pair of epsg
+# codes and per thread (each holds its own PROJ context).
+transformers=threading.local()
+
 
 ##############################################################################
 def webmercator_pixel_size(lat,zoomlevel):
     return 2*pi*earth_radius*cos(pi*lat/180)/(2**(zoomlevel+8))
 ##############################################################################
 
+##############################################################################
+def transformer(s_epsg,t_epsg):
+    if not hasattr(transformers,'cache'): transformers.cache={}
+    key=(s_epsg,t_epsg)
+    if key not in transformers.cache:
+        # always_xy : lon,lat order as for the former Proj(init=...) objects
+        transformers.cache[key]=pyproj.Transformer.from_crs(epsg[s_epsg],epsg[t_epsg],always_xy=True)
+    return transformers.cache[key]
+##############################################################################
+
 ##############################################################################
 def transform(s_epsg, t_epsg, s_x, s_y):
-    return pyproj.transform(epsg[s_epsg], epsg[t_epsg], s_x, s_y)
+    """
+    s_x and s_y can be numbers or arrays (one call for a whole batch of points)
+    """
+    return transformer(s_epsg,t_epsg).transform(s_x,s_y)
+##############################################################################
+
+##############################################################################
+# The conversions below come in two flavours : the _vec kernels accept NumPy
+# arrays and are meant to be called once per batch, the scalar functions use
+# math since they are called point by point in loops (earth map, tiles and 
+# textures enumeration) where NumPy's per call overhead would dominate.
+##############################################################################
+
+##############################################################################
+def gtile_to_wgs84_vec(til_x,til_y,zoomlevel):
+    mult=2.0**(numpy.asarray(zoomlevel)-1)
+    rat_x=numpy.asarray(til_x)/mult-1
+    rat_y=1-numpy.asarray(til_y)/mult
+    lon=rat_x*180
+    lat=360/pi*numpy.arctan(numpy.exp(pi*rat_y))-90
+    return (lat,lon)
 ##############################################################################
 
 ##############################################################################
@@ -45,18 +81,18 @@ def gtile_to_wgs84(til_x,til_y,zoomlevel):
 ##############################################################################
 
 ##############################################################################
-def wgs84_to_gtile(lat,lon,zoomlevel):                                          
-    rat_x=lon/180           
-    rat_y=log(tan((90+lat)*pi/360))/pi
-    pix_x=round((rat_x+1)*(2**(zoomlevel+7)))
-    pix_y=round((1-rat_y)*(2**(zoomlevel+7)))
-    til_x=pix_x//256
-    til_y=pix_y//256
-    return (til_x,til_y)
+def wgs84_to_pix_vec(lat,lon,zoomlevel):
+    rat_x=numpy.asarray(lon)/180
+    rat_y=numpy.log(numpy.tan((90+numpy.asarray(lat))*pi/360))/pi
+    mult=2.0**(numpy.asarray(zoomlevel)+7)
+    # rint rounds half to even, as round does
+    pix_x=numpy.rint((rat_x+1)*mult).astype(numpy.int64)
+    pix_y=numpy.rint((1-rat_y)*mult).astype(numpy.int64)
+    return (pix_x,pix_y)
 ##############################################################################
 
 ##############################################################################
-def wgs84_to_pix(lat,lon,zoomlevel):                                          
+def wgs84_to_pix(lat,lon,zoomlevel):
     rat_x=lon/180           
     rat_y=log(tan((90+lat)*pi/360))/pi
     pix_x=round((rat_x+1)*(2**(zoomlevel+7)))
@@ -64,6 +100,28 @@ def wgs84_to_pix(lat,lon,zoomlevel):
     return (pix_x,pix_y)
 ##############################################################################
 
+##############################################################################
+def wgs84_to_gtile_vec(lat,lon,zoomlevel):
+    (pix_x,pix_y)=wgs84_to_pix_vec(lat,lon,zoomlevel)
+    return (pix_x//256,pix_y//256)
+##############################################################################
+
+##############################################################################
+def wgs84_to_gtile(lat,lon,zoomlevel):
+    (pix_x,pix_y)=wgs84_to_pix(lat,lon,zoomlevel)
+    return (pix_x//256,pix_y//256)
+##############################################################################
+
+##############################################################################
+def pix_to_wgs84_vec(pix_x,pix_y,zoomlevel):
+    mult=2.0**(numpy.asarray(zoomlevel)+7)
+    rat_x=numpy.asarray(pix_x)/mult-1
+    rat_y=1-numpy.asarray(pix_y)/mult
+    lon=rat_x*180
+    lat=360/pi*numpy.arctan(numpy.exp(pi*rat_y))-90
+    return (lat,lon)
+##############################################################################
+
 ##############################################################################
 def pix_to_wgs84(pix_x,pix_y,zoomlevel):
     rat_x=(pix_x/(2**(zoomlevel+7))-1)
@@ -91,6 +149,16 @@ def gtile_to_quadkey(til_x,til_y,zoomlevel):
     return quadkey
 ##############################################################################
 
+##############################################################################
+def wgs84_to_orthogrid_vec(lat,lon,zoomlevel):
+    ratio_x=numpy.asarray(lon)/180           
+    ratio_y=numpy.log(numpy.tan((90+numpy.asarray(lat))*pi/360))/pi
+    mult=2.0**(numpy.asarray(zoomlevel)-5)
+    til_x=((ratio_x+1)*mult).astype(numpy.int64)*16
+    til_y=((1-ratio_y)*mult).astype(numpy.int64)*16
+    return (til_x,til_y)
+##############################################################################
+
 ##############################################################################
 def wgs84_to_orthogrid(lat,lon,zoomlevel):
     ratio_x=lon/180           
@@ -101,6 +169,19 @@ def wgs84_to_orthogrid(lat,lon,zoomlevel):
     return (til_x,til_y)
 ##############################################################################
 
+##############################################################################
+def st_coord_vec(lat,lon,tex_x,tex_y,zoomlevel,provider_code=None):                        
+    """
+    ST coordinates of arrays of points, texture attributes can be arrays too
+    """
+    ratio_x=numpy.asarray(lon)/180           
+    ratio_y=numpy.log(numpy.tan((90+numpy.asarray(lat))*pi/360))/pi
+    mult=2.0**(numpy.asarray(zoomlevel)-5)
+    s=(ratio_x+1)*mult-(numpy.asarray(tex_x)//16)
+    t=1-((1-ratio_y)*mult-numpy.asarray(tex_y)//16)
+    return (numpy.clip(s,0,1),numpy.clip(t,0,1))
+##############################################################################
+
 ##############################################################################
 def st_coord(lat,lon,tex_x,tex_y,zoomlevel,provider_code):                        
     """
@@ -4,8 +4,11 @@ import sys
 import subprocess
 import io
 import requests
-import queue
 import random
+import threading
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from math import ceil, log, tan, pi
 import numpy
 from PIL import Image, ImageFilter, ImageEnhance,  ImageOps
@@ -13,6 +16,8 @@ Image.MAX_IMAGE_PIXELS = 1000000000 # Not a decompression bomb attack!
 import O4_UI_Utils as UI
 import O4_Geo_Utils as GEO
 import O4_File_Names as FNAMES
+import O4_DDS_Utils as DDS
+import O4_Blur_Utils as BLUR
 try:
     import O4_Custom_URL as URL
     has_URL=True
@@ -29,12 +34,13 @@ import O4_Vector_Utils as VECT
 import O4_Mesh_Utils as MESH
 import O4_OSM_Utils as OSM
 import O4_Mask_Utils as MASK
-from O4_Parallel_Utils import parallel_execute
 
 http_timeout=10
 check_tms_response=False
 max_connect_retries=10
 max_baddata_retries=10
+# in MB, zero disables the on-disk cache of provider tiles 
+raw_tile_cache_size=0
 
 user_agent_generic="Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0"
 request_headers_generic={
@@ -59,6 +65,9 @@ else:
     gdal_transl_cmd = "gdal_translate"
     gdalwarp_cmd    = "gdalwarp"
     devnull_rdir    = " >/dev/null 2>&1 "
+
+# 'nvcompress' (external tool) or 'numpy' (in-process encoder of O4_DDS_Utils)
+dds_encoder='nvcompress'
     
 ###############################################################################################################################
 #
@@ -71,6 +80,9 @@ combined_providers_dict={}
 local_combined_providers_dict={}
 extents_dict={'global':{'dir':None,'code':'global'}}
 color_filters_dict={'none':[]}
+# filter chains compiled by color_transform, per (color_code, image mode) 
+compiled_color_filters_dict={}
+pointwise_color_filters=('brightness-contrast','levels')
 
 def initialize_extents_dict():
     for dir_name in os.listdir(FNAMES.Extent_dir):
@@ -96,11 +108,11 @@ def initialize_extents_dict():
                 # structuring data
                 if key=='epsg_code':
                     try:
-                        GEO.epsg[value]=GEO.pyproj.Proj(init='epsg:'+value)
+                        GEO.epsg[value]=GEO.pyproj.CRS('epsg:'+value)
                     except:
                         # HACK for Slovenia 
                         if int(value)==102060:
-                            GEO.epsg[value]=GEO.pyproj.Proj(init='epsg:3912')
+                            GEO.epsg[value]=GEO.pyproj.CRS('epsg:3912')
                         else:
                             print("Error in epsg code for extent",extent_code)
                             valid_extent=False
@@ -132,6 +144,7 @@ def initialize_extents_dict():
             f.close()
 
 def initialize_color_filters_dict():
+    compiled_color_filters_dict.clear()
     for file_name in os.listdir(FNAMES.Filter_dir):
             if '.' not in file_name or file_name.split('.')[-1]!='flt': continue
             color_code=file_name.split('.')[0]
@@ -195,11 +208,11 @@ def initialize_providers_dict():
                         valid_provider=False
                 elif key=='epsg_code':
                     try:
-                        GEO.epsg[value]=GEO.pyproj.Proj(init='epsg:'+value)
+                        GEO.epsg[value]=GEO.pyproj.CRS('epsg:'+value)
                     except:
                         # HACK for Slovenia 
                         if int(value)==102060:
-                            GEO.epsg[value]=GEO.pyproj.Proj(init='epsg:3912')
+                            GEO.epsg[value]=GEO.pyproj.CRS('epsg:3912')
                         else:
                             UI.vprint(0,"Error in epsg code for provider",provider_code)
                             valid_provider=False
@@ -442,17 +455,7 @@ def initialize_local_combined_providers_dict(tile):
                                     mask_im=Image.fromarray((numpy.array(mask_im,dtype=numpy.uint8)==255).astype(numpy.uint8)*255)
                             if mask_width:
                                 mask_width+=1
-                                img_array=numpy.array(mask_im,dtype=numpy.uint8)
-                                kernel=numpy.ones(int(mask_width))/int(mask_width)
-                                kernel=numpy.array(range(1,2*mask_width))
-                                kernel[mask_width:]=range(mask_width-1,0,-1)
-                                kernel=kernel/mask_width**2
-                                for i in range(0,len(img_array)):
-                                    img_array[i]=numpy.convolve(img_array[i],kernel,'same')
-                                img_array=img_array.transpose() 
-                                for i in range(0,len(img_array)):
-                                    img_array[i]=numpy.convolve(img_array[i],kernel,'same')
-                                img_array=img_array.transpose()
+                                img_array=BLUR.hat_filter(numpy.array(mask_im,dtype=numpy.uint8),mask_width)
                                 img_array[img_array>=128]=255
                                 img_array[img_array<128]*=2  
                                 img_array=numpy.array(img_array,dtype=numpy.uint8)
@@ -508,6 +511,80 @@ def read_tilematrixsets(file_name):
     f.close()
     return tilematrixsets
 
+###############################################################################################################################
+# Extent masks are decoded once and kept in memory (the extent_mask_cache_size most recently used
+# ones). Each comes with a summed-area table of its number of pixels with data by blocks of
+# extent_block_size pixels, which answers "any data in this box" without scanning the pixels,
+# except for the partially covered blocks at the border of the box when it is not conclusive.
+extent_mask_cache=OrderedDict()
+extent_mask_cache_size=8
+extent_mask_cache_lock=threading.Lock()
+extent_block_size=16
+
+class ExtentMask():
+    def __init__(self,file_name):
+        self.array=numpy.array(Image.open(file_name).convert("L"))
+        (self.sizey,self.sizex)=self.array.shape
+        # for negative extents data is where the mask is not white, computed when first needed
+        self.sat={False:self.block_sat(self.array!=0),True:None}
+
+    def block_sat(self,has_data_array):
+        b=extent_block_size
+        (h,w)=has_data_array.shape
+        padded=numpy.zeros((-(-h//b)*b,-(-w//b)*b),dtype=numpy.int32)
+        padded[:h,:w]=has_data_array
+        counts=padded.reshape((padded.shape[0]//b,b,padded.shape[1]//b,b)).sum(axis=(1,3),dtype=numpy.int64)
+        sat=numpy.zeros((counts.shape[0]+1,counts.shape[1]+1),dtype=numpy.int64)
+        sat[1:,1:]=counts.cumsum(axis=0).cumsum(axis=1)
+        return sat
+
+    def block_count(self,sat,bx0,by0,bx1,by1):
+        if bx1<=bx0 or by1<=by0: return 0
+        return sat[by1,bx1]-sat[by0,bx1]-sat[by1,bx0]+sat[by0,bx0]
+
+    def any_data(self,pxx0,pxy0,pxx1,pxy1,negative=False):
+        # same answer as getbbox() on the (possibly inverted) crop of the mask, the crop being
+        # padded with zeros outside of the mask (i.e. with data for negative extents)
+        if pxx1<=pxx0 or pxy1<=pxy0: return False
+        (x0,y0,x1,y1)=(max(pxx0,0),max(pxy0,0),min(pxx1,self.sizex),min(pxy1,self.sizey))
+        if negative and (x0,y0,x1,y1)!=(pxx0,pxy0,pxx1,pxy1): return True
+        if x1<=x0 or y1<=y0: return False
+        if negative and self.sat[True] is None:
+            self.sat[True]=self.block_sat(self.array!=255)
+        sat=self.sat[negative]
+        b=extent_block_size
+        # no data in the blocks touching the box, or some in the blocks within the box ?
+        if not self.block_count(sat,x0//b,y0//b,-(-x1//b),-(-y1//b)): return False
+        if self.block_count(sat,-(-x0//b),-(-y0//b),x1//b,y1//b): return True
+        sub_array=self.array[y0:y1,x0:x1]
+        return bool((sub_array!=255).any() if negative else sub_array.any())
+
+    def crop(self,pxx0,pxy0,pxx1,pxy1):
+        # as Image.crop, zero padded outside of the mask
+        crop_array=numpy.zeros((max(pxy1-pxy0,0),max(pxx1-pxx0,0)),dtype=numpy.uint8)
+        (x0,y0,x1,y1)=(max(pxx0,0),max(pxy0,0),min(pxx1,self.sizex),min(pxy1,self.sizey))
+        if x1>x0 and y1>y0:
+            crop_array[y0-pxy0:y1-pxy0,x0-pxx0:x1-pxx0]=self.array[y0:y1,x0:x1]
+        return Image.fromarray(crop_array)
+###############################################################################################################################
+
+###############################################################################################################################
+def extent_mask(extent_code):
+    file_name=os.path.join(FNAMES.Extent_dir,extents_dict[extent_code]['dir'],extents_dict[extent_code]['code']+".png")
+    key=(file_name,os.path.getmtime(file_name))
+    with extent_mask_cache_lock:
+        if key in extent_mask_cache:
+            extent_mask_cache.move_to_end(key)
+            return extent_mask_cache[key]
+    ext_mask=ExtentMask(file_name)
+    with extent_mask_cache_lock:
+        extent_mask_cache[key]=ext_mask
+        while len(extent_mask_cache)>extent_mask_cache_size:
+            extent_mask_cache.popitem(last=False)
+    return ext_mask
+###############################################################################################################################
+
+###############################################################################################################################
 def has_data(bbox,extent_code,return_mask=False,mask_size=(4096,4096),is_sharp_resize=False,is_mask_layer=False):
     # This function checks wether a given provider has data instersecting the given bbox. 
     # IMPORTANT : THE EXTENT AND THE BBOX NEED TO BE USING THE SAME REFERENCE FRAME (e.g. ESPG CODE) 
@@ -529,8 +606,8 @@ def has_data(bbox,extent_code,return_mask=False,mask_size=(4096,4096),is_sharp_r
         if x0>xmax or x1<xmin or y0<ymin or y1>ymax:
             return negative
         if (not is_mask_layer) or (x1-x0)==1:
-            mask_im=Image.open(os.path.join(FNAMES.Extent_dir,extents_dict[extent_code]['dir'],extents_dict[extent_code]['code']+".png")).convert("L")
-            (sizex,sizey)=mask_im.size
+            ext_mask=extent_mask(extent_code)
+            (sizex,sizey)=(ext_mask.sizex,ext_mask.sizey)
             pxx0=int((x0-xmin)/(xmax-xmin)*sizex)
             pxx1=int((x1-xmin)/(xmax-xmin)*sizex)
             pxy0=int((ymax-y0)/(ymax-ymin)*sizey)
@@ -540,12 +617,12 @@ def has_data(bbox,extent_code,return_mask=False,mask_size=(4096,4096),is_sharp_r
                 pxx1=min(sizex,pxx1)
                 pxy0=max(-1,pxy0)
                 pxy1=min(sizey,pxy1)
-            mask_im=mask_im.crop((pxx0,pxy0,pxx1,pxy1))
-            if negative: mask_im=ImageOps.invert(mask_im)
-            if not mask_im.getbbox():
+            if not ext_mask.any_data(pxx0,pxy0,pxx1,pxy1,negative):
                 return False
             if not return_mask:
                 return True
+            mask_im=ext_mask.crop(pxx0,pxy0,pxx1,pxy1)
+            if negative: mask_im=ImageOps.invert(mask_im)
             if is_sharp_resize:
                 return mask_im.resize(mask_size)
             else:
@@ -564,16 +641,16 @@ def has_data(bbox,extent_code,return_mask=False,mask_size=(4096,4096),is_sharp_r
                 return False
             # build extent mask_im
             if extent_code!='global':
-                mask_im=Image.open(os.path.join(FNAMES.Extent_dir,extents_dict[extent_code]['dir'],extents_dict[extent_code]['code']+".png")).convert("L")
-                (sizex,sizey)=mask_im.size
+                ext_mask=extent_mask(extent_code)
+                (sizex,sizey)=(ext_mask.sizex,ext_mask.sizey)
                 pxx0=int((x0-xmin)/(xmax-xmin)*sizex)
                 pxx1=int((x1-xmin)/(xmax-xmin)*sizex)
                 pxy0=int((ymax-y0)/(ymax-ymin)*sizey)
                 pxy1=int((ymax-y1)/(ymax-ymin)*sizey)
-                mask_im=mask_im.crop((pxx0,pxy0,pxx1,pxy1))
-                if negative: mask_im=ImageOps.invert(mask_im)
-                if not mask_im.getbbox():
+                if not ext_mask.any_data(pxx0,pxy0,pxx1,pxy1,negative):
                     return False
+                mask_im=ext_mask.crop(pxx0,pxy0,pxx1,pxy1)
+                if negative: mask_im=ImageOps.invert(mask_im)
                 if is_sharp_resize:
                     mask_im=mask_im.resize(mask_size)
                 else:
@@ -616,7 +693,57 @@ def has_data(bbox,extent_code,return_mask=False,mask_size=(4096,4096),is_sharp_r
 ###############################################################################################################################
 
 ###############################################################################################################################
-def http_request_to_image(width,height,url,request_headers,http_session):
+# Each provider has its own long-lived download engine : an http session whose connection pool keeps
+# its connections alive from one texture to the next, and a pool of worker threads. Both are sized 
+# after provider['max_threads'], which hence limits the number of simultaneous requests to the
+# provider whatever the number of textures being built. Images are decoded by the workers while
+# the other downloads go on. Batch builds processes share that limit in equal parts.
+download_engines={}
+download_processes=1
+download_engines_lock=threading.Lock()
+
+class DownloadEngine():
+    def __init__(self,provider):
+        self.max_threads=int(provider['max_threads']) if 'max_threads' in provider else 16
+        self.max_threads=max(1,self.max_threads//download_processes)
+        self.http_session=requests.Session()
+        adapter=requests.adapters.HTTPAdapter(pool_connections=4,pool_maxsize=self.max_threads,pool_block=True)
+        self.http_session.mount('http://',adapter)
+        self.http_session.mount('https://',adapter)
+        self.executor=ThreadPoolExecutor(max_workers=self.max_threads)
+
+    def execute(self,task,args_list,progress=None):
+        pending={self.executor.submit(task,*args) for args in args_list}
+        success=1
+        while pending:
+            (finished,pending)=wait(pending,timeout=1,return_when=FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    success=future.result() and success
+                except Exception as e:
+                    UI.vprint(2,"Download task failed:",e)
+                    success=0
+                if progress:
+                    progress['done']+=1
+                    UI.progress_bar(progress['bar'],int(100*progress['done']/(progress['done']+len(pending))))
+            if UI.red_flag:
+                for future in pending: future.cancel()
+                return 0
+        if progress: UI.progress_bar(progress['bar'],100)
+        return success
+###############################################################################################################################
+
+###############################################################################################################################
+def download_engine(provider):
+    with download_engines_lock:
+        if provider['code'] not in download_engines:
+            download_engines[provider['code']]=DownloadEngine(provider)
+        return download_engines[provider['code']]
+###############################################################################################################################
+
+###############################################################################################################################
+def http_request_to_raw_image(url,request_headers,http_session):
+    # returns the undecoded image data as received
     UI.vprint(3,"HTTP request issued :",url,"\nRequest headers :",request_headers)
     tentative_request=0
     tentative_image=0
@@ -638,8 +765,8 @@ def http_request_to_image(width,height,url,request_headers,http_session):
                     return (0,'[404]')
             if ('[200]' in status_code) and ('image' in r.headers['Content-Type']):
                 try:
-                    small_image=Image.open(io.BytesIO(r.content))
-                    return (1,small_image)
+                    Image.open(io.BytesIO(r.content))
+                    return (1,r.content)
                 except:
                     UI.vprint(2,"Server said 'OK', but the received image was corrupted.")
                     UI.vprint(3,url,r.headers)
@@ -672,8 +799,7 @@ def http_request_to_image(width,height,url,request_headers,http_session):
             UI.vprint(3,e)
             if not check_tms_response:
                 break
-            # trying a new session ? 
-            http_session=requests.Session()
+            # the broken connection is dropped by the pool, the session is kept 
             time.sleep(2)
             if UI.red_flag: return (0,'Stopped')
             tentative_request+=1
@@ -682,6 +808,95 @@ def http_request_to_image(width,height,url,request_headers,http_session):
     return (0,status_code)
 ###############################################################################################################################
 
+###############################################################################################################################
+def http_request_to_image(width,height,url,request_headers,http_session):
+    (success,data)=http_request_to_raw_image(url,request_headers,http_session)
+    if success:
+        return (1,Image.open(io.BytesIO(data)))
+    return (0,data)
+###############################################################################################################################
+
+###############################################################################################################################
+# On-disk cache of the raw provider tiles, independent of the textures they were used for. The
+# modification time of a file is refreshed when it is read, and the least recently used ones
+# are removed when the cache exceeds raw_tile_cache_size. Tiles are filed under a hash of the 
+# provider definition, so that a changed url or layer does not serve the former tiles.  
+raw_tile_cache_lock=threading.Lock()
+raw_tile_cache_used=None  # bytes, known after the first write
+
+def provider_cache_key(provider):
+    if 'cache_key' not in provider:
+        items=[str(provider.get(key)) for key in ('request_type','url_template','url_prefix','layers','image_type','tile_size')]
+        if isinstance(provider.get('tilematrixset'),dict): items.append(provider['tilematrixset']['identifier'])
+        if has_URL and provider['code'] in URL.custom_url_list:
+            # urls are built by code
+            try:
+                with open(URL.__file__,'r') as f:
+                    items.append(f.read())
+            except:
+                pass
+        provider['cache_key']=hashlib.sha1('\n'.join(items).encode('utf-8')).hexdigest()[:8]
+    return provider['cache_key']
+
+def read_raw_tile(provider,tilematrix,til_x,til_y):
+    if not raw_tile_cache_size: return None
+    file_name=FNAMES.raw_tile_file(provider['code'],provider_cache_key(provider),tilematrix,til_x,til_y)
+    try:
+        with open(file_name,'rb') as f:
+            data=f.read()
+        os.utime(file_name)
+        return data
+    except:
+        return None
+
+def write_raw_tile(provider,tilematrix,til_x,til_y,data):
+    global raw_tile_cache_used
+    if not raw_tile_cache_size: return
+    file_name=FNAMES.raw_tile_file(provider['code'],provider_cache_key(provider),tilematrix,til_x,til_y)
+    try:
+        os.makedirs(os.path.dirname(file_name),exist_ok=True)
+        tmp_file_name=file_name+'.'+str(threading.get_ident())+'.tmp'
+        with open(tmp_file_name,'wb') as f:
+            f.write(data)
+        os.replace(tmp_file_name,file_name)
+    except Exception as e:
+        UI.vprint(2,"Could not write",file_name,"to the tile cache:",e)
+        return
+    with raw_tile_cache_lock:
+        if raw_tile_cache_used is None:
+            raw_tile_cache_used=sum(size for (_,size,_) in raw_tile_cache_content())
+        else:
+            raw_tile_cache_used+=len(data)
+        if raw_tile_cache_used>raw_tile_cache_size*2**20:
+            evict_raw_tiles()
+
+def raw_tile_cache_content():
+    content=[]
+    for (dir_name,_,file_names) in os.walk(FNAMES.Raw_tile_dir):
+        for file_name in file_names:
+            if file_name[-4:]=='.tmp': continue
+            try:
+                stat=os.stat(os.path.join(dir_name,file_name))
+                content.append((stat.st_mtime,stat.st_size,os.path.join(dir_name,file_name)))
+            except:
+                pass
+    return content
+
+def evict_raw_tiles():
+    # to be called with raw_tile_cache_lock held, we go down to 90% of the limit  
+    global raw_tile_cache_used
+    content=sorted(raw_tile_cache_content())
+    raw_tile_cache_used=sum(size for (_,size,_) in content)
+    for (_,size,file_name) in content:
+        if raw_tile_cache_used<=0.9*raw_tile_cache_size*2**20: break
+        try: 
+            os.remove(file_name)
+            raw_tile_cache_used-=size
+        except:
+            pass
+    UI.vprint(2,"Tile cache trimmed to",round(raw_tile_cache_used/2**20,1),"MB.")
+###############################################################################################################################
+
 ###############################################################################################################################
 def get_wms_image(bbox,width,height,provider,http_session):
     request_headers=None 
@@ -753,7 +968,16 @@ def get_wmts_image(tilematrix,til_x,til_y,provider,http_session):
         else:
             request_headers=request_headers_generic
     width=height=provider['tile_size'] 
-    (success,data)=http_request_to_image(width,height,url,request_headers,http_session)
+    (success,data)=(0,None)
+    raw_data=read_raw_tile(provider,tilematrix,til_x,til_y)
+    if raw_data:
+        try: (success,data)=(1,Image.open(io.BytesIO(raw_data)))
+        except: UI.vprint(2,"Corrupted tile in the cache, downloading it again.")
+    if not success:
+        (success,data)=http_request_to_raw_image(url,request_headers,http_session)
+        if success:
+            write_raw_tile(provider,tilematrix,til_x,til_y,data)
+            data=Image.open(io.BytesIO(data))
     if success and not down_sample: 
         return (success,data) 
     elif success and down_sample:
@@ -800,22 +1024,17 @@ def build_texture_from_tilbox(tilbox,zoomlevel,provider,progress=None):
     parts_y=til_y_max-til_y_min
     width=height=provider['tile_size']
     big_image=Image.new('RGB',(width*parts_x,height*parts_y)) 
-    # we set-up the queue of downloads
-    http_session=requests.Session() 
-    download_queue=queue.Queue()
+    # we set-up the list of downloads
+    engine=download_engine(provider)
+    download_list=[]
     for monty in range(0,parts_y):
         for montx in range(0,parts_x):
             x0=montx*width
             y0=monty*height
-            fargs=(zoomlevel,til_x_min+montx,til_y_min+monty,provider,big_image,x0,y0,http_session)
-            download_queue.put(fargs)
-    # then the number of workers
-    if 'max_threads' in provider: 
-        max_threads=int(provider['max_threads'])
-    else:
-        max_threads=16
-    # and finally activate them
-    success=parallel_execute(get_and_paste_wmts_part,download_queue,max_threads,progress)
+            fargs=(zoomlevel,til_x_min+montx,til_y_min+monty,provider,big_image,x0,y0,engine.http_session)
+            download_list.append(fargs)
+    # and hand it to the provider download engine
+    success=engine.execute(get_and_paste_wmts_part,download_list,progress)
     # once out big_image has been filled and we return it
     return (success,big_image)
 ###############################################################################################################################
@@ -886,8 +1105,8 @@ def build_texture_from_bbox_and_size(t_bbox,t_epsg,t_size,provider):
         else:
             subt_size=None
     big_image=Image.new('RGB',(width*parts_x,height*parts_y)) 
-    http_session=requests.Session()
-    download_queue=queue.Queue()
+    engine=download_engine(provider)
+    download_list=[]
     for monty in range(0,parts_y):
         for montx in range(0,parts_x):
             x0=montx*width
@@ -898,19 +1117,15 @@ def build_texture_from_bbox_and_size(t_bbox,t_epsg,t_size,provider):
                 p_lrx=p_ulx+x_range/parts_x
                 p_lry=p_uly-y_range/parts_y
                 p_bbox=[p_ulx,p_uly,p_lrx,p_lry]
-                fargs=[p_bbox[:],width,height,provider,big_image,x0,y0,http_session]
+                fargs=[p_bbox[:],width,height,provider,big_image,x0,y0,engine.http_session]
             elif provider['request_type'] in ['wmts','tms','local_tms']:
-                fargs=[wmts_tilematrix,til_x_min+montx,til_y_min+monty,provider,big_image,x0,y0,http_session,subt_size]
-            download_queue.put(fargs)
+                fargs=[wmts_tilematrix,til_x_min+montx,til_y_min+monty,provider,big_image,x0,y0,engine.http_session,subt_size]
+            download_list.append(fargs)
     # We execute the downloads and subimage pastes
-    if 'max_threads' in provider: 
-        max_threads=int(provider['max_threads'])
-    else:
-        max_threads=16
     if provider['request_type']=='wms':
-        success=parallel_execute(get_and_paste_wms_part,download_queue,max_threads)
+        success=engine.execute(get_and_paste_wms_part,download_list)
     elif provider['request_type'] in ['wmts','tms','local_tms']:
-        success=parallel_execute(get_and_paste_wmts_part,download_queue,max_threads)
+        success=engine.execute(get_and_paste_wmts_part,download_list)
     # We modify big_image if necessary
     if warp_needed:
         UI.vprint(3,"Warp needed")
@@ -1199,7 +1414,6 @@ def gdalwarp_alternative(s_bbox,s_epsg,s_im,t_bbox,t_epsg,t_size):
         (s_w,s_h)=s_im.size
         (t_w,t_h)=t_size
         t_quad = (0, 0, t_w, t_h)
-        meshes = []
         def cut_quad_into_grid(quad, steps):
             w = quad[2]-quad[0]
             h = quad[3]-quad[1]
@@ -1212,50 +1426,102 @@ def gdalwarp_alternative(s_bbox,s_epsg,s_im,t_bbox,t_epsg,t_size):
                     yield (int(x), int(y), int(x+x_step), int(y+y_step))
                     x += x_step
                 y += y_step
-        for quad in cut_quad_into_grid(t_quad,8):
-            s_quad=[]
-            for (t_pixx,t_pixy) in [(quad[0],quad[1]),(quad[0],quad[3]),(quad[2],quad[3]),(quad[2],quad[1])]:
-                t_x=t_ulx+t_pixx/t_w*(t_lrx-t_ulx)
-                t_y=t_uly-t_pixy/t_h*(t_uly-t_lry)
-                (s_x,s_y)=GEO.transform(t_epsg,s_epsg,t_x,t_y)
-                s_pixx=int(round((s_x-s_ulx)/(s_lrx-s_ulx)*s_w))    
-                s_pixy=int(round((s_uly-s_y)/(s_uly-s_lry)*s_h))
-                s_quad.extend((s_pixx,s_pixy))
-            meshes.append((quad,s_quad))    
+        quads=list(cut_quad_into_grid(t_quad,8))
+        # the corners of all quads are projected in a single call
+        t_pix=numpy.array([corner for quad in quads for corner in ((quad[0],quad[1]),(quad[0],quad[3]),(quad[2],quad[3]),(quad[2],quad[1]))],dtype=numpy.float64)
+        t_x=t_ulx+t_pix[:,0]/t_w*(t_lrx-t_ulx)
+        t_y=t_uly-t_pix[:,1]/t_h*(t_uly-t_lry)
+        (s_x,s_y)=GEO.transform(t_epsg,s_epsg,t_x,t_y)
+        s_pixx=numpy.rint((s_x-s_ulx)/(s_lrx-s_ulx)*s_w).astype(numpy.int64)
+        s_pixy=numpy.rint((s_uly-s_y)/(s_uly-s_lry)*s_h).astype(numpy.int64)
+        s_quads=numpy.column_stack((s_pixx,s_pixy)).reshape((-1,8)).tolist()
+        meshes=list(zip(quads,s_quads))
         return s_im.transform(t_size,Image.MESH,meshes,Image.BICUBIC)
 ###############################################################################################################################
 
+###############################################################################################################################
+def apply_color_filter(im,color_filter):
+    if color_filter[0]=='brightness-contrast': #both range from -127 to 127, http://gimp.sourcearchive.com/documentation/2.6.1/gimpbrightnesscontrastconfig_8c-source.html
+        (brightness,contrast)=color_filter[1:3]
+        if brightness>=0:  
+            im=im.point(lambda i: 128+tan(pi/4*(1+contrast/128))*(brightness+(255-brightness)/255*i-128))
+        else:
+            im=im.point(lambda i: 128+tan(pi/4*(1+contrast/128))*((255+brightness)/255*i-128))
+    elif color_filter[0]=='saturation':  
+        saturation=color_filter[1]   
+        im=ImageEnhance.Color(im).enhance(1+saturation/100)
+    elif color_filter[0]=='sharpness':
+        im=ImageEnhance.Sharpness(im).enhance(color_filter[1])
+    elif color_filter[0]=='blur':
+        im=im.filter(ImageFilter.GaussianBlur(color_filter[1]))
+    elif color_filter[0]=='levels': # levels range between 0 and 255, gamma is neutral at 1 / https://pippin.gimp.org/image-processing/chap_point.html
+        bands=im.split()
+        for j in [0,1,2]:
+            in_min,gamma,in_max,out_min,out_max=color_filter[5*j+1:5*j+6]
+            bands[j].paste(bands[j].point(lambda i: out_min+(out_max-out_min)*((max(in_min,min(i,in_max))-in_min)/(in_max-in_min))**(1/gamma)))
+        im=Image.merge(im.mode,bands)
+    return im
+###############################################################################################################################
+
+###############################################################################################################################
+def compile_color_filters(color_code,mode):
+    # Consecutive point-wise filters are folded into a single lookup table per band, obtained
+    # by applying them to an image made of the 256 possible values of each band. 
+    steps=[]
+    lut_im=None
+    for color_filter in color_filters_dict[color_code]:
+        if color_filter[0] in pointwise_color_filters:
+            if lut_im is None:
+                lut_im=Image.merge(mode,[Image.frombytes('L',(256,1),bytes(range(256)))]*len(Image.new(mode,(1,1)).getbands()))
+            lut_im=apply_color_filter(lut_im,color_filter)
+        else:
+            if lut_im is not None:
+                steps.append(['lut',list(b''.join(band.tobytes() for band in lut_im.split()))])
+                lut_im=None
+            steps.append(color_filter)
+    if lut_im is not None:
+        steps.append(['lut',list(b''.join(band.tobytes() for band in lut_im.split()))])
+    return steps
+###############################################################################################################################
+
 ###############################################################################################################################
 def color_transform(im,color_code):
     try:
-        for color_filter in color_filters_dict[color_code]:
-            if color_filter[0]=='brightness-contrast': #both range from -127 to 127, http://gimp.sourcearchive.com/documentation/2.6.1/gimpbrightnesscontrastconfig_8c-source.html
-                (brightness,contrast)=color_filter[1:3]
-                if brightness>=0:  
-                    im=im.point(lambda i: 128+tan(pi/4*(1+contrast/128))*(brightness+(255-brightness)/255*i-128))
-                else:
-                    im=im.point(lambda i: 128+tan(pi/4*(1+contrast/128))*((255+brightness)/255*i-128))
-            elif color_filter[0]=='saturation':  
-                saturation=color_filter[1]   
-                im=ImageEnhance.Color(im).enhance(1+saturation/100)
-            elif color_filter[0]=='sharpness':
-                im=ImageEnhance.Sharpness(im).enhance(color_filter[1])
-            elif color_filter[0]=='blur':
-                im=im.filter(ImageFilter.GaussianBlur(color_filter[1]))
-            elif color_filter[0]=='levels': # levels range between 0 and 255, gamma is neutral at 1 / https://pippin.gimp.org/image-processing/chap_point.html
-                bands=im.split()
-                for j in [0,1,2]:
-                    in_min,gamma,in_max,out_min,out_max=color_filter[5*j+1:5*j+6]
-                    bands[j].paste(bands[j].point(lambda i: out_min+(out_max-out_min)*((max(in_min,min(i,in_max))-in_min)/(in_max-in_min))**(1/gamma)))
-                im=Image.merge(im.mode,bands)
+        if (color_code,im.mode) not in compiled_color_filters_dict:
+            compiled_color_filters_dict[(color_code,im.mode)]=compile_color_filters(color_code,im.mode)
+        for step in compiled_color_filters_dict[(color_code,im.mode)]:
+            if step[0]=='lut':
+                im=im.point(step[1])
+            else:
+                im=apply_color_filter(im,step)
         return im
     except:
         return im
 ###############################################################################################################################
 
+###############################################################################################################################
+def composite_in_place(canvas,layer,mask,strip_rows=256):
+    # canvas=Image.composite(layer,canvas,mask) with the integer arithmetic of PIL, canvas being
+    # a uint16 array (values within 0..255, the products of the blend fit within 16 bits), layer 
+    # a uint8 array with the same number of bands and mask a uint8 or uint16 one. Rows are 
+    # processed by strips to keep temporaries small.
+    for row in range(0,canvas.shape[0],strip_rows):
+        out=canvas[row:row+strip_rows]
+        # the blend is exactly the identity for a zero mask, and the copy for a full one
+        if not mask[row:row+strip_rows].any(): continue
+        if mask[row:row+strip_rows].min()==255:
+            out[...]=layer[row:row+strip_rows]
+            continue
+        weight=mask[row:row+strip_rows,:,None].astype(numpy.uint16)
+        out*=255-weight
+        out+=layer[row:row+strip_rows]*weight
+        out+=128
+        out+=out>>8
+        out>>=8
+###############################################################################################################################
+
 ###############################################################################################################################
 def combine_textures(tile,til_x_left,til_y_top,zoomlevel,provider_code):
-    big_image=Image.new('RGBA',(4096,4096))
     (y0,x0)=GEO.gtile_to_wgs84(til_x_left,til_y_top,zoomlevel)
     (y1,x1)=GEO.gtile_to_wgs84(til_x_left+16,til_y_top+16,zoomlevel)
     mask_weight_below=numpy.zeros((4096,4096),dtype=numpy.uint16)
@@ -1289,6 +1555,11 @@ def combine_textures(tile,til_x_left,til_y_top,zoomlevel,provider_code):
         UI.vprint(2,"Finished imprinting",til_x_left,til_y_top)
         return true_im
     # the real situation now where there are more than one layer with data
+    # Layers are blended one after the other into a single preallocated canvas, in place.
+    # Peak memory stays at about 350MB whatever the number of layers : the uint16 canvas 
+    # (128MB), the current layer both as decoded image and RGBA array (112MB) and three
+    # 4096x4096 uint16 arrays for the masks (96MB). 
+    canvas=numpy.zeros((4096,4096,4),dtype=numpy.uint16)
     for rlayer in local_combined_providers_dict[provider_code][::-1]:
         mask=has_data((x0,y0,x1,y1),rlayer['extent_code'],return_mask=True,is_mask_layer=(tile.lat,tile.lon, tile.mask_zl) if rlayer['priority']=='mask' else False)
         if not mask: continue
@@ -1322,25 +1593,27 @@ def combine_textures(tile,til_x_left,til_y_top,zoomlevel,provider_code):
         # in case the smoothing of the extent mask was too strong we remove the
         # the mask (where it is nor 0 nor 255) the pixels for which the true_im
         # is all white or all black
-        true_arr=numpy.array(true_im).astype(numpy.uint16)
-        mask[(numpy.sum(true_arr,axis=2)>=735)*(mask>=1)*(mask<=253)]=0
-        mask[(numpy.sum(true_arr,axis=2)<=35)*(mask>=1)*(mask<=253)]=0
+        true_arr=numpy.asarray(true_im)
+        true_sum=true_arr[:,:,0].astype(numpy.uint16)
+        for band in range(1,true_arr.shape[2]): true_sum+=true_arr[:,:,band]
+        del true_arr
+        mask[((true_sum>=735) | (true_sum<=35)) & (mask>=1) & (mask<=253)]=0
+        del true_sum
         if rlayer['priority']=='low':
             # low priority layers, do not increase mask_weight_below
-            wasnt_zero=(mask_weight_below+mask)!=0
-            mask[wasnt_zero]=255*mask[wasnt_zero]/(mask_weight_below+mask)[wasnt_zero]
+            weight=mask_weight_below+mask
+            numpy.floor_divide(255*mask,weight,out=mask,where=weight!=0)
+            del weight
         elif rlayer['priority'] in ['high','mask']:
             mask_weight_below+=mask
         elif rlayer['priority']=='medium':
-            not_zero=mask!=0
             mask_weight_below+=mask
-            mask[not_zero]=255*mask[not_zero]/mask_weight_below[not_zero]
+            numpy.floor_divide(255*mask,mask_weight_below,out=mask,where=mask!=0)
             # undecided about the next two lines
             # was_zero=mask_weight_below==0
             # mask[was_zero]=255 
-        # we turn back the array mask into an image
-        mask=Image.fromarray(mask.astype(numpy.uint8))
-        big_image=Image.composite(true_im,big_image,mask)
+        composite_in_place(canvas,numpy.asarray(true_im.convert('RGBA')),mask)
+    big_image=Image.fromarray(canvas.astype(numpy.uint8),'RGBA')
     UI.vprint(2,"Finished imprinting",til_x_left,til_y_top)
     return big_image
 ###############################################################################################################################
@@ -1349,16 +1622,19 @@ def combine_textures(tile,til_x_left,til_y_top,zoomlevel,provider_code):
 def convert_texture(tile,til_x_left,til_y_top,zoomlevel,provider_code,type='dds'):
     if type=='dds':
         out_file_name=FNAMES.dds_file_name_from_attributes(til_x_left,til_y_top,zoomlevel,provider_code)
-        png_file_name=out_file_name.replace('dds','png')
+        # uncompressed intermediate files for the external tools, no need to spend time in PNG compression 
+        raw_file_name=out_file_name.replace('.dds','.tga')
     elif type=='tif':
         out_file_name=FNAMES.geotiff_file_name_from_attributes(til_x_left,til_y_top,zoomlevel,provider_code)
         if os.path.exists(os.path.join(FNAMES.Geotiff_dir,out_file_name)):
             try: os.remove(os.path.join(FNAMES.Geotiff_dir,out_file_name))
             except: pass
-        png_file_name=out_file_name.replace('tif','png')
+        raw_file_name=out_file_name.replace('.tif','-raw.tif')
         tmp_tif_file_name = os.path.join(UI.Ortho4XP_dir,'tmp',out_file_name.replace('4326','3857'))
     UI.vprint(1,"   Converting orthophoto(s) to build texture "+out_file_name+".")
-    erase_tmp_png=False
+    # the in-process encoder directly takes the image in memory
+    in_memory=(type=='dds' and dds_encoder=='numpy')
+    erase_tmp_raw=False
     erase_tmp_tif=False
     dxt5=False
     masked_texture=False
@@ -1394,9 +1670,10 @@ def convert_texture(tile,til_x_left,til_y_top,zoomlevel,provider_code,type='dds'
                 try: os.remove(os.path.join(tile.build_dir,"textures",FNAMES.mask_file(til_x_left,til_y_top,zoomlevel,provider_code))) 
                 except: pass
             dxt5=True
-        file_to_convert=os.path.join(UI.Ortho4XP_dir,'tmp',png_file_name)
-        erase_tmp_png=True
-        big_image.save(file_to_convert) 
+        if not in_memory:
+            file_to_convert=os.path.join(UI.Ortho4XP_dir,'tmp',raw_file_name)
+            erase_tmp_raw=True
+            big_image.save(file_to_convert) 
         # If one wanted to distribute jpegs instead of dds, uncomment the next line
         # big_image.convert('RGB').save(os.path.join(tile.build_dir,'textures',out_file_name.replace('dds','jpg')),quality=70)
     # now if provider_code was not in local_combined_providers_dict but color correction is required
@@ -1411,13 +1688,21 @@ def convert_texture(tile,til_x_left,til_y_top,zoomlevel,provider_code,type='dds'
                 try: os.remove(os.path.join(tile.build_dir,"textures",FNAMES.mask_file(til_x_left,til_y_top,zoomlevel,provider_code))) 
                 except: pass
             dxt5=True
-        file_to_convert=os.path.join(UI.Ortho4XP_dir,'tmp',png_file_name)
-        erase_tmp_png=True
-        big_image.save(file_to_convert) 
+        if not in_memory:
+            file_to_convert=os.path.join(UI.Ortho4XP_dir,'tmp',raw_file_name)
+            erase_tmp_raw=True
+            big_image.save(file_to_convert) 
     # finally if nothing needs to be done prior to the conversion
     else:
         file_to_convert=os.path.join(file_dir,jpeg_file_name)
+        if in_memory: big_image=Image.open(file_to_convert)
     # eventually the dds conversion
+    if in_memory:
+        try:
+            DDS.write_dds(big_image,os.path.join(tile.build_dir,'textures',out_file_name),dxt5)
+        except Exception as e:
+            UI.lvprint(1,"ERROR: Could not convert texture",os.path.join(tile.build_dir,'textures',out_file_name),e)
+        return
     if type=='dds':
         if not dxt5:
             conv_cmd=[dds_convert_cmd,'-bc1','-fast',file_to_convert,os.path.join(tile.build_dir,'textures',out_file_name),devnull_rdir]
@@ -1435,7 +1720,7 @@ def convert_texture(tile,til_x_left,til_y_top,zoomlevel,provider_code,type='dds'
             erase_tmp_tif=True
             if subprocess.call(geotag_cmd,stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT):
                 UI.vprint(1,"ERROR: Could not geotag texture (gdal not present ?) ",os.path.join(tile.build_dir,'textures',out_file_name))
-                try: os.remove(os.path.join(UI.Ortho4XP_dir,'tmp',png_file_name))
+                try: os.remove(os.path.join(UI.Ortho4XP_dir,'tmp',raw_file_name))
                 except: pass  
                 return
             conv_cmd=[gdalwarp_cmd,'-of','Gtiff','-co','COMPRESS=JPEG','-s_srs','epsg:3857','-t_srs','epsg:4326','-ts','4096','4096','-rb',tmp_tif_file_name,os.path.join(FNAMES.Geotiff_dir,out_file_name)] 
@@ -1449,11 +1734,11 @@ def convert_texture(tile,til_x_left,til_y_top,zoomlevel,provider_code,type='dds'
             break
         UI.lvprint(1,"WARNING: Could not convert texture",os.path.join(tile.build_dir,'textures',out_file_name))
         time.sleep(1)
-    if erase_tmp_png:
-        try: os.remove(os.path.join(UI.Ortho4XP_dir,'tmp',png_file_name))
+    if erase_tmp_raw:
+        try: os.remove(os.path.join(UI.Ortho4XP_dir,'tmp',raw_file_name))
         except: pass
     if erase_tmp_tif:
-        try: os.remove(os.path.join(UI.Ortho4XP_dir,'tmp',png_file_name))
+        try: os.remove(tmp_tif_file_name)
         except: pass
     return 
 ###############################################################################################################################
@@ -13,6 +13,8 @@ import O4_Imagery_Utils as IMG
 import O4_OSM_Utils as OSM
 import O4_Vector_Utils as VECT
 import O4_Mesh_Utils as MESH
+import O4_Mesh_IO as MESHIO
+import O4_Blur_Utils as BLUR
 from O4_Parallel_Utils import parallel_execute
 
 mask_altitude_above=0.5
@@ -40,6 +42,27 @@ def needs_mask(tile, til_x_left,til_y_top,zoomlevel,*args):
         return small_img
 ##############################################################################
 
+##############################################################################
+def tris_mask_cells(vertices,tris,mask_zl):
+    # (lat1,lon1,lat2,lon2,lat3,lon3) of each triangle, the mask cell of its
+    # barycenter, and the position (0..3) of the barycenter within that cell
+    lonlat=vertices[tris,:2]
+    bary_lon=(lonlat[:,0,0]+lonlat[:,1,0]+lonlat[:,2,0])/3
+    bary_lat=(lonlat[:,0,1]+lonlat[:,1,1]+lonlat[:,2,1])/3
+    (til_x,til_y)=GEO.wgs84_to_orthogrid_vec(bary_lat,bary_lon,mask_zl)
+    (til_x2,til_y2)=GEO.wgs84_to_orthogrid_vec(bary_lat,bary_lon,mask_zl+2)
+    tri_coords=[tuple(tri) for tri in lonlat[:,:,::-1].reshape((-1,6)).tolist()]
+    return (tri_coords,til_x.tolist(),til_y.tolist(),((til_x2//16)%4).tolist(),((til_y2//16)%4).tolist())
+##############################################################################
+
+##############################################################################
+def tris_to_mask_pix(tri_coords,mask_zl,px0,py0):
+    # triangles as lists of three pixel positions relative to (px0,py0)
+    tri_coords=numpy.array(tri_coords).reshape((-1,6))
+    (px,py)=GEO.wgs84_to_pix_vec(tri_coords[:,0::2],tri_coords[:,1::2],mask_zl)
+    return numpy.stack((px-px0,py-py0),axis=2).tolist()
+##############################################################################
+
 ##############################################################################
 def build_masks(tile,for_imagery=False):
     if UI.is_working: return 0
@@ -90,27 +113,21 @@ def build_masks(tile,for_imagery=False):
     UI.vprint(1,"-> Reading mesh data")
     for mesh_file_name in mesh_file_name_list:
         try:
-            f_mesh=open(mesh_file_name,"r")
+            # the tile own mesh is kept in memory for Step 3
+            mesh=MESHIO.read_mesh_file(mesh_file_name,keep=(mesh_file_name==FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon)))
             UI.vprint(1,"   * ",mesh_file_name)
         except:
             UI.lvprint(1,"Mesh file ",mesh_file_name," could not be read. Skipped.")
             continue
-        mesh_version=float(f_mesh.readline().strip().split()[-1])
-        has_water = 7 if mesh_version>=1.3 else 3
-        for i in range(3):
-            f_mesh.readline()
-        nbr_pt_in=int(f_mesh.readline())
-        pt_in=numpy.zeros(5*nbr_pt_in,'float')
-        for i in range(0,nbr_pt_in):
-            pt_in[5*i:5*i+3]=[float(x) for x in f_mesh.readline().split()[:3]]
-        for i in range(0,3):
-            f_mesh.readline()
-        for i in range(0,nbr_pt_in):
-            pt_in[5*i+3:5*i+5]=[float(x) for x in f_mesh.readline().split()[:2]]
-        for i in range(0,2): # skip 2 lines
-            f_mesh.readline()
-        nbr_tri_in=int(f_mesh.readline()) # read nbr of tris
-        step_stones=nbr_tri_in//100
+        has_water = 7 if mesh.mesh_version>=1.3 else 3
+        water_types=mesh.tri_types & has_water
+        if tile.use_masks_for_inland:
+            sea_tris=mesh.tris[water_types>0]
+        else:
+            sea_tris=mesh.tris[water_types>=2]
+        (tri_coords,tri_til_x,tri_til_y,tri_a,tri_b)=tris_mask_cells(mesh.vertices,sea_tris,tile.mask_zl)
+        nbr_tri_in=len(sea_tris)
+        step_stones=nbr_tri_in//100+1
         percent=-1
         UI.vprint(2," Attribution process of masks buffers to water triangles for "+str(mesh_file_name)+".")
         for i in range(0,nbr_tri_in):
@@ -118,104 +135,78 @@ def build_masks(tile,for_imagery=False):
                 percent+=1
                 UI.progress_bar(1, int(percent*5/10))
                 if UI.red_flag: UI.exit_message_and_bottom_line(); return 0
-            (n1,n2,n3,tri_type)=[int(x)-1 for x in f_mesh.readline().split()[:4]]
-            tri_type+=1
-            if (not tri_type) or (not (tri_type & has_water)) or ((tri_type & has_water)<2 and not tile.use_masks_for_inland):
-                continue
-            (lon1,lat1)=pt_in[5*n1:5*n1+2]
-            (lon2,lat2)=pt_in[5*n2:5*n2+2]
-            (lon3,lat3)=pt_in[5*n3:5*n3+2]
-            bary_lat=(lat1+lat2+lat3)/3
-            bary_lon=(lon1+lon2+lon3)/3
-            (til_x,til_y)=GEO.wgs84_to_orthogrid(bary_lat,bary_lon,tile.mask_zl)
+            (til_x,til_y)=(tri_til_x[i],tri_til_y[i])
             if til_x < til_x_min-16 or til_x > til_x_max+16 or til_y < til_y_min-16 or til_y>til_y_max+16:
                 continue
-            (til_x2,til_y2)=GEO.wgs84_to_orthogrid(bary_lat,bary_lon,tile.mask_zl+2)
-            a=(til_x2//16)%4
-            b=(til_y2//16)%4
+            (a,b)=(tri_a[i],tri_b[i])
+            tri=tri_coords[i]
             if (til_x,til_y) in dico_masks:
-                dico_masks[(til_x,til_y)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                dico_masks[(til_x,til_y)].append(tri)
             else:
-                dico_masks[(til_x,til_y)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
+                dico_masks[(til_x,til_y)]=[tri]
             if a==0: 
                 if (til_x-16,til_y) in dico_masks:
-                    dico_masks[(til_x-16,til_y)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                    dico_masks[(til_x-16,til_y)].append(tri)
                 else:
-                    dico_masks[(til_x-16,til_y)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
+                    dico_masks[(til_x-16,til_y)]=[tri]
                 if b==0: 
                     if (til_x-16,til_y-16) in dico_masks:
-                        dico_masks[(til_x-16,til_y-16)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                        dico_masks[(til_x-16,til_y-16)].append(tri)
                     else:
-                        dico_masks[(til_x-16,til_y-16)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
+                        dico_masks[(til_x-16,til_y-16)]=[tri]
                 elif b==3:
                     if (til_x-16,til_y+16) in dico_masks:
-                        dico_masks[(til_x-16,til_y+16)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                        dico_masks[(til_x-16,til_y+16)].append(tri)
                     else:
-                        dico_masks[(til_x-16,til_y+16)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
+                        dico_masks[(til_x-16,til_y+16)]=[tri]
             elif a==3:
                 if (til_x+16,til_y) in dico_masks:
-                    dico_masks[(til_x+16,til_y)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                    dico_masks[(til_x+16,til_y)].append(tri)
                 else:
-                    dico_masks[(til_x+16,til_y)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
+                    dico_masks[(til_x+16,til_y)]=[tri]
                 if b==0: 
                     if (til_x+16,til_y-16) in dico_masks:
-                        dico_masks[(til_x+16,til_y-16)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                        dico_masks[(til_x+16,til_y-16)].append(tri)
                     else:
-                        dico_masks[(til_x+16,til_y-16)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
+                        dico_masks[(til_x+16,til_y-16)]=[tri]
                 elif b==3:
                     if (til_x+16,til_y+16) in dico_masks:
-                        dico_masks[(til_x+16,til_y+16)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                        dico_masks[(til_x+16,til_y+16)].append(tri)
                     else:
-                        dico_masks[(til_x+16,til_y+16)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
+                        dico_masks[(til_x+16,til_y+16)]=[tri]
             if b==0: 
                 if (til_x,til_y-16) in dico_masks:
-                    dico_masks[(til_x,til_y-16)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                    dico_masks[(til_x,til_y-16)].append(tri)
                 else:
-                    dico_masks[(til_x,til_y-16)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
+                    dico_masks[(til_x,til_y-16)]=[tri]
             elif b==3:
                 if (til_x,til_y+16) in dico_masks:
-                    dico_masks[(til_x,til_y+16)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                    dico_masks[(til_x,til_y+16)].append(tri)
                 else:
-                    dico_masks[(til_x,til_y+16)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
-        f_mesh.close()
+                    dico_masks[(til_x,til_y+16)]=[tri]
         if not tile.use_masks_for_inland:
             UI.vprint(2,"   Taking care of inland water near shoreline")
-            f_mesh=open(mesh_file_name,"r")
-            for i in range(0,4):
-                f_mesh.readline()
-            nbr_pt_in=int(f_mesh.readline())
-            for i in range(0,2*nbr_pt_in+5):
-                f_mesh.readline()
-            nbr_tri_in=int(f_mesh.readline()) # read nbr of tris
-            step_stones=nbr_tri_in//100
+            inland_tris=mesh.tris[water_types==1]
+            (tri_coords,tri_til_x,tri_til_y,tri_a,tri_b)=tris_mask_cells(mesh.vertices,inland_tris,tile.mask_zl)
+            nbr_tri_in=len(inland_tris)
+            step_stones=nbr_tri_in//100+1
             percent=-1
             for i in range(0,nbr_tri_in):
                 if i%step_stones==0:
                     percent+=1
                     UI.progress_bar(1, int(percent*5/10))
                     if UI.red_flag: UI.exit_message_and_bottom_line(); return 0
-                (n1,n2,n3,tri_type)=[int(x)-1 for x in f_mesh.readline().split()[:4]]
-                tri_type+=1
-                if not (tri_type & has_water)==1:
-                    continue
-                (lon1,lat1)=pt_in[5*n1:5*n1+2]
-                (lon2,lat2)=pt_in[5*n2:5*n2+2]
-                (lon3,lat3)=pt_in[5*n3:5*n3+2]
-                bary_lat=(lat1+lat2+lat3)/3
-                bary_lon=(lon1+lon2+lon3)/3
-                (til_x,til_y)=GEO.wgs84_to_orthogrid(bary_lat,bary_lon,tile.mask_zl)
+                (til_x,til_y)=(tri_til_x[i],tri_til_y[i])
                 if til_x < til_x_min-16 or til_x > til_x_max+16 or til_y < til_y_min-16 or til_y>til_y_max+16:
                     continue
-                (til_x2,til_y2)=GEO.wgs84_to_orthogrid(bary_lat,bary_lon,tile.mask_zl+2)
-                a=(til_x2//16)%4
-                b=(til_y2//16)%4
+                tri=tri_coords[i]
                 # Here an inland water tri is added ONLY if sea water tri were already added for this mask extent
                 if (til_x,til_y) in dico_masks:
                     if (til_x,til_y) in dico_masks_inland:
-                        dico_masks_inland[(til_x,til_y)].append((lat1,lon1,lat2,lon2,lat3,lon3))
+                        dico_masks_inland[(til_x,til_y)].append(tri)
                     else:
-                        dico_masks_inland[(til_x,til_y)]=[(lat1,lon1,lat2,lon2,lat3,lon3)]
-            f_mesh.close()
+                        dico_masks_inland[(til_x,til_y)]=[tri]
+        del mesh
     UI.vprint(1,"-> Construction of the masks")
     if tile.masks_use_DEM_too:
         try:
@@ -252,19 +243,11 @@ def build_masks(tile,for_imagery=False):
             mask_draw.polygon([(px1,py1),(px2,py2),(px3,py3),(px4,py4)],fill='white')
         # 3a)  We overwrite the white part of the mask with grey (ratio_water dependent) where inland water was detected in the first part above   
         if (til_x,til_y) in dico_masks_inland:    
-            for (lat1,lon1,lat2,lon2,lat3,lon3) in dico_masks_inland[(til_x,til_y)]:
-                (px1,py1)=GEO.wgs84_to_pix(lat1,lon1,tile.mask_zl)
-                (px2,py2)=GEO.wgs84_to_pix(lat2,lon2,tile.mask_zl)
-                (px3,py3)=GEO.wgs84_to_pix(lat3,lon3,tile.mask_zl)
-                px1-=px0; px2-=px0; px3-=px0; py1-=py0; py2-=py0; py3-=py0
-                mask_draw.polygon([(px1,py1),(px2,py2),(px3,py3)],fill=sea_level) #int(255*(1-tile.ratio_water)))   
+            for triangle in tris_to_mask_pix(dico_masks_inland[(til_x,til_y)],tile.mask_zl,px0,py0):
+                mask_draw.polygon(triangle,fill=sea_level) #int(255*(1-tile.ratio_water)))   
         # 3b) We overwrite the white + grey part of the mask with black where sea water was detected in the first part above
-        for (lat1,lon1,lat2,lon2,lat3,lon3) in dico_masks[(til_x,til_y)]:
-            (px1,py1)=GEO.wgs84_to_pix(lat1,lon1,tile.mask_zl)
-            (px2,py2)=GEO.wgs84_to_pix(lat2,lon2,tile.mask_zl)
-            (px3,py3)=GEO.wgs84_to_pix(lat3,lon3,tile.mask_zl)
-            px1-=px0; px2-=px0; px3-=px0; py1-=py0; py2-=py0; py3-=py0
-            mask_draw.polygon([(px1,py1),(px2,py2),(px3,py3)],fill='black')
+        for triangle in tris_to_mask_pix(dico_masks[(til_x,til_y)],tile.mask_zl,px0,py0):
+            mask_draw.polygon(triangle,fill='black')
         del(mask_draw)
         #mask_im=mask_im.convert("L") 
         img_array=numpy.array(mask_im,dtype=numpy.uint8)
@@ -311,16 +294,7 @@ def build_masks(tile,for_imagery=False):
             blur_width=[L/pxscal for L in tile.masks_width]
         if tile.masking_mode=="sand" and blur_width: 
         # convolution with a hat function
-            b_img_array=numpy.array(img_array)
-            kernel=numpy.array(range(1,2*blur_width))
-            kernel[blur_width:]=range(blur_width-1,0,-1)
-            kernel=kernel/blur_width**2
-            for i in range(0,len(b_img_array)):
-                b_img_array[i]=numpy.convolve(b_img_array[i],kernel,'same')
-            b_img_array=b_img_array.transpose() 
-            for i in range(0,len(b_img_array)):
-                b_img_array[i]=numpy.convolve(b_img_array[i],kernel,'same')
-            b_img_array=b_img_array.transpose()
+            b_img_array=BLUR.hat_filter(numpy.array(img_array),blur_width)
             b_img_array=2*numpy.minimum(b_img_array,127)   
             b_img_array=numpy.array(b_img_array,dtype=numpy.uint8)
         elif tile.masking_mode=="rocks" and blur_width: 
@@ -552,17 +526,7 @@ if __name__ == '__main__':
     if mask_width:
         mask_width+=1
         UI.vprint(1,"Blur of the mask...")
-        img_array=numpy.array(mask_im,dtype=numpy.uint8)
-        kernel=numpy.ones(int(mask_width))/int(mask_width)
-        kernel=numpy.array(range(1,2*mask_width))
-        kernel[mask_width:]=range(mask_width-1,0,-1)
-        kernel=kernel/mask_width**2
-        for i in range(0,len(img_array)):
-            img_array[i]=numpy.convolve(img_array[i],kernel,'same')
-        img_array=img_array.transpose() 
-        for i in range(0,len(img_array)):
-            img_array[i]=numpy.convolve(img_array[i],kernel,'same')
-        img_array=img_array.transpose()
+        img_array=BLUR.hat_filter(numpy.array(mask_im,dtype=numpy.uint8),mask_width)
         img_array[img_array>=128]=255
         img_array[img_array<128]*=2  
         img_array=numpy.array(img_array,dtype=numpy.uint8)
@@ -0,0 +1,202 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+import numpy
+import O4_UI_Utils as UI
+
+# Number of meshes kept in memory once parsed (only those read with keep=True),
+# typically the tile mesh between Step 2.5 and Step 3.
+mesh_cache_size=2
+mesh_cache=OrderedDict()
+
+# When set, a binary companion (.mesh.bin) is written next to each text mesh 
+# and used instead of it as long as it matches the text file size and mtime.
+binary_mesh=False
+# magic, mesh version, nbr_vert, nbr_tri, text size, text mtime_ns, padded to 64 bytes
+binary_mesh_magic=b'O4BMESH1'
+binary_mesh_header='<8sdqqqq16x'
+
+##############################################################################
+class Mesh():
+    # vertices : (nbr_vert,3) float64 array of lon, lat, z/100000
+    # normals  : (nbr_vert,2) float64 array of the x and y normal components
+    # tris     : (nbr_tri,3) int array of zero based vertex indices
+    # tri_types: (nbr_tri,) int array of the raw triangle attributes
+    def __init__(self,mesh_version,vertices,normals,tris,tri_types):
+        self.mesh_version=mesh_version
+        self.vertices=vertices
+        self.normals=normals
+        self.tris=tris
+        self.tri_types=tri_types
+
+    def node_coords(self):
+        # flat lon,lat,z,nx,ny layout historically used by the DSF and mask code
+        node_coords=numpy.empty((len(self.vertices),5))
+        node_coords[:,:3]=self.vertices
+        node_coords[:,3:]=self.normals
+        return node_coords.ravel()
+##############################################################################
+
+##############################################################################
+def read_section(data,keyword,pos,dtype):
+    pos=data.index(b'\n'+keyword,pos)+len(keyword)+1
+    pos=data.index(b'\n',pos)+1
+    end=data.index(b'\n',pos)
+    count=int(data[pos:end])
+    pos=end+1
+    if count:
+        # sections are terminated by an empty line (or the end of file)
+        end=data.find(b'\n\n',pos)
+        if end==-1: end=len(data)
+        values=numpy.fromstring(data[pos:end],dtype=dtype,sep=' ')
+        if len(values)%count:
+            raise Exception("inconsistent "+keyword.decode()+" section in mesh file")
+        values=values.reshape((count,len(values)//count))
+    else:
+        end=pos
+        values=numpy.zeros((0,4),dtype=dtype)
+    return (values,end)
+##############################################################################
+
+##############################################################################
+def read_text_mesh(mesh_file_name):
+    with open(mesh_file_name,'rb') as f:
+        data=f.read()
+    mesh_version=float(data[:data.index(b'\n')].split()[-1])
+    (vertices,pos)=read_section(data,b'Vertices',0,numpy.float64)
+    (normals,pos)=read_section(data,b'Normals',pos,numpy.float64)
+    (tris,pos)=read_section(data,b'Triangles',pos,numpy.int64)
+    del data
+    return Mesh(mesh_version,vertices[:,:3],normals[:,:2],(tris[:,:3]-1).astype(numpy.int32),tris[:,3].astype(numpy.int32))
+##############################################################################
+
+##############################################################################
+def write_text_mesh(mesh_file_name,mesh):
+    with open(mesh_file_name,'w') as f:
+        f.write("MeshVersionFormatted "+str(mesh.mesh_version)+"\n")
+        f.write("Dimension 3\n\n")
+        f.write("Vertices\n")
+        f.write(str(len(mesh.vertices))+"\n")
+        numpy.savetxt(f,mesh.vertices,fmt='%.7f %.7f %.7f 0')
+        f.write("\n")
+        f.write("Normals\n")
+        f.write(str(len(mesh.normals))+"\n")
+        numpy.savetxt(f,mesh.normals,fmt='%.2f %.2f')
+        f.write("\n")
+        f.write("Triangles\n")
+        f.write(str(len(mesh.tris))+"\n")
+        numpy.savetxt(f,numpy.column_stack((mesh.tris+1,mesh.tri_types)),fmt='%d %d %d %d')
+    return 1
+##############################################################################
+
+##############################################################################
+def binary_mesh_file(mesh_file_name):
+    return mesh_file_name+'.bin'
+##############################################################################
+
+##############################################################################
+def text_mesh_stamp(mesh_file_name):
+    try:
+        stat=os.stat(mesh_file_name)
+        return (stat.st_size,stat.st_mtime_ns)
+    except:
+        return None
+##############################################################################
+
+##############################################################################
+def write_binary_mesh(bin_file_name,mesh,stamp=(0,0)):
+    nbr_vert=len(mesh.vertices)
+    nbr_tri=len(mesh.tris)
+    tris=numpy.empty((nbr_tri,4),dtype='<i4')
+    tris[:,:3]=mesh.tris
+    tris[:,3]=mesh.tri_types
+    # unique per process and thread, masks of neighbouring tiles may convert the same mesh
+    tmp_file_name=bin_file_name+'.'+str(os.getpid())+'.'+str(threading.get_ident())+'.tmp'
+    with open(tmp_file_name,'wb') as f:
+        f.write(struct.pack(binary_mesh_header,binary_mesh_magic,mesh.mesh_version,nbr_vert,nbr_tri,*stamp))
+        f.write(numpy.ascontiguousarray(mesh.vertices,dtype='<f8').tobytes())
+        f.write(numpy.ascontiguousarray(mesh.normals,dtype='<f4').tobytes())
+        f.write(tris.tobytes())
+    try:
+        os.replace(tmp_file_name,bin_file_name)
+    except:
+        # e.g. the former one is still memory mapped (Windows)
+        try: os.remove(tmp_file_name)
+        except: pass
+        raise
+    return 1
+##############################################################################
+
+##############################################################################
+def read_binary_mesh(bin_file_name,stamp=None):
+    # arrays are memory mapped, nothing is parsed
+    header_size=struct.calcsize(binary_mesh_header)
+    with open(bin_file_name,'rb') as f:
+        header=f.read(header_size)
+    (magic,mesh_version,nbr_vert,nbr_tri,size,mtime_ns)=struct.unpack(binary_mesh_header,header)
+    if magic!=binary_mesh_magic:
+        raise Exception("not a binary mesh file")
+    if stamp and (size,mtime_ns)!=stamp:
+        raise Exception("binary mesh file out of date")
+    offset=header_size
+    vertices=numpy.memmap(bin_file_name,dtype='<f8',mode='r',offset=offset,shape=(nbr_vert,3))
+    offset+=24*nbr_vert
+    normals=numpy.memmap(bin_file_name,dtype='<f4',mode='r',offset=offset,shape=(nbr_vert,2))
+    offset+=8*nbr_vert
+    tris=numpy.memmap(bin_file_name,dtype='<i4',mode='r',offset=offset,shape=(nbr_tri,4)) if nbr_tri else numpy.zeros((0,4),dtype='<i4')
+    return Mesh(mesh_version,vertices,normals,tris[:,:3],tris[:,3])
+##############################################################################
+
+##############################################################################
+def mesh_text_to_binary(mesh_file_name,mesh=None):
+    if mesh is None: mesh=read_text_mesh(mesh_file_name)
+    return write_binary_mesh(binary_mesh_file(mesh_file_name),mesh,text_mesh_stamp(mesh_file_name))
+##############################################################################
+
+##############################################################################
+def mesh_binary_to_text(mesh_file_name):
+    # restores the text mesh from its companion, and stamps the latter accordingly
+    bin_file_name=binary_mesh_file(mesh_file_name)
+    mesh=read_binary_mesh(bin_file_name)
+    write_text_mesh(mesh_file_name,mesh)
+    mesh.vertices=numpy.array(mesh.vertices); mesh.normals=numpy.array(mesh.normals)
+    mesh.tris=numpy.array(mesh.tris); mesh.tri_types=numpy.array(mesh.tri_types)
+    return write_binary_mesh(bin_file_name,mesh,text_mesh_stamp(mesh_file_name))
+##############################################################################
+
+##############################################################################
+def read_mesh_file(mesh_file_name,keep=False):
+    stamp=text_mesh_stamp(mesh_file_name)
+    key=os.path.abspath(mesh_file_name)
+    if key in mesh_cache and mesh_cache[key][0]==stamp:
+        UI.vprint(2,"    Mesh file",mesh_file_name,"found in memory.")
+        mesh_cache.move_to_end(key)
+        return mesh_cache[key][1]
+    mesh_cache.pop(key,None)
+    mesh=None
+    if binary_mesh and os.path.isfile(binary_mesh_file(mesh_file_name)):
+        try:
+            mesh=read_binary_mesh(binary_mesh_file(mesh_file_name),stamp)
+        except Exception as e:
+            UI.vprint(2,"    Binary companion of",mesh_file_name,"not used:",e)
+    if mesh is None:
+        mesh=read_text_mesh(mesh_file_name)
+        if binary_mesh:
+            try:
+                mesh_text_to_binary(mesh_file_name,mesh)
+            except Exception as e:
+                UI.vprint(2,"    Could not write the binary companion of",mesh_file_name,":",e)
+    if keep and mesh_cache_size:
+        mesh_cache[key]=(stamp,mesh)
+        while len(mesh_cache)>mesh_cache_size:
+            mesh_cache.popitem(last=False)
+    return mesh
+##############################################################################
+
+##############################################################################
+def forget_mesh_file(mesh_file_name):
+    mesh_cache.pop(os.path.abspath(mesh_file_name),None)
+    try: os.remove(binary_mesh_file(mesh_file_name))
+    except: pass
+##############################################################################
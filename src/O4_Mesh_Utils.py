@@ -12,6 +12,7 @@ import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Vector_Utils as VECT
 import O4_OSM_Utils as OSM
+import O4_Mesh_IO as MESHIO
 import O4_Version
 
 if 'dar' in sys.platform:
@@ -226,7 +227,8 @@ def write_mesh_file(tile,vertices):
     f_ele  = open(FNAMES.output_ele_file(tile),'r')
     nbr_vert=len(vertices)//6
     nbr_tri=int(f_ele.readline().split()[0])
-    f=open(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon),"w")
+    # written aside and then renamed, the mesh may be read meanwhile (batch builds)
+    f=open(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon)+'.tmp',"w")
     f.write("MeshVersionFormatted "+O4_Version.version+"\n")
     f.write("Dimension 3\n\n")
     f.write("Vertices\n")
@@ -248,6 +250,15 @@ def write_mesh_file(tile,vertices):
        f.write(' '.join(f_ele.readline().split()[1:])+"\n")
     f_ele.close()
     f.close()
+    # the former mesh may be held in memory (memory mapped companion)
+    MESHIO.forget_mesh_file(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon))
+    os.replace(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon)+'.tmp',FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon))
+    if MESHIO.binary_mesh:
+        UI.vprint(1,"-> Writing its binary companion")
+        try:
+            MESHIO.mesh_text_to_binary(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon))
+        except Exception as e:
+            UI.lvprint(1,"WARNING: Could not write the binary companion of the mesh, the text one will be used :",e)
     return
 ##############################################################################
 
@@ -261,57 +272,43 @@ def extract_mesh_to_obj(mesh_file,til_x_left,til_y_top,zoomlevel,provider_code):
     (latmin,lonmax)=GEO.gtile_to_wgs84(til_x_left+16,til_y_top+16,zoomlevel)
     obj_file_name=FNAMES.obj_file(til_x_left,til_y_top,zoomlevel,provider_code)
     mtl_file_name=FNAMES.mtl_file(til_x_left,til_y_top,zoomlevel,provider_code)
-    f_mesh=open(mesh_file,"r")
-    for i in range(4):
-        f_mesh.readline()
-    nbr_pt_in=int(f_mesh.readline())
-    UI.vprint(1,"    Reading nodes...")
-    pt_in=numpy.zeros(5*nbr_pt_in,'float')
-    for i in range(nbr_pt_in):
-        pt_in[5*i:5*i+3]=[float(x) for x in f_mesh.readline().split()[:3]]
-    for i in range(3):
-        f_mesh.readline()
-    for i in range(nbr_pt_in):
-        pt_in[5*i+3:5*i+5]=[float(x) for x in f_mesh.readline().split()[:2]]
-    for i in range(0,2): # skip 2 lines
-        f_mesh.readline()
+    UI.vprint(1,"    Reading mesh...")
+    mesh=MESHIO.read_mesh_file(mesh_file)
+    pt_in=mesh.node_coords()
     if UI.red_flag: UI.exit_message_and_bottom_line(); return 0
-    UI.vprint(1,"    Reading triangles...")
-    nbr_tri_in=int(f_mesh.readline()) # read nbr of tris
+    UI.vprint(1,"    Selecting triangles...")
+    # only the triangles whose barycenter falls within the region are kept
+    bary=mesh.vertices[mesh.tris,:2].mean(axis=1)
+    tri_list=mesh.tris[(bary[:,1]>=latmin) & (bary[:,1]<=latmax) & (bary[:,0]>=lonmin) & (bary[:,0]<=lonmax)].tolist()
+    del mesh, bary
     textured_nodes={}
     textured_nodes_inv={}
-    nodes_st_coord={}
     len_textured_nodes=0
     dico_new_tri={}
     len_dico_new_tri=0
-    for i in range(0,nbr_tri_in):
-        (n1,n2,n3)=[int(x)-1 for x in f_mesh.readline().split()[:3]]
-        (lon1,lat1,z1,u1,v1)=pt_in[5*n1:5*n1+5]
-        (lon2,lat2,z2,u2,v2)=pt_in[5*n2:5*n2+5]
-        (lon3,lat3,z3,u3,v3)=pt_in[5*n3:5*n3+5]
-        if is_in_region((lat1+lat2+lat3)/3.0,(lon1+lon2+lon3)/3.0,latmin,latmax,lonmin,lonmax):
-            if n1 not in textured_nodes_inv:
-                len_textured_nodes+=1 
-                textured_nodes_inv[n1]=len_textured_nodes
-                textured_nodes[len_textured_nodes]=n1
-                nodes_st_coord[len_textured_nodes]=GEO.st_coord(lat1,lon1,til_x_left,til_y_top,zoomlevel,provider_code)
-            n1new=textured_nodes_inv[n1]
-            if n2 not in textured_nodes_inv:
-                len_textured_nodes+=1 
-                textured_nodes_inv[n2]=len_textured_nodes
-                textured_nodes[len_textured_nodes]=n2
-                nodes_st_coord[len_textured_nodes]=GEO.st_coord(lat2,lon2,til_x_left,til_y_top,zoomlevel,provider_code)
-            n2new=textured_nodes_inv[n2]
-            if n3 not in textured_nodes_inv:
-                len_textured_nodes+=1 
-                textured_nodes_inv[n3]=len_textured_nodes
-                textured_nodes[len_textured_nodes]=n3
-                nodes_st_coord[len_textured_nodes]=GEO.st_coord(lat3,lon3,til_x_left,til_y_top,zoomlevel,provider_code)
-            n3new=textured_nodes_inv[n3]
-            dico_new_tri[len_dico_new_tri]=(n1new,n2new,n3new)
-            len_dico_new_tri+=1
+    for (n1,n2,n3) in tri_list:
+        if n1 not in textured_nodes_inv:
+            len_textured_nodes+=1 
+            textured_nodes_inv[n1]=len_textured_nodes
+            textured_nodes[len_textured_nodes]=n1
+        n1new=textured_nodes_inv[n1]
+        if n2 not in textured_nodes_inv:
+            len_textured_nodes+=1 
+            textured_nodes_inv[n2]=len_textured_nodes
+            textured_nodes[len_textured_nodes]=n2
+        n2new=textured_nodes_inv[n2]
+        if n3 not in textured_nodes_inv:
+            len_textured_nodes+=1 
+            textured_nodes_inv[n3]=len_textured_nodes
+            textured_nodes[len_textured_nodes]=n3
+        n3new=textured_nodes_inv[n3]
+        dico_new_tri[len_dico_new_tri]=(n1new,n2new,n3new)
+        len_dico_new_tri+=1
     nbr_vert=len_textured_nodes
     nbr_tri=len_dico_new_tri
+    # texture coordinates of all the kept nodes at once
+    kept_nodes=numpy.array([textured_nodes[i] for i in range(1,nbr_vert+1)],dtype=numpy.int64)
+    (nodes_s,nodes_t)=GEO.st_coord_vec(pt_in[5*kept_nodes+1],pt_in[5*kept_nodes],til_x_left,til_y_top,zoomlevel,provider_code)
     if UI.red_flag: UI.exit_message_and_bottom_line(); return 0
     UI.vprint(1,"    Writing the obj file.")
     # first the obj file
@@ -328,14 +325,13 @@ def extract_mesh_to_obj(mesh_file,til_x_left,til_y_top,zoomlevel,provider_code):
     f.write("\n")
     for i in range(1,nbr_vert+1):
         j=textured_nodes[i]
-        f.write("vt "+'{:.9f}'.format(nodes_st_coord[i][0])+" "+\
-                '{:.9f}'.format(nodes_st_coord[i][1])+"\n")
+        f.write("vt "+'{:.9f}'.format(nodes_s[i-1])+" "+\
+                '{:.9f}'.format(nodes_t[i-1])+"\n")
     f.write("\n")
     f.write("usemtl orthophoto\n\n")
     for i in range(0,nbr_tri):
         (one,two,three)=dico_new_tri[i]
         f.write("f "+str(one)+"/"+str(one)+"/"+str(one)+" "+str(two)+"/"+str(two)+"/"+str(two)+" "+str(three)+"/"+str(three)+"/"+str(three)+"\n")
-    f_mesh.close()
     f.close()
     # then the mtl file
     f=open(mtl_file_name,'w')
@@ -505,6 +501,7 @@ def sort_mesh(tile):
         UI.exit_message_and_bottom_line("\nERROR: Could not find ",mesh_file)
         return 0
     sort_mesh_cmd_list=[sort_mesh_cmd.strip(),str(tile.default_zl),mesh_file]
+    MESHIO.forget_mesh_file(mesh_file)
     UI.vprint(1,"-> Reorganizing mesh triangles.")
     timer=time.time()
     moulinette=subprocess.Popen(sort_mesh_cmd_list,stdout=subprocess.PIPE,bufsize=0)
@@ -514,6 +511,11 @@ def sort_mesh(tile):
             break
         else:
             print(line.decode("utf-8")[:-1])
+    if MESHIO.binary_mesh:
+        try:
+            MESHIO.mesh_text_to_binary(mesh_file)
+        except Exception as e:
+            UI.lvprint(1,"WARNING: Could not write the binary companion of the mesh, the text one will be used :",e)
     UI.timings_and_bottom_line(timer)
     UI.logprint("Moulinette applied for tile lat=",tile.lat,", lon=",tile.lon," and ZL",tile.default_zl)
     return 1
@@ -2,12 +2,18 @@ import os
 import time
 import io
 import bz2
+import json
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import requests
 import numpy
 from shapely import geometry, ops
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
+import O4_PBF_Utils as PBF
 
 overpass_servers={
         "DE":"http://overpass-api.de/api/interpreter",
@@ -17,14 +23,42 @@ overpass_servers={
         }
 overpass_server_choice="DE"
 max_osm_tentatives=8
+osm_binary_cache=True
+# directory of .osm.pbf extracts used instead of Overpass for the tiles they cover
+osm_extract_dir=''
+# string queries of a layer are downloaded in unions of at most max_union_queries,
+# up to max_overpass_threads requests at a time
+max_union_queries=3
+max_overpass_threads=4
+# requests per second and per server in the long run, and maximal burst
+overpass_rate=0.5
+overpass_burst=2
+
+# .o4osm files : magic, length of a json header, header, and then raw arrays 
+# (described in the header) aligned on 64 bytes so that they can be memory mapped
+o4osm_magic=b'O4OSM\n'
+o4osm_version=1
 
 ##############################################################################
 class OSM_layer():
 
-    def __init__(self):
+    def __init__(self,compact=False):
         self.dicosmn={}      # keys are ints (ids) and values are tuple of (lat,lon)
         self.dicosmn_reverse={} # reverese of the previous one
         self.dicosmw={}
+        # In compact mode (large layers) the three above are replaced by numpy arrays:
+        # node -k has coordinates node_coords[k-1] and way -k is made of the node rows 
+        # way_rows[way_offsets[k-1]:way_offsets[k]], relations rings are int64 arrays. 
+        # Nodes are deduplicated through a dict keyed by their coordinates (1e-7 deg) 
+        # packed in an int64, which only lives for the time of update_dicosm.
+        # Ids are the same in both modes, use the way_* and node* methods below to 
+        # access nodes and ways.
+        self.compact=compact
+        if compact:
+            self.dicosmn=self.dicosmn_reverse=self.dicosmw=None
+            self.node_coords=numpy.empty((4096,2),dtype=numpy.float64)
+            self.way_offsets=numpy.zeros(1024,dtype=numpy.int64)
+            self.way_rows=numpy.empty(16384,dtype=numpy.int64)
         self.next_node_id=-1
         self.next_way_id=-1
         self.next_rel_id=-1
@@ -45,88 +79,113 @@ class OSM_layer():
         # input_tags (dict or None) are the input query tags (per osm type)
         # target_tags (dict or None) are the the tags which should be kept (per osm type)
         # It is expected that if not None the target_tags contains the input_tags
-        initnodes=len(self.dicosmn)
+        initnodes=-1-self.next_node_id
         initways=len(self.dicosmfirst['w'])
         initrels=len(self.dicosmfirst['r'])
         dicosmn_id_map={}
         dicosmw_id_map={}
-        # osm_input may either refer to an osm filename (e.g. cached data) or 
-        # to a xml bytestring (direct download) 
+        # osm_input may either refer to an osm filename (e.g. cached data), 
+        # to a xml bytestring (direct download), or be an iterable of already
+        # parsed (tag,attributes) pairs in the xml order (local extract)
+        pfile=None
         if isinstance(osm_input,str):
             osm_file_name=osm_input 
             try:
                 if osm_file_name[-4:]=='.bz2':
-                    pfile=bz2.open(osm_file_name,'rt',encoding="utf-8")
+                    pfile=bz2.open(osm_file_name,'rb')
                 else:
-                    pfile=open(osm_file_name,'r',encoding="utf-8")
+                    pfile=open(osm_file_name,'rb')
             except:
                 UI.vprint(1,"    Could not open",osm_file_name,"for reading (corrupted ?).")
                 return 0    
         elif isinstance(osm_input,bytes):
-            pfile=io.StringIO(osm_input.decode(encoding="utf-8"))
-        first_line=pfile.readline()
-        if "<osm " not in first_line:
-            first_line=pfile.readline()
-        separator="'" if "'" in first_line else '"'
+            pfile=io.BytesIO(osm_input)
         normal_exit=False
-        for line in pfile:
-            items=line.split(separator)
-            if '<node id=' in items[0]:
+        osm_root=False
+        osmtype=osmid=dico_rel_check=None
+        # The XML is streamed through expat, whatever its layout (quotes, line breaks).
+        # Elements are handled when they open (their attributes are then known), 
+        # a way or relation is completed when the next node, way or relation opens
+        # or at the end of the file (no end handler, called for each element).
+        (dicosmn,dicosmn_reverse,dicosmw)=(self.dicosmn,self.dicosmn_reverse,self.dicosmw)
+        (compact,node_keys)=(self.compact,self.node_keys() if self.compact else None)
+        way_nodes=None
+        def complete_element():
+            if osmtype=='w':
+                if compact and way_nodes:
+                    self.store_way(osmid,way_nodes)
+                elif not way_nodes:
+                    if not compact: del(dicosmw[osmid]) 
+                    self.next_way_id+=1
+                    if osmid in self.dicosmfirst['w']: self.dicosmfirst['w'].remove(osmid)
+                    if osmid in self.dicosmtags['w']: del(self.dicosmtags['w'][osmid])
+            elif osmtype=='r':
+                self.close_relation(osmid,dico_rel_check,target_tags)
+        def start_element(tag,attrib):
+            nonlocal osmtype,osmid,dico_rel_check,way_nodes,osm_root
+            if tag=='nd':
+                way_nodes.append(dicosmn_id_map[attrib['ref']])
+            elif tag=='node':
+                if osmtype=='w' or osmtype=='r': complete_element()
                 osmtype='n'
-                osmid=items[1]
-                for j in range(0,len(items)):
-                    if items[j]==' lat=':
-                        latp=float(items[j+1])
-                    elif items[j]==' lon=':
-                        lonp=float(items[j+1])
-                if (lonp,latp) in self.dicosmn_reverse:
-                    true_osmid=self.dicosmn_reverse[(lonp,latp)]
-                    dicosmn_id_map[osmid]=true_osmid
-                    osmid=true_osmid
+                lonlat=(float(attrib['lon']),float(attrib['lat']))
+                if compact:
+                    key=round(lonlat[0]*1e7)*4294967296+round(lonlat[1]*1e7)
+                    osmid=node_keys.get(key)
+                    if osmid is None:
+                        osmid=self.next_node_id
+                        self.next_node_id-=1
+                        node_keys[key]=osmid
+                        if -1-osmid==len(self.node_coords): self.node_coords=grown(self.node_coords) 
+                        self.node_coords[-1-osmid]=lonlat
                 else:
-                    true_osmid=self.next_node_id
-                    dicosmn_id_map[osmid]=true_osmid
-                    osmid=true_osmid
-                    self.dicosmn_reverse[(lonp,latp)]=osmid
-                    self.dicosmn[osmid]=(lonp,latp)
-                    self.next_node_id-=1
-            elif '<way id=' in items[0]:
+                    osmid=dicosmn_reverse.get(lonlat)
+                    if osmid is None:
+                        osmid=self.next_node_id
+                        self.next_node_id-=1
+                        dicosmn_reverse[lonlat]=osmid
+                        dicosmn[osmid]=lonlat
+                dicosmn_id_map[attrib['id']]=osmid
+            elif tag=='tag':
+                (k,v)=(attrib['k'],attrib['v'])
+                # Do we need to catch that tag ?
+                if (not input_tags) or (('all','') in target_tags[osmtype])\
+                                     or ((k,'') in target_tags[osmtype])\
+                                     or ((k,v) in target_tags[osmtype]):
+                    if osmid not in self.dicosmtags[osmtype]: 
+                        self.dicosmtags[osmtype][osmid]={k:v}
+                    else:
+                        self.dicosmtags[osmtype][osmid][k]=v                     
+                    # If so, do we need to declare this osmid as a first catch, not one only brought with as a child    
+                    if input_tags and (((k,'') in input_tags[osmtype]) or ((k,v) in input_tags[osmtype])):
+                        self.dicosmfirst[osmtype].add(osmid)                         
+            elif tag=='way':
+                if osmtype=='w' or osmtype=='r': complete_element()
                 osmtype='w'
-                osmid=items[1]
+                osmid=attrib['id']
                 true_osmid=self.next_way_id
                 self.next_way_id-=1
                 dicosmw_id_map[osmid]=true_osmid
                 osmid=true_osmid
-                self.dicosmw[osmid]=[]  
+                way_nodes=[]
+                if not compact: dicosmw[osmid]=way_nodes
                 if not input_tags: self.dicosmfirst['w'].add(osmid)
-            elif '<nd ref=' in items[0]:
-                self.dicosmw[osmid].append(dicosmn_id_map[items[1]])
-            elif '<relation id=' in items[0]:
-                osmtype='r'
-                osmid=items[1]
-                true_osmid=self.next_rel_id
-                self.next_rel_id-=1
-                osmid=true_osmid
-                self.dicosmr[osmid]={'outer':[],'inner':[]}
-                self.dicosmrorig[osmid]={'outer':[],'inner':[]}
-                dico_rel_check={'inner':{},'outer':{}}
-                if not input_tags: 
-                    self.dicosmfirst['r'].add(osmid)
-            elif '<member type=' in items[0]:
-                role=items[5]
-                if items[1]!='way' or role not in ('outer','inner'):
-                    if items[1]=='node': continue # not necessary to report these
-                    UI.lvprint(2,"Relation id=",osmid,"contains a member of type","'"+items[1]+"'","and role","'"+role+"'","which was not treated (only deal with 'ways' of role 'inner' or 'outer').")
-                    continue                
+            elif tag=='member':
+                (member_type,role)=(attrib.get('type'),attrib.get('role'))
+                if member_type!='way' or role not in ('outer','inner'):
+                    if member_type=='node': return # not necessary to report these
+                    UI.lvprint(2,"Relation id=",osmid,"contains a member of type","'"+str(member_type)+"'","and role","'"+str(role)+"'","which was not treated (only deal with 'ways' of role 'inner' or 'outer').")
+                    return                
                 try:
-                    wayid=dicosmw_id_map[items[3]]
+                    wayid=dicosmw_id_map[attrib['ref']]
                 except:
-                    continue
+                    return
                 self.dicosmrorig[osmid][role].append(wayid)
-                endpt1=self.dicosmw[wayid][0]
-                endpt2=self.dicosmw[wayid][-1]
+                member_nodes=self.way_nodes(wayid)
+                endpt1=member_nodes[0]
+                endpt2=member_nodes[-1]
                 if endpt1==endpt2:
-                    self.dicosmr[osmid][role].append(self.dicosmw[wayid])
+                    self.dicosmr[osmid][role].append(member_nodes)
                 else:
                     if endpt1 in dico_rel_check[role]:
                         dico_rel_check[role][endpt1].append(wayid)
@@ -136,90 +195,140 @@ class OSM_layer():
                         dico_rel_check[role][endpt2].append(wayid)
                     else:
                         dico_rel_check[role][endpt2]=[wayid]
-            elif ('<tag k=' in items[0]):
-                # Do we need to catch that tag ?
-                if (not input_tags) or (('all','') in target_tags[osmtype])\
-                                     or ((items[1],'') in target_tags[osmtype])\
-                                     or ((items[1],items[3]) in target_tags[osmtype]):
-                    if osmid not in self.dicosmtags[osmtype]: 
-                        self.dicosmtags[osmtype][osmid]={items[1]:items[3]}
-                    else:
-                        self.dicosmtags[osmtype][osmid][items[1]]=items[3]                     
-                    # If so, do we need to declare this osmid as a first catch, not one only brought with as a child    
-                    if input_tags and (((items[1],'') in input_tags[osmtype]) or ((items[1],items[3]) in input_tags[osmtype])):
-                        self.dicosmfirst[osmtype].add(osmid)                         
-            elif '</way' in items[0]:
-                if not self.dicosmw[osmid]:
-                    del(self.dicosmw[osmid]) 
-                    self.next_way_id+=1
-                    if osmid in self.dicosmfirst['w']: self.dicosmfirst['w'].remove(osmid)
-                    if osmid in self.dicosmtags['w']: del(self.dicosmtags[osmtype][osmid])
-            elif '</relation>' in items[0]:
-                bad_rel=False
-                for role,endpt in ((r,e) for r in ['outer','inner'] for e in dico_rel_check[r]):
-                    if len(dico_rel_check[role][endpt])!=2:
-                        bad_rel=True
-                        break
-                if bad_rel==True:
-                    UI.lvprint(2,"Relation id=",osmid,"is ill formed and was not treated.")
-                    del(self.dicosmr[osmid])
-                    del(self.dicosmrorig[osmid])
-                    del(dico_rel_check)
-                    self.next_rel_id+=1
-                    if osmid in self.dicosmfirst['r']: self.dicosmfirst['r'].remove(osmid)
-                    if osmid in self.dicosmtags['r']: del(self.dicosmtags['r'][osmid])
-                    continue
-                for role in ['outer','inner']:
-                    while dico_rel_check[role]:
-                        nodeids=[]
-                        endpt=next(iter(dico_rel_check[role]))
-                        wayid=dico_rel_check[role][endpt][0]
-                        endptinit=self.dicosmw[wayid][0]
-                        endpt1=endptinit
-                        endpt2=self.dicosmw[wayid][-1]
-                        for nodeid in self.dicosmw[wayid][:-1]:
-                            nodeids.append(nodeid)
-                        while endpt2!=endptinit:
-                            if dico_rel_check[role][endpt2][0]==wayid:
-                                    wayid=dico_rel_check[role][endpt2][1]
-                            else:
-                                    wayid=dico_rel_check[role][endpt2][0]
-                            endpt1=endpt2
-                            if self.dicosmw[wayid][0]==endpt1:
-                                endpt2=self.dicosmw[wayid][-1]
-                                for nodeid in self.dicosmw[wayid][:-1]:
-                                    nodeids.append(nodeid)
-                            else:
-                                endpt2=self.dicosmw[wayid][0]
-                                for nodeid in self.dicosmw[wayid][-1:0:-1]:
-                                    nodeids.append(nodeid)
-                            del(dico_rel_check[role][endpt1])
-                        nodeids.append(endptinit)
-                        self.dicosmr[osmid][role].append(nodeids)
-                        del(dico_rel_check[role][endptinit])
-                if target_tags==None:
-                    for wayid in self.dicosmrorig[osmid]['outer']+self.dicosmrorig[osmid]['inner']:
-                        try:
-                            self.dicosmfirst['w'].remove(wayid)
-                        except:
-                           pass
-                if not self.dicosmr[osmid]['outer']: 
-                    del(self.dicosmr[osmid])
-                    del(self.dicosmrorig[osmid])
-                    self.next_rel_id+=1
-                    if osmid in self.dicosmfirst['r']: self.dicosmfirst['r'].remove(osmid)
-                    if osmid in self.dicosmtags['r']: del(self.dicosmtags['r'][osmid])
-                del(dico_rel_check)
-            elif '</osm>' in items[0]:
+            elif tag=='relation':
+                if osmtype=='w' or osmtype=='r': complete_element()
+                osmtype='r'
+                true_osmid=self.next_rel_id
+                self.next_rel_id-=1
+                osmid=true_osmid
+                self.dicosmr[osmid]={'outer':[],'inner':[]}
+                self.dicosmrorig[osmid]={'outer':[],'inner':[]}
+                dico_rel_check={'inner':{},'outer':{}}
+                if not input_tags: 
+                    self.dicosmfirst['r'].add(osmid)
+            elif tag=='osm':
+                osm_root=True
+        parser=expat.ParserCreate()
+        parser.StartElementHandler=start_element
+        try:
+            if pfile is None:
+                for (tag,attrib) in osm_input: start_element(tag,attrib)
+            else:
+                # large reads, expat's own ParseFile reads in small chunks
+                while True:
+                    data=pfile.read(1048576)
+                    parser.Parse(data,not data)
+                    if not data: break
+            # expat only gets there with a complete document
+            if osm_root:
+                complete_element()
                 normal_exit=True
-        pfile.close()
+        except Exception as e:
+            UI.vprint(2,"      XML parse error:",e)
+        if pfile: pfile.close()
         if not normal_exit:
             UI.lvprint(0,"ERROR: OSM overpass server answer was corrupted (no ending </OSM> tag)")
             return 0 
-        UI.vprint(2,"      A total of "+str(len(self.dicosmn)-initnodes)+" new node(s), "+\
+        UI.vprint(2,"      A total of "+str(-1-self.next_node_id-initnodes)+" new node(s), "+\
                str(len(self.dicosmfirst['w'])-initways)+" new ways and "+str(len(self.dicosmfirst['r'])-initrels)+" new relation(s).")
         return 1
 
+    def store_way(self,wayid,nodeids):
+        # compact mode, way -k is appended after way -k+1
+        k=-1-wayid
+        if k+1==len(self.way_offsets): self.way_offsets=grown(self.way_offsets)
+        start=self.way_offsets[k]
+        end=start+len(nodeids)
+        while end>len(self.way_rows): self.way_rows=grown(self.way_rows)
+        self.way_rows[start:end]=-1-numpy.array(nodeids,dtype=numpy.int64)
+        self.way_offsets[k+1]=end
+
+    def node_keys(self):
+        # compact mode, dict of the packed coordinates of all nodes to their ids
+        keys=numpy.rint(self.node_coords[:-1-self.next_node_id]*1e7).astype(numpy.int64)
+        return dict(zip((keys[:,0]*4294967296+keys[:,1]).tolist(),range(-1,self.next_node_id,-1)))
+
+    def way_ids(self):
+        return self.dicosmw.keys() if not self.compact else range(-1,self.next_way_id,-1)
+
+    def way_nodes(self,wayid):
+        # list of nodeids
+        if not self.compact: return self.dicosmw[wayid]
+        return (-1-self.way_rows[self.way_offsets[-1-wayid]:self.way_offsets[-wayid]]).tolist()
+
+    def way_lonlat(self,wayid):
+        # (n,2) array of the (lon,lat) of the nodes of the way 
+        if not self.compact: return self.nodes_lonlat(self.dicosmw[wayid])
+        return self.node_coords[self.way_rows[self.way_offsets[-1-wayid]:self.way_offsets[-wayid]]]
+
+    def nodes_lonlat(self,nodeids):
+        if not self.compact: return numpy.array([self.dicosmn[nodeid] for nodeid in nodeids],dtype=numpy.float64)
+        return self.node_coords[-1-numpy.array(nodeids,dtype=numpy.int64)]
+
+    def node_lonlat(self,nodeid):
+        if not self.compact: return self.dicosmn[nodeid]
+        return tuple(self.node_coords[-1-nodeid].tolist())
+
+    def close_relation(self,osmid,dico_rel_check,target_tags):
+        # sorts out the member ways of relation osmid into closed rings of nodeids,
+        # or drops the relation if it is ill formed or has no outer ring.
+        bad_rel=False
+        for role,endpt in ((r,e) for r in ['outer','inner'] for e in dico_rel_check[r]):
+            if len(dico_rel_check[role][endpt])!=2:
+                bad_rel=True
+                break
+        if bad_rel==True:
+            UI.lvprint(2,"Relation id=",osmid,"is ill formed and was not treated.")
+            del(self.dicosmr[osmid])
+            del(self.dicosmrorig[osmid])
+            self.next_rel_id+=1
+            if osmid in self.dicosmfirst['r']: self.dicosmfirst['r'].remove(osmid)
+            if osmid in self.dicosmtags['r']: del(self.dicosmtags['r'][osmid])
+            return
+        for role in ['outer','inner']:
+            while dico_rel_check[role]:
+                nodeids=[]
+                endpt=next(iter(dico_rel_check[role]))
+                wayid=dico_rel_check[role][endpt][0]
+                endptinit=self.way_nodes(wayid)[0]
+                endpt1=endptinit
+                endpt2=self.way_nodes(wayid)[-1]
+                for nodeid in self.way_nodes(wayid)[:-1]:
+                    nodeids.append(nodeid)
+                while endpt2!=endptinit:
+                    if dico_rel_check[role][endpt2][0]==wayid:
+                            wayid=dico_rel_check[role][endpt2][1]
+                    else:
+                            wayid=dico_rel_check[role][endpt2][0]
+                    endpt1=endpt2
+                    if self.way_nodes(wayid)[0]==endpt1:
+                        endpt2=self.way_nodes(wayid)[-1]
+                        for nodeid in self.way_nodes(wayid)[:-1]:
+                            nodeids.append(nodeid)
+                    else:
+                        endpt2=self.way_nodes(wayid)[0]
+                        for nodeid in self.way_nodes(wayid)[-1:0:-1]:
+                            nodeids.append(nodeid)
+                    del(dico_rel_check[role][endpt1])
+                nodeids.append(endptinit)
+                self.dicosmr[osmid][role].append(nodeids)
+                del(dico_rel_check[role][endptinit])
+        if target_tags==None:
+            for wayid in self.dicosmrorig[osmid]['outer']+self.dicosmrorig[osmid]['inner']:
+                try:
+                    self.dicosmfirst['w'].remove(wayid)
+                except:
+                   pass
+        if not self.dicosmr[osmid]['outer']: 
+            del(self.dicosmr[osmid])
+            del(self.dicosmrorig[osmid])
+            self.next_rel_id+=1
+            if osmid in self.dicosmfirst['r']: self.dicosmfirst['r'].remove(osmid)
+            if osmid in self.dicosmtags['r']: del(self.dicosmtags['r'][osmid])
+        elif self.compact:
+            for role in ['outer','inner']:
+                self.dicosmr[osmid][role]=[numpy.array(nodeids,dtype=numpy.int64) for nodeids in self.dicosmr[osmid][role]]
+
     def write_to_file(self,filename):
         try:
             if filename[-4:]=='.bz2':
@@ -230,24 +339,28 @@ class OSM_layer():
             UI.vprint(1,"    Could not open",filename,"for writing.")
             return 0
         fout.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="Ortho4XP">\n')
+        if not self.compact:
+            nodes=self.dicosmn.items()
+        else:
+            nodes=zip(range(-1,self.next_node_id,-1),self.node_coords[:-1-self.next_node_id].tolist())
         if not len(self.dicosmfirst['n']):
-            for nodeid,(lonp,latp) in self.dicosmn.items():
+            for nodeid,(lonp,latp) in nodes:
                 fout.write('  <node id="'+str(nodeid)+'" lat="'+'{:.7f}'.format(latp)+'" lon="'+'{:.7f}'.format(lonp)+'" version="1"/>\n')
         else:
-            for nodeid,(lonp,latp) in self.dicosmn.items():
+            for nodeid,(lonp,latp) in nodes:
                 if nodeid not in self.dicosmtags['n']:
                     fout.write('  <node id="'+str(nodeid)+'" lat="'+'{:.7f}'.format(latp)+'" lon="'+'{:.7f}'.format(lonp)+'" version="1"/>\n')
                 else:
                     fout.write('  <node id="'+str(nodeid)+'" lat="'+'{:.7f}'.format(latp)+'" lon="'+'{:.7f}'.format(lonp)+'" version="1">\n')
                     for tag in self.dicosmtags['n'][nodeid]:
-                        fout.write('    <tag k="'+tag+'" v="'+self.dicosmtags['n'][nodeid][tag]+'"/>\n')
+                        fout.write('    <tag k='+quoteattr(tag)+' v='+quoteattr(self.dicosmtags['n'][nodeid][tag])+'/>\n')
                     fout.write('  </node>\n')
-        for wayid in tuple(self.dicosmfirst['w'])+tuple(set(self.dicosmw).difference(self.dicosmfirst['w'])):
+        for wayid in tuple(self.dicosmfirst['w'])+tuple(set(self.way_ids()).difference(self.dicosmfirst['w'])):
             fout.write('  <way id="'+str(wayid)+'" version="1">\n')
-            for nodeid in self.dicosmw[wayid]:
+            for nodeid in self.way_nodes(wayid):
                 fout.write('    <nd ref="'+str(nodeid)+'"/>\n')
             for tag in self.dicosmtags['w'][wayid] if wayid in self.dicosmtags['w'] else []:
-                fout.write('    <tag k="'+tag+'" v="'+self.dicosmtags['w'][wayid][tag]+'"/>\n')
+                fout.write('    <tag k='+quoteattr(tag)+' v='+quoteattr(self.dicosmtags['w'][wayid][tag])+'/>\n')
             fout.write('  </way>\n')
         for relid in tuple(self.dicosmfirst['r'])+tuple(set(self.dicosmrorig).difference(self.dicosmfirst['r'])):
             fout.write('  <relation id="'+str(relid)+'" version="1">\n')
@@ -256,11 +369,121 @@ class OSM_layer():
             for wayid in self.dicosmrorig[relid]['inner']:
                 fout.write('    <member type="way" ref="'+str(wayid)+'" role="inner"/>\n')
             for tag in self.dicosmtags['r'][relid] if relid in self.dicosmtags['r'] else []:
-                fout.write('    <tag k="'+tag+'" v="'+self.dicosmtags['r'][relid][tag]+'"/>\n')
+                fout.write('    <tag k='+quoteattr(tag)+' v='+quoteattr(self.dicosmtags['r'][relid][tag])+'/>\n')
             fout.write('  </relation>\n')
         fout.write('</osm>')
         fout.close()    
         return 1
+
+    def write_to_binary_file(self,filename,cache_key):
+        # cache_key is checked at reading time, so that the file is only used for the 
+        # same queries (and tags) as those it was built from  
+        nb_ways=-1-self.next_way_id
+        if self.compact:
+            node_coords=self.node_coords[:-1-self.next_node_id]
+            way_offsets=self.way_offsets[:nb_ways+1]
+            way_rows=self.way_rows[:way_offsets[-1]]
+        else:
+            node_coords=numpy.array([self.dicosmn[nodeid] for nodeid in range(-1,self.next_node_id,-1)],dtype=numpy.float64).reshape((-1,2))
+            way_offsets=numpy.zeros(nb_ways+1,dtype=numpy.int64)
+            numpy.cumsum([len(self.dicosmw[wayid]) for wayid in range(-1,self.next_way_id,-1)],dtype=numpy.int64,out=way_offsets[1:])
+            way_rows=-1-numpy.array([nodeid for wayid in range(-1,self.next_way_id,-1) for nodeid in self.dicosmw[wayid]],dtype=numpy.int64)
+        arrays={'node_coords':node_coords,'way_offsets':way_offsets,'way_rows':way_rows}
+        # relations : rings and original member ways, with the index of their relation and their role
+        rel_ids=list(self.dicosmr)
+        (rings,ring_info,members)=([],[],[])
+        for (i,relid) in enumerate(rel_ids):
+            for (r,role) in enumerate(['outer','inner']):
+                for nodeids in self.dicosmr[relid][role]:
+                    rings.append(numpy.asarray(nodeids,dtype=numpy.int64))
+                    ring_info.append((i,r))
+                members.extend((i,r,wayid) for wayid in self.dicosmrorig[relid][role])
+        arrays['rel_ids']=numpy.array(rel_ids,dtype=numpy.int64)
+        arrays['ring_info']=numpy.array(ring_info,dtype=numpy.int64).reshape((-1,2))
+        arrays['ring_offsets']=numpy.cumsum([0]+[len(ring) for ring in rings],dtype=numpy.int64)
+        arrays['ring_nodes']=numpy.concatenate(rings) if rings else numpy.zeros(0,dtype=numpy.int64)
+        arrays['members']=numpy.array(members,dtype=numpy.int64).reshape((-1,3))
+        # tags : keys and values as indices in a table of strings
+        strings={}
+        for osmtype in ['n','w','r']:
+            tags=self.dicosmtags[osmtype]
+            key_values=[(strings.setdefault(k,len(strings)),strings.setdefault(v,len(strings))) for osmid in tags for (k,v) in tags[osmid].items()]
+            arrays['first_'+osmtype]=numpy.array(list(self.dicosmfirst[osmtype]),dtype=numpy.int64)
+            arrays['tags_'+osmtype+'_ids']=numpy.array(list(tags),dtype=numpy.int64)
+            arrays['tags_'+osmtype+'_offsets']=numpy.cumsum([0]+[len(tags[osmid]) for osmid in tags],dtype=numpy.int64)
+            arrays['tags_'+osmtype+'_kv']=numpy.array(key_values,dtype=numpy.int32).reshape((-1,2))
+        # NUL is not allowed in XML, hence in tags 
+        arrays['strings']=numpy.frombuffer('\0'.join(strings).encode('utf-8'),dtype=numpy.uint8)
+        header={'version':o4osm_version,'key':cache_key,'next_ids':[self.next_node_id,self.next_way_id,self.next_rel_id],'arrays':{}}
+        offset=0
+        for (name,array) in arrays.items():
+            header['arrays'][name]=[array.dtype.str,array.shape,offset]
+            offset+=-(-array.nbytes//64)*64
+        header=json.dumps(header).encode()
+        try:
+            with open(filename+'.tmp','wb') as f:
+                f.write(o4osm_magic+len(header).to_bytes(8,'little')+header)
+                for array in arrays.values():
+                    f.seek(-(-f.tell()//64)*64)
+                    f.write(numpy.ascontiguousarray(array).tobytes())
+            os.replace(filename+'.tmp',filename)
+        except Exception as e:
+            UI.vprint(1,"    Could not write",filename,":",e)
+            return 0
+        return 1
+
+    def read_binary_file(self,filename,cache_key):
+        # only into an empty layer, returns 0 if the file is missing, outdated or built for other queries
+        if (self.next_node_id,self.next_way_id,self.next_rel_id)!=(-1,-1,-1): return 0
+        try:
+            with open(filename,'rb') as f:
+                if f.read(len(o4osm_magic))!=o4osm_magic: return 0
+                header_size=int.from_bytes(f.read(8),'little')
+                header=json.loads(f.read(header_size).decode())
+                data_start=-(-f.tell()//64)*64
+            if header['version']!=o4osm_version or header['key']!=cache_key: return 0
+            arrays={}
+            for (name,(dtype,shape,offset)) in header['arrays'].items():
+                # copy-on-write : compact layers can still be extended 
+                arrays[name]=numpy.memmap(filename,dtype=dtype,mode='c',offset=data_start+offset,shape=tuple(shape))\
+                        if numpy.prod(shape) else numpy.zeros(shape,dtype=dtype)
+        except Exception as e:
+            UI.vprint(2,"    Could not read",filename,":",e)
+            return 0
+        (self.next_node_id,self.next_way_id,self.next_rel_id)=header['next_ids']
+        if self.compact:
+            (self.node_coords,self.way_offsets,self.way_rows)=(arrays['node_coords'],arrays['way_offsets'],arrays['way_rows'])
+        else:
+            self.dicosmn.update(zip(range(-1,self.next_node_id,-1),map(tuple,arrays['node_coords'].tolist())))
+            self.dicosmn_reverse.update(zip(self.dicosmn.values(),self.dicosmn))
+            (way_nodes,way_offsets)=((-1-arrays['way_rows']).tolist(),arrays['way_offsets'].tolist())
+            for k in range(-1-self.next_way_id):
+                self.dicosmw[-1-k]=way_nodes[way_offsets[k]:way_offsets[k+1]]
+        rel_ids=arrays['rel_ids'].tolist()
+        for relid in rel_ids:
+            self.dicosmr[relid]={'outer':[],'inner':[]}
+            self.dicosmrorig[relid]={'outer':[],'inner':[]}
+        ring_offsets=arrays['ring_offsets'].tolist()
+        for ((i,r),start,end) in zip(arrays['ring_info'].tolist(),ring_offsets[:-1],ring_offsets[1:]):
+            ring=arrays['ring_nodes'][start:end]
+            self.dicosmr[rel_ids[i]]['outer' if r==0 else 'inner'].append(numpy.array(ring) if self.compact else ring.tolist())
+        for (i,r,wayid) in arrays['members'].tolist():
+            self.dicosmrorig[rel_ids[i]]['outer' if r==0 else 'inner'].append(wayid)
+        strings=arrays['strings'].tobytes().decode('utf-8').split('\0')
+        for osmtype in ['n','w','r']:
+            self.dicosmfirst[osmtype].update(arrays['first_'+osmtype].tolist())
+            (key_values,tags_offsets)=(arrays['tags_'+osmtype+'_kv'].tolist(),arrays['tags_'+osmtype+'_offsets'].tolist())
+            for (osmid,start,end) in zip(arrays['tags_'+osmtype+'_ids'].tolist(),tags_offsets[:-1],tags_offsets[1:]):
+                self.dicosmtags[osmtype][osmid]={strings[k]:strings[v] for (k,v) in key_values[start:end]}
+        return 1
+##############################################################################
+
+##############################################################################
+def grown(array):
+    # growable arrays of the compact mode double their capacity when full
+    new_array=numpy.empty((max(2*len(array),1024),)+array.shape[1:],dtype=array.dtype)
+    new_array[:len(array)]=array
+    return new_array
 ##############################################################################
 
 ##############################################################################
@@ -285,27 +508,65 @@ def OSM_queries_to_OSM_layer(queries,osm_layer,lat,lon,tags_of_interest=[],serve
                 else:
                     if tag not in target_tags[osm_type]:target_tags[osm_type].append(tag)
     cached_data_filename=FNAMES.osm_cached(lat, lon, cached_suffix)
+    binary_cached_filename=FNAMES.osm_binary_cached(lat, lon, cached_suffix)
+    cache_key=json.dumps([queries,tags_of_interest])
+    if cached_suffix and osm_binary_cache and os.path.isfile(binary_cached_filename):
+        # the XML data remains the reference (it can have been edited in JOSM) 
+        if not os.path.isfile(cached_data_filename) or os.path.getmtime(cached_data_filename)<=os.path.getmtime(binary_cached_filename):
+            if osm_layer.read_binary_file(binary_cached_filename,cache_key):
+                UI.vprint(1,"    * Recycling OSM data from",binary_cached_filename)
+                return 1
     if cached_suffix and os.path.isfile(cached_data_filename):
         UI.vprint(1,"    * Recycling OSM data from",cached_data_filename)
-        return osm_layer.update_dicosm(cached_data_filename,input_tags,target_tags)
+        if not osm_layer.update_dicosm(cached_data_filename,input_tags,target_tags): return 0
+        if osm_binary_cache: osm_layer.write_to_binary_file(binary_cached_filename,cache_key)
+        return 1
+    # queries on indexed keys are answered by a local extract covering the tile, if any
+    index=PBF.tile_extract(osm_extract_dir,lat,lon) if osm_extract_dir else None
+    if UI.red_flag: return 0
+    if index and any(PBF.answers(index,query) for query in queries):
+        extract_queries=[query for query in queries if PBF.answers(index,query)]
+        UI.vprint(1,"    * Extracting OSM data from",index['name'],"for",', '.join(str(query) for query in extract_queries))
+        if not osm_layer.update_dicosm(PBF.extract_elements(index,lat,lon,extract_queries),input_tags,target_tags): return 0
+        queries=[query for query in queries if query not in extract_queries]
+    # look first for cached data (old scheme), the other queries are gathered in
+    # groups downloaded concurrently, and everything is parsed in the queries order
+    jobs=[]
     for query in queries:
-        # look first for cached data (old scheme)
         if isinstance(query,str):
             old_cached_data_filename=FNAMES.osm_old_cached(lat, lon, query)
             if os.path.isfile(old_cached_data_filename):
-                UI.vprint(1,"    * Recycling OSM data for",query)
-                osm_layer.update_dicosm(old_cached_data_filename,input_tags,target_tags)
+                jobs.append((query,old_cached_data_filename))
+            elif jobs and isinstance(jobs[-1],list) and isinstance(jobs[-1][0],str) and len(jobs[-1])<max_union_queries:
+                jobs[-1].append(query)
+            else:
+                jobs.append([query])
+        else: # query is a tuple, already a union
+            jobs.append([query])
+    executor=ThreadPoolExecutor(max_workers=max_overpass_threads)
+    futures=[executor.submit(get_overpass_union_data,job,(lat,lon,lat+1,lon+1),server_code) if isinstance(job,list) else None for job in jobs]
+    try:
+        for (job,future) in zip(jobs,futures):
+            if not future:
+                UI.vprint(1,"    * Recycling OSM data for",job[0])
+                osm_layer.update_dicosm(job[1],input_tags,target_tags)
                 continue
-        UI.vprint(1,"    * Downloading OSM data for",query)        
-        response=get_overpass_data(query,(lat,lon,lat+1,lon+1),server_code)
-        if UI.red_flag: return 0
-        if not response: 
-           UI.logprint("No valid answer for",query,"after",max_osm_tentatives,", skipping it.") 
-           UI.vprint(1,"      No valid answer after",max_osm_tentatives,", skipping it.")
-           return 0
-        osm_layer.update_dicosm(response,input_tags,target_tags)
+            UI.vprint(1,"    * Downloading OSM data for",', '.join(str(query) for query in job))        
+            while not wait([future],timeout=1)[0]:
+                if UI.red_flag: return 0
+            responses=future.result()
+            if UI.red_flag: return 0
+            if not responses: 
+               UI.logprint("No valid answer for",job,"after",max_osm_tentatives,", skipping it.") 
+               UI.vprint(1,"      No valid answer after",max_osm_tentatives,", skipping it.")
+               return 0
+            for response in responses:
+                osm_layer.update_dicosm(response,input_tags,target_tags)
+    finally:
+        executor.shutdown(wait=False,cancel_futures=True)
     if cached_suffix: 
         osm_layer.write_to_file(cached_data_filename)
+        if osm_binary_cache: osm_layer.write_to_binary_file(binary_cached_filename,cache_key)
     return 1
 ##############################################################################
 
@@ -344,40 +605,130 @@ def OSM_query_to_OSM_layer(query,bbox,osm_layer,tags_of_interest=[],server_code=
 
 
 ##############################################################################
-def get_overpass_data(query,bbox,server_code=None):
+# Overpass client : each server has a long-lived http session and a token bucket
+# limiting the rate of requests sent to it. A server which answers 429 (too many
+# requests) or 504 (overloaded), or fails, has its bucket emptied for a delay 
+# growing with the number of tentatives. Requests go to the server with the 
+# earliest available token (in order of preference), hence fail over to another
+# server at once, and concurrent ones are spread among servers.
+overpass_sessions={}
+overpass_sessions_lock=threading.Lock()
+
+class TokenBucket():
+    def __init__(self,rate,burst):
+        (self.rate,self.burst)=(rate,burst)
+        self.tokens=burst
+        # monotonic : a clock adjustment must neither stall nor burst the servers
+        self.timer=time.monotonic()
+        self.lock=threading.Lock()
+
+    def refill(self):
+        now=time.monotonic()
+        self.tokens=min(self.burst,self.tokens+(now-self.timer)*self.rate)
+        self.timer=now
+
+    def available_in(self):
+        with self.lock:
+            self.refill()
+            return max(0,(1-self.tokens)/self.rate)
+
+    def take(self):
+        # waits for a token, returns 0 if interrupted
+        while not UI.red_flag:
+            with self.lock:
+                self.refill()
+                if self.tokens>=1:
+                    self.tokens-=1
+                    return 1
+                delay=(1-self.tokens)/self.rate
+            time.sleep(min(delay,1))
+        return 0
+
+    def hold(self,delay):
+        # no token for delay seconds
+        with self.lock:
+            self.refill()
+            self.tokens=min(self.tokens,1-delay*self.rate)
+##############################################################################
+
+##############################################################################
+def overpass_session(server_code):
+    with overpass_sessions_lock:
+        if server_code not in overpass_sessions:
+            overpass_sessions[server_code]=(requests.Session(),TokenBucket(overpass_rate,overpass_burst))
+        return overpass_sessions[server_code]
+##############################################################################
+
+##############################################################################
+def get_overpass_data(query,bbox,server_code=None,error_is_final=False):
+    # returns the answer, 0 if none was valid after max_osm_tentatives, or None 
+    # at once for an error answer (e.g. data too big) if error_is_final
+    if isinstance(query,str):
+        overpass_query=query+str(bbox)+";"
+    else: # query is a tuple 
+        overpass_query=''.join([x+str(bbox)+";" for x in query])
+    if server_code:
+        server_codes=[server_code]
+    elif overpass_server_choice=='random':
+        server_codes=random.sample(list(overpass_servers),len(overpass_servers))
+    else:
+        server_codes=[overpass_server_choice]+[x for x in overpass_servers if x!=overpass_server_choice]
     tentative=1
     while True:
-        s=requests.Session()
-        true_server_code = server_code
-        if not server_code:
-           true_server_code = random.choice(list(overpass_servers.keys())) if overpass_server_choice=='random' else overpass_server_choice
-        base_url=overpass_servers[true_server_code]
-        if isinstance(query,str):
-            overpass_query=query+str(bbox)+";"
-        else: # query is a tuple 
-            overpass_query=''.join([x+str(bbox)+";" for x in query])
-        url=base_url+"?data=("+overpass_query+");(._;>>;);out meta;"
+        # min keeps the first of equals, i.e. the preferred server
+        true_server_code=min(server_codes,key=lambda x: overpass_session(x)[1].available_in())
+        (session,bucket)=overpass_session(true_server_code)
+        if not bucket.take(): return 0
+        url=overpass_servers[true_server_code]+"?data=("+overpass_query+");(._;>>;);out meta;"
         UI.vprint(3,url)
+        delay=2**tentative
         try:
-            r=s.get(url,timeout=60)
-            UI.vprint(3,"OSM response status :",r)
-            if '200' in str(r):
-                if b"</osm>" not in r.content[-10:] and b"</OSM>" not in r.content[-10:]:
-                    UI.vprint(1,"        OSM server",true_server_code,"sent a corrupted answer (no closing </osm> tag in answer), new tentative in",2**tentative,"sec...")
-                elif len(r.content)<=1000 and b"error" in r.content: 
-                    UI.vprint(1,"        OSM server",true_server_code,"sent us an error code for the data (data too big ?), new tentative in",2**tentative,"sec...")
+            with session.get(url,timeout=60,stream=True) as r:
+                UI.vprint(3,"OSM response status :",r)
+                if r.status_code==200:
+                    # streamed so that a stop is honoured during long downloads, the
+                    # answer is still kept whole : it is checked before being parsed
+                    # and parsed later in the queries order
+                    chunks=[]
+                    for chunk in r.iter_content(chunk_size=1048576):
+                        if UI.red_flag: return 0
+                        chunks.append(chunk)
+                    content=b''.join(chunks)
+                    if b"</osm>" not in content[-10:] and b"</OSM>" not in content[-10:]:
+                        UI.vprint(1,"        OSM server",true_server_code,"sent a corrupted answer (no closing </osm> tag in answer), new tentative...")
+                    elif len(content)<=1000 and b"error" in content: 
+                        UI.vprint(1,"        OSM server",true_server_code,"sent us an error code for the data (data too big ?)"+(", new tentative..." if not error_is_final else "."))
+                        if error_is_final: return None
+                    else:
+                        return content
+                elif r.status_code in (429,504):
+                    UI.vprint(1,"        OSM server",true_server_code,"is overloaded ("+str(r.status_code)+"), new tentative...")
+                    try: delay=max(delay,float(r.headers['Retry-After']))
+                    except: pass
                 else:
-                    break
-            else:
-                UI.vprint(1,"        OSM server",true_server_code,"rejected our query, new tentative in",2**tentative,"sec...")
+                    UI.vprint(1,"        OSM server",true_server_code,"rejected our query, new tentative...")
         except:
-            UI.vprint(1,"        OSM server",true_server_code,"was too busy, new tentative in",2**tentative,"sec...")
+            UI.vprint(1,"        OSM server",true_server_code,"was too busy, new tentative...")
+        bucket.hold(delay)
         if tentative>=max_osm_tentatives:
             return 0
         if UI.red_flag: return 0
-        time.sleep(2**tentative)
         tentative+=1           
-    return r.content
+##############################################################################
+
+##############################################################################
+def get_overpass_union_data(queries,bbox,server_code=None):
+    # list of answers : one for the union of the queries, or one per query if the
+    # server finds the union too big 
+    if len(queries)==1:
+        response=get_overpass_data(queries[0],bbox,server_code)
+        return [response] if response else 0
+    response=get_overpass_data(tuple(queries),bbox,server_code,error_is_final=True)
+    if response is not None:
+        return [response] if response else 0
+    UI.vprint(1,"        Splitting the union of",len(queries),"queries.")
+    responses=[get_overpass_data(query,bbox,server_code) for query in queries]
+    return responses if all(responses) else 0
 ##############################################################################
 
 ##############################################################################
@@ -394,7 +745,7 @@ def OSM_to_MultiLineString(osm_layer,lat,lon,tags_for_exclusion=set(),filter=Non
           and not set(osm_layer.dicosmtags['w'][wayid].keys()).isdisjoint(tags_for_exclusion):
             done+=1
             continue  
-        way=numpy.round(numpy.array([osm_layer.dicosmn[nodeid] for nodeid in osm_layer.dicosmw[wayid]],dtype=numpy.float64)-numpy.array([[lon,lat]],dtype=numpy.float64),7) 
+        way=numpy.round(osm_layer.way_lonlat(wayid)-numpy.array([[lon,lat]],dtype=numpy.float64),7) 
         if filter and not filter(way,filtered_segs):
             try:
                 multiline_reject.append(geometry.LineString(way))
@@ -425,16 +776,17 @@ def OSM_to_MultiPolygon(osm_layer,lat,lon,filter=None):
     done=0
     for wayid in osm_layer.dicosmfirst['w']:
         if done%step==0: UI.progress_bar(1,int(100*done/todo))
-        if osm_layer.dicosmw[wayid][0]!=osm_layer.dicosmw[wayid][-1]: 
-            UI.logprint("Non closed way starting at",osm_layer.dicosmn[osm_layer.dicosmw[wayid][0]],", skipped.")
+        nodeids=osm_layer.way_nodes(wayid)
+        if nodeids[0]!=nodeids[-1]: 
+            UI.logprint("Non closed way starting at",osm_layer.node_lonlat(nodeids[0]),", skipped.")
             done+=1
             continue
-        way=numpy.round(numpy.array([osm_layer.dicosmn[nodeid] for nodeid in osm_layer.dicosmw[wayid]],dtype=numpy.float64)-numpy.array([[lon,lat]],dtype=numpy.float64),7) 
+        way=numpy.round(osm_layer.way_lonlat(wayid)-numpy.array([[lon,lat]],dtype=numpy.float64),7) 
         try:
             pol=geometry.Polygon(way)
             if not pol.area: continue
             if not pol.is_valid:
-                UI.logprint("Invalid OSM way starting at",osm_layer.dicosmn[osm_layer.dicosmw[wayid][0]],", skipped.")
+                UI.logprint("Invalid OSM way starting at",osm_layer.node_lonlat(nodeids[0]),", skipped.")
                 done+=1
                 continue
         except Exception as e:
@@ -449,12 +801,10 @@ def OSM_to_MultiPolygon(osm_layer,lat,lon,filter=None):
     for relid in osm_layer.dicosmfirst['r']:
         if done%step==0: UI.progress_bar(1,int(100*done/todo))
         try:
-            multiout=[geometry.Polygon(numpy.round(numpy.array([osm_layer.dicosmn[nodeid] \
-                                        for nodeid in nodelist],dtype=numpy.float64)-numpy.array([lon,lat],dtype=numpy.float64),7))\
+            multiout=[geometry.Polygon(numpy.round(osm_layer.nodes_lonlat(nodelist)-numpy.array([lon,lat],dtype=numpy.float64),7))\
                                         for nodelist in osm_layer.dicosmr[relid]['outer']]
             multiout=ops.cascaded_union([geom for geom in multiout if geom.is_valid])
-            multiin=[geometry.Polygon(numpy.round(numpy.array([osm_layer.dicosmn[nodeid]\
-                                        for nodeid in nodelist],dtype=numpy.float64)-numpy.array([lon,lat],dtype=numpy.float64),7))\
+            multiin=[geometry.Polygon(numpy.round(osm_layer.nodes_lonlat(nodelist)-numpy.array([lon,lat],dtype=numpy.float64),7))\
                                         for nodelist in osm_layer.dicosmr[relid]['inner']]
             multiin=ops.cascaded_union([geom for geom in multiin if geom.is_valid])
         except Exception as e:
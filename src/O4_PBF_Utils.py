@@ -0,0 +1,768 @@
+import os
+import re
+import zlib
+import json
+import shutil
+import time
+import threading
+from array import array
+import numpy
+from shapely import geometry, ops
+import O4_UI_Utils as UI
+import O4_File_Names as FNAMES
+
+##############################################################################
+# Offline OSM source : local .osm.pbf extracts (Geofabrik regions, planet subsets)
+# are indexed once into OSM_data/Extract_index/<name>, with one file per 1x1 deg
+# tile, osm type and tag key (e.g. +45+006_w_highway.npz for the ways tagged
+# highway=* which go through the tile). Such a file holds these elements with all
+# their tags, and what is needed to rebuild them (nodes of the ways, member ways
+# of the relations and their nodes), so that the Overpass like queries of
+# O4_OSM_Utils ('way["highway"="primary"]') are answered from the files of the
+# tile only.
+##############################################################################
+
+# tag keys for which the elements are indexed, those queried by O4_Vector_Map
+indexed_keys=('aeroway','highway','natural','railway','waterway')
+index_version=1
+# seconds after which the lock of an index build which is not refreshed is stale
+lock_timeout=300
+osm_types={'node':'n','way':'w','rel':'r'}
+query_pattern=re.compile(r'^(node|way|rel)\["([^"]+)"(?:="([^"]*)")?\]$')
+# parsed .poly files by (name, mtime), and extracts without one already reported
+coverages={}
+no_coverage=set()
+
+##############################################################################
+# Minimal protobuf decoding : messages are read field by field, packed repeated
+# varints at once with numpy when they can be long (node ids, coordinates, refs).
+def varint(buf,pos):
+    result=shift=0
+    while True:
+        b=buf[pos]
+        pos+=1
+        result|=(b&0x7f)<<shift
+        if b<0x80: return (result,pos)
+        shift+=7
+
+def signed(value):
+    # int64 encoded as a varint
+    return value-(1<<64) if value>=(1<<63) else value
+
+def zigzag(value):
+    # sint64
+    return (value>>1)^-(value&1)
+
+def fields(buf):
+    # yields (field number, value), value being an int for varints and a memoryview
+    # for length delimited fields (fixed size ones are not used by the OSM format)
+    pos=0
+    end=len(buf)
+    while pos<end:
+        (key,pos)=varint(buf,pos)
+        wire_type=key&7
+        if wire_type==0:
+            (value,pos)=varint(buf,pos)
+        elif wire_type==2:
+            (length,pos)=varint(buf,pos)
+            value=buf[pos:pos+length]
+            pos+=length
+        elif wire_type==1:
+            pos+=8
+            continue
+        elif wire_type==5:
+            pos+=4
+            continue
+        else:
+            raise ValueError("unsupported protobuf wire type "+str(wire_type))
+        yield (key>>3,value)
+
+def unpacked(buf):
+    # list of the varints of a short packed field
+    (values,pos)=([],0)
+    while pos<len(buf):
+        (value,pos)=varint(buf,pos)
+        values.append(value)
+    return values
+
+def packed_varints(buf):
+    # uint64 array of the varints of a packed field
+    b=numpy.frombuffer(buf,dtype=numpy.uint8)
+    ends=numpy.flatnonzero(b<0x80)
+    if not len(ends): return numpy.zeros(0,dtype=numpy.uint64)
+    b=b[:ends[-1]+1]
+    starts=numpy.empty(len(ends),dtype=numpy.int64)
+    starts[0]=0
+    starts[1:]=ends[:-1]+1
+    shifts=(7*(numpy.arange(len(b))-numpy.repeat(starts,ends-starts+1))).astype(numpy.uint64)
+    return numpy.bitwise_or.reduceat((b&0x7f).astype(numpy.uint64)<<shifts,starts)
+
+def packed_sint64(buf,delta=False):
+    values=packed_varints(buf)
+    values=(values>>numpy.uint64(1)).astype(numpy.int64)^-(values&numpy.uint64(1)).astype(numpy.int64)
+    return numpy.cumsum(values) if delta else values
+
+def packed_sint64_deltas(buffers):
+    # delta coded packed fields decoded at once : concatenated values, and number of values of each
+    data=b''.join(buffers)
+    ends=numpy.flatnonzero(numpy.frombuffer(data,dtype=numpy.uint8)<0x80)
+    lengths=numpy.diff(numpy.searchsorted(ends,numpy.cumsum([0]+[len(buf) for buf in buffers])))
+    values=numpy.cumsum(packed_sint64(data))
+    # the sums restart with each field
+    before=numpy.concatenate(([0],values))[numpy.cumsum(lengths)-lengths]
+    return (values-numpy.repeat(before,lengths),lengths)
+##############################################################################
+
+##############################################################################
+def read_blobs(pbf_file,offsets=None):
+    # yields the offset, type ('OSMHeader' or 'OSMData') and decompressed content of the 
+    # blobs of the file (or of those at the given offsets only), and the fraction done
+    size=os.path.getsize(pbf_file)
+    with open(pbf_file,'rb') as f:
+        k=0
+        while True:
+            if offsets is not None:
+                if k==len(offsets): return
+                f.seek(offsets[k])
+                k+=1
+            offset=f.tell()
+            header_size=f.read(4)
+            if len(header_size)<4: return
+            header=dict(fields(memoryview(f.read(int.from_bytes(header_size,'big')))))
+            blob=dict(fields(memoryview(f.read(header[3]))))
+            if 1 in blob:
+                data=blob[1]
+            elif 3 in blob:
+                data=memoryview(zlib.decompress(blob[3]))
+            else:
+                raise ValueError("unsupported blob compression (only zlib is)")
+            yield (offset,bytes(header[1]).decode(),data,k/len(offsets) if offsets is not None else f.tell()/size)
+##############################################################################
+def header_bbox(data):
+    # (left,bottom,right,top) in degrees of a HeaderBlock, or None
+    bbox=None
+    for (field,value) in fields(data):
+        if field==1:
+            box=dict(fields(value))
+            bbox=[zigzag(box.get(i,0))/1e9 for i in (1,4,2,3)]
+        elif field==4 and bytes(value).decode() not in ('OsmSchema-V0.6','DenseNodes'):
+            raise ValueError("unsupported required feature "+bytes(value).decode())
+    return bbox
+##############################################################################
+
+##############################################################################
+class Block():
+    # a PrimitiveBlock : string table, primitive groups, and the conversion of its
+    # coordinates to integers in 1e-7 deg (those of Overpass answers)
+    def __init__(self,data):
+        (self.strings,self.groups)=([],[])
+        (granularity,self.lat_offset,self.lon_offset)=(100,0,0)
+        for (field,value) in fields(data):
+            if field==1:
+                self.strings=[bytes(s).decode('utf-8') for (_,s) in fields(value)]
+            elif field==2:
+                self.groups.append(value)
+            elif field==17:
+                granularity=value
+            elif field==19:
+                self.lat_offset=signed(value)
+            elif field==20:
+                self.lon_offset=signed(value)
+        self.granularity=granularity
+        self.key_ids=set(i for (i,s) in enumerate(self.strings) if s in indexed_keys)
+
+    def group_type(self,group):
+        # groups only contain one kind of primitives : 1 nodes, 2 dense nodes, 3 ways, 4 relations
+        return varint(group,0)[0]>>3 if len(group) else 0
+
+    def coords(self,lons,lats):
+        # (n,2) int64 array of (lon,lat) in 1e-7 deg
+        return numpy.column_stack(((self.lon_offset+self.granularity*numpy.asarray(lons,dtype=numpy.int64)+50)//100,
+                                   (self.lat_offset+self.granularity*numpy.asarray(lats,dtype=numpy.int64)+50)//100))
+
+    def tags(self,keys,vals,strings):
+        # flat list of the key and value of each tag, as indices in the common table strings
+        return [strings.setdefault(self.strings[i],len(strings)) for kv in zip(keys,vals) for i in kv]
+##############################################################################
+
+##############################################################################
+class Elements():
+    # osm elements of one type kept by the indexing, in arrays of the array module:
+    # ids, a list of ints per element (coordinates of nodes, node refs of ways, member
+    # ways of relations along with their roles), codes of the tiles they go through,
+    # and tags (key, value, key, value, ...) as indices in a common table of strings
+    def __init__(self):
+        self.ids=array('q')
+        (self.item_offsets,self.items,self.roles)=(array('q',[0]),array('q'),array('q'))
+        (self.tile_offsets,self.tiles)=(array('q',[0]),array('q'))
+        (self.tag_offsets,self.tags)=(array('q',[0]),array('q'))
+
+    def add(self,osmid,items,tiles,tags,roles=()):
+        self.ids.append(osmid)
+        self.items.frombytes(numpy.asarray(items,dtype=numpy.int64).tobytes())
+        self.item_offsets.append(len(self.items))
+        self.roles.extend(roles)
+        self.tiles.extend(tiles)
+        self.tile_offsets.append(len(self.tiles))
+        self.tags.extend(tags)
+        self.tag_offsets.append(len(self.tags))
+
+    def arrays(self):
+        return {name:numpy.frombuffer(getattr(self,name),dtype=numpy.int64) if len(getattr(self,name)) else numpy.zeros(0,dtype=numpy.int64)
+                for name in ('ids','item_offsets','items','roles','tile_offsets','tiles','tag_offsets','tags')}
+##############################################################################
+
+##############################################################################
+def tile_codes(lonlat):
+    lat=numpy.clip(lonlat[:,1]//10000000,-90,89)
+    lon=numpy.clip(lonlat[:,0]//10000000,-180,179)
+    return (lat+90)*360+lon+180
+
+def code_to_tile(code):
+    return (code//360-90,code%360-180)
+##############################################################################
+
+##############################################################################
+def ways_tiles(lengths,lonlat):
+    # codes of the tiles touched by each way, given the number of nodes of each way
+    # and their coordinates : those of the nodes, and those crossed by a segment 
+    # between two nodes which are not in the same or in neighbouring tiles.
+    # Returns them as offsets (one more than ways) and codes.
+    owners=numpy.repeat(numpy.arange(len(lengths)),lengths)
+    codes=tile_codes(lonlat)
+    pairs=[owners*65536+codes]
+    (lat,lon)=(codes//360,codes%360)
+    far=numpy.flatnonzero((owners[1:]==owners[:-1])&(numpy.abs(lat[1:]-lat[:-1])+numpy.abs(lon[1:]-lon[:-1])>1))
+    extra=[owners[i]*65536+y*360+x for i in far.tolist()
+             for y in range(min(lat[i],lat[i+1]),max(lat[i],lat[i+1])+1)
+             for x in range(min(lon[i],lon[i+1]),max(lon[i],lon[i+1])+1)
+             if segment_in_tile(lonlat[i]/1e7,lonlat[i+1]/1e7,x-180,y-90)]
+    pairs=numpy.unique(numpy.concatenate(pairs+[numpy.array(extra,dtype=numpy.int64)]))
+    return (numpy.searchsorted(pairs//65536,numpy.arange(len(lengths)+1)),pairs%65536)
+##############################################################################
+def segment_in_tile(a,b,lon,lat):
+    # whether the segment [a,b] ((lon,lat) arrays) meets the tile (Liang-Barsky clipping)
+    (t0,t1)=(0,1)
+    (dx,dy)=(b[0]-a[0],b[1]-a[1])
+    for (p,q) in ((-dx,a[0]-lon),(dx,lon+1-a[0]),(-dy,a[1]-lat),(dy,lat+1-a[1])):
+        if p==0:
+            if q<0: return False
+        elif p<0:
+            t0=max(t0,q/p)
+        else:
+            t1=min(t1,q/p)
+    return t0<=t1
+##############################################################################
+
+##############################################################################
+def take(offsets,values,rows):
+    # offsets and values of the given rows of a list of lists stored as (offsets,values)
+    starts=offsets[rows]
+    lengths=offsets[rows+1]-starts
+    new_offsets=numpy.zeros(len(rows)+1,dtype=numpy.int64)
+    numpy.cumsum(lengths,out=new_offsets[1:])
+    return (new_offsets,values[numpy.repeat(starts-new_offsets[:-1],lengths)+numpy.arange(new_offsets[-1])])
+##############################################################################
+
+##############################################################################
+def build_index(pbf_file,index_dir):
+    UI.vprint(1,"    * Indexing",pbf_file,"(once for all, it can take a while).")
+    source=[os.path.getsize(pbf_file),os.path.getmtime(pbf_file)]
+    strings={}
+    (nodes,ways,rels)=(Elements(),Elements(),Elements())
+    # Only the nodes needed are stored, hence three passes in reverse order of the
+    # file : relations of interest, ways of interest (tagged or members of these 
+    # relations) and finally nodes (those of these ways, and tagged ones). The 
+    # first one also notes which blobs contain ways and nodes.
+    (way_blobs,node_blobs)=([],[])
+    bbox=None
+    for (offset,blob_type,data,progress) in read_blobs(pbf_file):
+        if UI.red_flag: return 0
+        UI.progress_bar(1,int(40*progress))
+        if blob_type=='OSMHeader':
+            bbox=header_bbox(data)
+            continue
+        block=Block(data)
+        group_types=set(block.group_type(group) for group in block.groups)
+        if 3 in group_types: way_blobs.append(offset)
+        if 1 in group_types or 2 in group_types: node_blobs.append(offset)
+        if 4 not in group_types or not block.key_ids: continue
+        for group in block.groups:
+            if block.group_type(group)!=4: continue
+            for (field,message) in fields(group):
+                if field!=4: continue
+                (osmid,keys,vals,roles,memids,types)=(0,[],[],[],[],[])
+                for (subfield,value) in fields(message):
+                    if subfield==1: osmid=signed(value)
+                    elif subfield==2: keys=unpacked(value)
+                    elif subfield==3: vals=unpacked(value)
+                    elif subfield==8: roles=unpacked(value)
+                    elif subfield==9: memids=packed_sint64(value,delta=True).tolist()
+                    elif subfield==10: types=unpacked(value)
+                if not block.key_ids.intersection(keys): continue
+                # only ways of role outer or inner are used by O4_OSM_Utils
+                members=[(ref,block.strings[role]) for (ref,role,member_type) in zip(memids,roles,types)
+                            if member_type==1 and block.strings[role] in ('outer','inner')]
+                rels.add(osmid,[ref for (ref,_) in members],[],block.tags(keys,vals,strings),
+                         [strings.setdefault(role,len(strings)) for (_,role) in members])
+    if not node_blobs:
+        UI.lvprint(0,"ERROR: no OSM node found in",pbf_file)
+        return 0
+    member_ids=set(rels.items)
+    for (_,_,data,progress) in read_blobs(pbf_file,way_blobs):
+        if UI.red_flag: return 0
+        UI.progress_bar(1,40+int(30*progress))
+        block=Block(data)
+        for group in block.groups:
+            if block.group_type(group)!=3: continue
+            kept=[]
+            for (field,message) in fields(group):
+                if field!=3: continue
+                (osmid,keys,vals,refs)=(0,[],[],None)
+                for (subfield,value) in fields(message):
+                    if subfield==1: osmid=signed(value)
+                    elif subfield==2: keys=unpacked(value)
+                    elif subfield==3: vals=unpacked(value)
+                    elif subfield==8: refs=value
+                if refs is None or not (block.key_ids.intersection(keys) or osmid in member_ids): continue
+                kept.append((osmid,refs,block.tags(keys,vals,strings)))
+            if not kept: continue
+            (refs,lengths)=packed_sint64_deltas([way_refs for (_,way_refs,_) in kept])
+            offsets=numpy.concatenate(([0],numpy.cumsum(lengths)))
+            for ((osmid,_,tags),start,end) in zip(kept,offsets[:-1].tolist(),offsets[1:].tolist()):
+                ways.add(osmid,refs[start:end],[],tags)
+    way_arrays=ways.arrays()
+    del(ways)
+    needed=numpy.unique(way_arrays['items'])
+    needed_coords=numpy.zeros((len(needed),2),dtype=numpy.int32)
+    found=numpy.zeros(len(needed),dtype=bool)
+    def store_coords(ids,lonlat):
+        if not len(needed): return
+        rows=numpy.minimum(numpy.searchsorted(needed,ids),len(needed)-1)
+        hits=needed[rows]==ids
+        needed_coords[rows[hits]]=lonlat[hits]
+        found[rows[hits]]=True
+    for (_,_,data,progress) in read_blobs(pbf_file,node_blobs):
+        if UI.red_flag: return 0
+        UI.progress_bar(1,70+int(20*progress))
+        block=Block(data)
+        for group in block.groups:
+            if block.group_type(group) not in (1,2): continue
+            for (field,message) in fields(group):
+                if field==2:
+                    (ids,lats,lons,keys_vals)=(None,None,None,numpy.zeros(0,dtype=numpy.int64))
+                    for (subfield,value) in fields(message):
+                        if subfield==1: ids=packed_sint64(value,delta=True)
+                        elif subfield==8: lats=packed_sint64(value,delta=True)
+                        elif subfield==9: lons=packed_sint64(value,delta=True)
+                        elif subfield==10: keys_vals=packed_varints(value).astype(numpy.int64)
+                    if ids is None: continue
+                    lonlat=block.coords(lons,lats)
+                    store_coords(ids,lonlat)
+                    if not len(keys_vals) or not block.key_ids: continue
+                    # keys_vals is made of the keys and values of each node followed by a 0
+                    ends=numpy.flatnonzero(keys_vals==0)
+                    starts=numpy.concatenate(([0],ends[:-1]+1))
+                    position=numpy.arange(len(keys_vals))
+                    owners=numpy.searchsorted(ends,position)
+                    is_key=((position-starts[owners])%2==0)&(keys_vals!=0)
+                    hits=is_key&numpy.isin(keys_vals,list(block.key_ids))
+                    for k in numpy.unique(owners[hits]).tolist():
+                        kv=keys_vals[starts[k]:ends[k]].tolist()
+                        nodes.add(int(ids[k]),lonlat[k],tile_codes(lonlat[k:k+1]).tolist(),block.tags(kv[::2],kv[1::2],strings))
+                elif field==1:
+                    (osmid,keys,vals,lat,lon)=(0,[],[],0,0)
+                    for (subfield,value) in fields(message):
+                        if subfield==1: osmid=zigzag(value)
+                        elif subfield==2: keys=unpacked(value)
+                        elif subfield==3: vals=unpacked(value)
+                        elif subfield==8: lat=zigzag(value)
+                        elif subfield==9: lon=zigzag(value)
+                    lonlat=block.coords([lon],[lat])
+                    store_coords(numpy.array([osmid],dtype=numpy.int64),lonlat)
+                    if block.key_ids.intersection(keys):
+                        nodes.add(osmid,lonlat[0],tile_codes(lonlat).tolist(),block.tags(keys,vals,strings))
+    (node_ids,node_coords)=(needed[found],needed_coords[found])
+    del(needed,needed_coords,found)
+    if not bbox and len(node_coords):
+        bbox=(node_coords.min(axis=0)/1e7).tolist()+(node_coords.max(axis=0)/1e7).tolist()
+    # nodes missing from the extract are left aside, ways go through the tiles of their
+    # nodes (by chunks, for the sake of memory)
+    (refs,offsets)=(way_arrays['items'],way_arrays['item_offsets'])
+    (item_offsets,items,tile_offsets,tiles)=([numpy.zeros(1,dtype=numpy.int64)],[],[numpy.zeros(1,dtype=numpy.int64)],[])
+    for first in range(0,len(way_arrays['ids']),100000):
+        chunk_offsets=offsets[first:first+100001]
+        chunk_refs=refs[chunk_offsets[0]:chunk_offsets[-1]]
+        rows=numpy.minimum(numpy.searchsorted(node_ids,chunk_refs),max(len(node_ids)-1,0))
+        hits=node_ids[rows]==chunk_refs if len(node_ids) else numpy.zeros(len(chunk_refs),dtype=bool)
+        owners=numpy.repeat(numpy.arange(len(chunk_offsets)-1),numpy.diff(chunk_offsets))
+        lengths=numpy.bincount(owners[hits],minlength=len(chunk_offsets)-1)
+        item_offsets.append(item_offsets[-1][-1]+numpy.cumsum(lengths))
+        items.append(chunk_refs[hits])
+        (chunk_tile_offsets,chunk_tiles)=ways_tiles(lengths,node_coords[rows[hits]])
+        tile_offsets.append(tile_offsets[-1][-1]+chunk_tile_offsets[1:])
+        tiles.append(chunk_tiles)
+    way_arrays['item_offsets']=numpy.concatenate(item_offsets)
+    way_arrays['tile_offsets']=numpy.concatenate(tile_offsets)
+    way_arrays['items']=numpy.concatenate(items) if items else numpy.zeros(0,dtype=numpy.int64)
+    way_arrays['tiles']=numpy.concatenate(tiles) if tiles else numpy.zeros(0,dtype=numpy.int64)
+    del(refs,offsets,item_offsets,items,tile_offsets,tiles)
+    # relations go through the tiles of their member ways
+    way_order=numpy.argsort(way_arrays['ids'],kind='stable')
+    sorted_way_ids=way_arrays['ids'][way_order]
+    rel_arrays=rels.arrays()
+    (rels.tile_offsets,rels.tiles)=(array('q',[0]),array('q'))
+    for k in range(len(rel_arrays['ids'])):
+        member_rows=member_way_rows(sorted_way_ids,way_order,rel_arrays['items'][rel_arrays['item_offsets'][k]:rel_arrays['item_offsets'][k+1]])
+        rels.tiles.extend(numpy.unique(take(way_arrays['tile_offsets'],way_arrays['tiles'],member_rows)[1]).tolist())
+        rels.tile_offsets.append(len(rels.tiles))
+    rel_arrays=rels.arrays()
+    # buckets : (tile code, osm type, key) -> rows of the elements of that type tagged with key
+    key_ids={strings[key]:key for key in indexed_keys if key in strings}
+    buckets={}
+    for (osm_type,element_arrays) in (('n',nodes.arrays()),('w',way_arrays),('r',rel_arrays)):
+        (tags,tag_offsets)=(element_arrays['tags'].tolist(),element_arrays['tag_offsets'].tolist())
+        (tiles,tile_offsets)=(element_arrays['tiles'].tolist(),element_arrays['tile_offsets'].tolist())
+        for row in range(len(element_arrays['ids'])):
+            keys=[key_ids[k] for k in tags[tag_offsets[row]:tag_offsets[row+1]:2] if k in key_ids]
+            for code in tiles[tile_offsets[row]:tile_offsets[row+1]]:
+                for key in keys:
+                    buckets.setdefault((code,osm_type,key),[]).append(row)
+        if osm_type=='n': node_arrays=element_arrays
+    tmp_dir=index_dir+'.tmp'+str(os.getpid())
+    shutil.rmtree(tmp_dir,ignore_errors=True)
+    string_table=list(strings)
+    UI.vprint(1,"      Writing",len(buckets),"index files.")
+    for (i,((code,osm_type,key),rows)) in enumerate(sorted(buckets.items())):
+        if UI.red_flag:
+            shutil.rmtree(tmp_dir,ignore_errors=True)
+            return 0
+        UI.progress_bar(1,95+int(5*i/len(buckets)))
+        (lat,lon)=code_to_tile(code)
+        filename=FNAMES.osm_extract_bucket(tmp_dir,lat,lon,osm_type,key)
+        os.makedirs(os.path.dirname(filename),exist_ok=True)
+        rows=numpy.array(rows,dtype=numpy.int64)
+        parts={}
+        if osm_type=='n':
+            parts['n']=(node_arrays,rows)
+        elif osm_type=='w':
+            parts['w']=(way_arrays,rows)
+        else:
+            parts['r']=(rel_arrays,rows)
+            member_ids=take(rel_arrays['item_offsets'],rel_arrays['items'],rows)[1]
+            parts['w']=(way_arrays,numpy.unique(member_way_rows(sorted_way_ids,way_order,member_ids)))
+        write_bucket(filename,parts,node_ids,node_coords,string_table)
+    with open(os.path.join(tmp_dir,'index.json'),'w') as f:
+        json.dump({'version':index_version,'source':source,'bbox':bbox,'keys':list(indexed_keys)},f)
+    if read_index(index_dir,source):
+        # built meanwhile by a process which took over a lock deemed stale
+        shutil.rmtree(tmp_dir,ignore_errors=True)
+    elif os.path.exists(index_dir):
+        # an outdated index is moved aside first, it may still be read
+        old_dir=index_dir+'.old'+str(os.getpid())
+        try:
+            os.rename(index_dir,old_dir)
+        except Exception as e:
+            UI.lvprint(0,"ERROR: could not replace the outdated index",index_dir,":",e)
+            shutil.rmtree(tmp_dir,ignore_errors=True)
+            return 0
+        os.rename(tmp_dir,index_dir)
+        shutil.rmtree(old_dir,ignore_errors=True)
+    else:
+        os.rename(tmp_dir,index_dir)
+    UI.progress_bar(1,100)
+    return 1
+##############################################################################
+
+##############################################################################
+def member_way_rows(sorted_way_ids,way_order,member_ids):
+    # rows of the member ways which were kept (present in the extract)
+    rows=numpy.minimum(numpy.searchsorted(sorted_way_ids,member_ids),max(len(sorted_way_ids)-1,0))
+    found=sorted_way_ids[rows]==member_ids if len(sorted_way_ids) else numpy.zeros(len(member_ids),dtype=bool)
+    return way_order[rows[found]]
+##############################################################################
+
+##############################################################################
+def write_bucket(filename,parts,node_ids,node_coords,string_table):
+    # parts are osm type -> (element arrays, rows), ways bring their nodes along
+    arrays={}
+    used_strings=[]
+    for (osm_type,(element_arrays,rows)) in parts.items():
+        # elements by id, as in Overpass answers
+        rows=rows[numpy.argsort(element_arrays['ids'][rows],kind='stable')]
+        arrays[osm_type+'_ids']=element_arrays['ids'][rows]
+        (arrays[osm_type+'_tag_offsets'],arrays[osm_type+'_tags'])=take(element_arrays['tag_offsets'],element_arrays['tags'],rows)
+        (arrays[osm_type+'_offsets'],arrays[osm_type+'_items'])=take(element_arrays['item_offsets'],element_arrays['items'],rows)
+        used_strings.append(arrays[osm_type+'_tags'])
+        if osm_type=='r':
+            arrays['r_roles']=take(element_arrays['item_offsets'],element_arrays['roles'],rows)[1]
+            used_strings.append(arrays['r_roles'])
+    if 'w' in parts:
+        refs=numpy.unique(arrays['w_items'])
+        rows=numpy.searchsorted(node_ids,refs)
+        arrays['n_ids']=refs
+        arrays['n_items']=node_coords[rows].reshape(-1)
+        arrays['n_offsets']=numpy.arange(0,2*len(refs)+1,2,dtype=numpy.int64)
+        (arrays['n_tag_offsets'],arrays['n_tags'])=(numpy.zeros(len(refs)+1,dtype=numpy.int64),numpy.zeros(0,dtype=numpy.int64))
+    # tags and roles are given by indices in a table of the strings of the file only
+    used_strings=numpy.unique(numpy.concatenate(used_strings))
+    for name in ('n_tags','w_tags','r_tags','r_roles'):
+        if name in arrays: arrays[name]=numpy.searchsorted(used_strings,arrays[name]).astype(numpy.int32)
+    arrays['strings']=numpy.frombuffer('\0'.join(string_table[k] for k in used_strings.tolist()).encode('utf-8'),dtype=numpy.uint8)
+    numpy.savez_compressed(filename,**arrays)
+##############################################################################
+
+##############################################################################
+def read_index(index_dir,source):
+    # the index in index_dir if it is complete and up to date with source
+    try:
+        with open(os.path.join(index_dir,'index.json'),'r') as f:
+            index=json.load(f)
+        if index['version']==index_version and index['source']==source: return index
+    except:
+        pass
+    return None
+##############################################################################
+
+##############################################################################
+def lock_index(lock_file):
+    # exclusive creation of lock_file, waiting while another process (batch build)
+    # indexes the same extract. The lock is refreshed while held, one left behind
+    # by a dead process is hence taken over after lock_timeout. Returns the event
+    # stopping the refresh, None if interrupted.
+    os.makedirs(os.path.dirname(lock_file),exist_ok=True)
+    waiting=False
+    while True:
+        try:
+            os.close(os.open(lock_file,os.O_CREAT|os.O_EXCL|os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time()-os.path.getmtime(lock_file)>lock_timeout:
+                    os.remove(lock_file)
+                    continue
+            except OSError:
+                continue
+        if UI.red_flag: return None
+        if not waiting:
+            UI.vprint(1,"    * Waiting for another process indexing the same extract.")
+            waiting=True
+        time.sleep(1)
+    stop=threading.Event()
+    def refresh():
+        while not stop.wait(lock_timeout/10):
+            try:
+                os.utime(lock_file)
+            except OSError:
+                pass
+    threading.Thread(target=refresh,daemon=True).start()
+    return stop
+##############################################################################
+
+##############################################################################
+def unlock_index(lock_file,stop):
+    stop.set()
+    try:
+        os.remove(lock_file)
+    except OSError:
+        pass
+##############################################################################
+
+##############################################################################
+def extract_index(pbf_file):
+    # the index of the extract (built if needed), None if it cannot be built
+    name=os.path.basename(pbf_file)[:-len('.osm.pbf')]
+    index_dir=FNAMES.osm_extract_index_dir(name)
+    source=[os.path.getsize(pbf_file),os.path.getmtime(pbf_file)]
+    index=read_index(index_dir,source)
+    if not index:
+        lock_file=index_dir+'.lock'
+        stop=lock_index(lock_file)
+        if not stop: return None
+        try:
+            # possibly built while we were waiting for the lock
+            index=read_index(index_dir,source)
+            if not index and build_index(pbf_file,index_dir):
+                index=read_index(index_dir,source)
+        except Exception as e:
+            UI.lvprint(0,"ERROR: could not index",pbf_file,":",e)
+            return None
+        finally:
+            unlock_index(lock_file,stop)
+        if not index: return None
+    index['name']=name
+    index['dir']=index_dir
+    return index
+##############################################################################
+
+##############################################################################
+def read_poly(poly_file):
+    # Osmosis polygon filter file : a name, then sections of 'lon lat' lines each 
+    # ended by END (holes have a name starting with '!'), and a final END
+    with open(poly_file,'r') as f:
+        lines=[line.strip() for line in f if line.strip()]
+    (outers,holes)=([],[])
+    k=1
+    while k<len(lines) and lines[k]!='END':
+        is_hole=lines[k].startswith('!')
+        k+=1
+        ring=[]
+        while lines[k]!='END':
+            ring.append(tuple(float(x) for x in lines[k].split()[:2]))
+            k+=1
+        k+=1
+        (holes if is_hole else outers).append(geometry.Polygon(ring).buffer(0))
+    return ops.unary_union(outers).difference(ops.unary_union(holes))
+##############################################################################
+
+##############################################################################
+def extract_coverage(pbf_file):
+    # the region really covered by an extract, given by the .poly file next to it 
+    # (Geofabrik names them without the '-latest' of the extract), None if none
+    base=pbf_file[:-len('.osm.pbf')]
+    for poly_file in (base+'.poly',base[:-len('-latest')]+'.poly' if base.endswith('-latest') else None):
+        if not poly_file or not os.path.isfile(poly_file): continue
+        key=(poly_file,os.path.getmtime(poly_file))
+        if key not in coverages:
+            try:
+                coverages[key]=read_poly(poly_file)
+            except Exception as e:
+                UI.lvprint(0,"ERROR: could not read",poly_file,":",e)
+                coverages[key]=None
+        return coverages[key]
+    return None
+##############################################################################
+
+##############################################################################
+def tile_extract(extract_dir,lat,lon):
+    # index of the first extract of extract_dir covering the whole tile. Extracts are
+    # clipped to a polygon (their bounding box reaches far beyond it), so that those
+    # without a .poly file are not used, a partial layer would be cached otherwise
+    try:
+        pbf_files=sorted(f for f in os.listdir(extract_dir) if f.endswith('.osm.pbf'))
+    except:
+        UI.vprint(1,"    Could not read the OSM extracts directory",extract_dir)
+        return None
+    for pbf_file in pbf_files:
+        pbf_file=os.path.join(extract_dir,pbf_file)
+        coverage=extract_coverage(pbf_file)
+        if coverage is None:
+            if pbf_file not in no_coverage:
+                no_coverage.add(pbf_file)
+                UI.lvprint(1,"    No (valid) .poly file found next to",pbf_file,", this extract is not used.")
+            continue
+        if not coverage.covers(geometry.box(lon,lat,lon+1,lat+1)): continue
+        index=extract_index(pbf_file)
+        if index: return index
+    return None
+##############################################################################
+
+##############################################################################
+def parse_query(tag):
+    # (osm type, key, value or None) for the plain forms type["key"] and 
+    # type["key"="value"] only, None for any other (regex, negation, several filters)
+    match=query_pattern.match(tag)
+    return (osm_types[match.group(1)],match.group(2),match.group(3)) if match else None
+##############################################################################
+
+##############################################################################
+def answers(index,query):
+    # whether all elements queried are indexed, other queries go to Overpass
+    for tag in [query] if isinstance(query,str) else query:
+        parsed=parse_query(tag)
+        if not parsed or parsed[1] not in index['keys']: return False
+    return True
+##############################################################################
+
+##############################################################################
+def read_bucket(filename):
+    with numpy.load(filename) as npz:
+        bucket={name:npz[name] for name in npz.files}
+    strings=bucket['strings'].tobytes().decode('utf-8').split('\0')
+    bucket['strings']=strings
+    bucket['string_ids']={s:i for (i,s) in enumerate(strings)}
+    return bucket
+##############################################################################
+
+##############################################################################
+def bucket_rows(bucket,osm_type,key,value=None):
+    # rows of the elements of osm_type tagged key=value, or key=* if value is None
+    string_ids=bucket['string_ids']
+    if key not in string_ids or (value is not None and value not in string_ids): return numpy.zeros(0,dtype=numpy.int64)
+    tags=bucket[osm_type+'_tags'].reshape((-1,2))
+    owners=numpy.repeat(numpy.arange(len(bucket[osm_type+'_ids'])),numpy.diff(bucket[osm_type+'_tag_offsets'])//2)
+    match=tags[:,0]==string_ids[key]
+    if value is not None: match&=tags[:,1]==string_ids[value]
+    return numpy.unique(owners[match])
+##############################################################################
+
+##############################################################################
+def bucket_elements(bucket,osm_type,rows):
+    # yields the id, list of items and tags of the elements at the given rows
+    strings=bucket['strings']
+    (item_offsets,items)=take(bucket[osm_type+'_offsets'],bucket[osm_type+'_items'],rows)
+    (tag_offsets,tags)=take(bucket[osm_type+'_tag_offsets'],bucket[osm_type+'_tags'],rows)
+    (items,item_offsets,tag_offsets)=(items.tolist(),item_offsets.tolist(),tag_offsets.tolist())
+    tags=[strings[k] for k in tags.tolist()]
+    if osm_type=='r':
+        roles=[strings[k] for k in take(bucket['r_offsets'],bucket['r_roles'],rows)[1].tolist()]
+        items=list(zip(items,roles))
+    for (k,osmid) in enumerate(bucket[osm_type+'_ids'][rows].tolist()):
+        yield (osmid,items[item_offsets[k]:item_offsets[k+1]],
+               dict(zip(tags[tag_offsets[k]:tag_offsets[k+1]:2],tags[tag_offsets[k]+1:tag_offsets[k+1]:2])))
+##############################################################################
+
+##############################################################################
+def extract_elements(index,lat,lon,queries):
+    # yields the elements answering the queries as (tag,attributes) pairs, in the
+    # order of an Overpass answer to their union : nodes, ways and relations by id
+    (nodes,ways,rels)=({},{},{})
+    def add_ways(bucket,rows):
+        for (osmid,refs,tags) in bucket_elements(bucket,'w',rows):
+            if osmid in ways: continue
+            ways[osmid]=(refs,tags)
+        # their nodes, without tags
+        refs=numpy.unique(take(bucket['w_offsets'],bucket['w_items'],rows)[1])
+        coords=bucket['n_items'].reshape((-1,2))[numpy.searchsorted(bucket['n_ids'],refs)].tolist()
+        for (ref,(x,y)) in zip(refs.tolist(),coords):
+            if ref not in nodes: nodes[ref]=(x,y,{})
+    buckets={}
+    for query in queries:
+        for tag in [query] if isinstance(query,str) else query:
+            (osm_type,key,value)=parse_query(tag)
+            if (osm_type,key) not in buckets:
+                filename=FNAMES.osm_extract_bucket(index['dir'],lat,lon,osm_type,key)
+                buckets[(osm_type,key)]=read_bucket(filename) if os.path.isfile(filename) else None
+            bucket=buckets[(osm_type,key)]
+            if not bucket: continue
+            rows=bucket_rows(bucket,osm_type,key,value)
+            if osm_type=='n':
+                for (osmid,(x,y),tags) in bucket_elements(bucket,'n',rows):
+                    nodes[osmid]=(x,y,tags)
+            elif osm_type=='w':
+                add_ways(bucket,rows)
+            else:
+                member_ids=[]
+                for (osmid,members,tags) in bucket_elements(bucket,'r',rows):
+                    rels[osmid]=(members,tags)
+                    member_ids+=[ref for (ref,_) in members]
+                # member ways missing from the extract are not in the bucket
+                member_ids=numpy.intersect1d(numpy.array(member_ids,dtype=numpy.int64),bucket['w_ids'])
+                add_ways(bucket,numpy.searchsorted(bucket['w_ids'],member_ids))
+    yield ('osm',{})
+    for osmid in sorted(nodes):
+        (x,y,tags)=nodes[osmid]
+        yield ('node',{'id':osmid,'lat':y/1e7,'lon':x/1e7})
+        for (k,v) in tags.items(): yield ('tag',{'k':k,'v':v})
+    for osmid in sorted(ways):
+        (refs,tags)=ways[osmid]
+        yield ('way',{'id':osmid})
+        for ref in refs: yield ('nd',{'ref':ref})
+        for (k,v) in tags.items(): yield ('tag',{'k':k,'v':v})
+    for osmid in sorted(rels):
+        (members,tags)=rels[osmid]
+        yield ('relation',{'id':osmid})
+        for (ref,role) in members:
+            if ref in ways: yield ('member',{'type':'way','ref':ref,'role':role})
+        for (k,v) in tags.items(): yield ('tag',{'k':k,'v':v})
+##############################################################################
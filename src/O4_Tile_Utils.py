@@ -3,11 +3,14 @@ import time
 import shutil
 import queue
 import threading
+import multiprocessing
+import concurrent.futures
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
 import O4_Imagery_Utils as IMG
 import O4_Vector_Map as VMAP
 import O4_Mesh_Utils as MESH
+import O4_Mesh_IO as MESHIO
 import O4_Mask_Utils as MASK
 import O4_DSF_Utils as DSF
 import O4_Overlay_Utils as OVL
@@ -16,6 +19,13 @@ from O4_Parallel_Utils import parallel_launch, parallel_join
 max_convert_slots=4 
 skip_downloads=False
 skip_converts=False
+max_batch_workers=1
+# Maximum number of batch worker processes allowed in each step at the same
+# time (0 means only bounded by max_batch_workers). Step 1 hits the Overpass
+# servers, Step 2 runs Triangle with a large memory footprint and Step 3 has
+# its own download and conversion threads.
+batch_step_slots={'osm':2,'mesh':2,'mask':0,'dsf':2,'ovl':1}
+batch_step_names={'osm':'Step 1','mesh':'Step 2','mask':'Step 2.5','dsf':'Step 3','ovl':'overlay'}
 
 ##############################################################################
 def download_textures(tile,download_queue,convert_queue):
@@ -116,6 +126,7 @@ def build_tile(tile):
     if UI.cleaning_level>2:
         try: os.remove(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon))
         except: pass
+        MESHIO.forget_mesh_file(FNAMES.mesh_file(tile.build_dir,tile.lat,tile.lon))
         try: os.remove(FNAMES.apt_file(tile))
         except: pass
     if UI.cleaning_level>1 and not tile.grouped:
@@ -145,6 +156,11 @@ def build_tile_list(tile,list_lat_lon,do_osm,do_mesh,do_mask,do_dsf,do_ovl,do_pt
     UI.red_flag=0
     timer=time.time()
     UI.lvprint(0,"Batch build launched for a number of",len(list_lat_lon),"tiles.")
+    if max_batch_workers>1 and len(list_lat_lon)>1:
+        if not build_tile_list_in_processes(tile,list_lat_lon,do_osm,do_mesh,do_mask,do_dsf,do_ovl,do_ptc):
+            UI.exit_message_and_bottom_line(); return 0
+        UI.lvprint(0,"Batch process completed in",UI.nicer_timer(time.time()-timer))
+        return 1
     k=0
     for (lat,lon) in list_lat_lon:
         k+=1
@@ -169,15 +185,140 @@ def build_tile_list(tile,list_lat_lon,do_osm,do_mesh,do_mask,do_dsf,do_ovl,do_pt
         if do_ovl: 
             OVL.build_overlay(lat,lon)
             if UI.red_flag: UI.exit_message_and_bottom_line(); return 0
-        try:
-            UI.gui.earth_window.canvas.delete(UI.gui.earth_window.dico_tiles_todo[(lat,lon)]) 
-            UI.gui.earth_window.dico_tiles_todo.pop((lat,lon),None)
-        except Exception as e:
-            print(e)
+        remove_from_todo_list(lat,lon)
     UI.lvprint(0,"Batch process completed in",UI.nicer_timer(time.time()-timer))
     return 1
 ##############################################################################
 
+##############################################################################
+def build_tile_list_in_processes(tile,list_lat_lon,do_osm,do_mesh,do_mask,do_dsf,do_ovl,do_ptc):
+    # Each tile is built in its own process, with its own copy of the tile 
+    # object and its own UI flags. Spawned rather than forked so that the 
+    # children do not inherit the Tk interpreter and the running threads. 
+    import O4_Config_Utils as CFG
+    app_vars={}
+    for var in CFG.list_app_vars:
+        module=getattr(CFG,CFG.cfg_vars[var]['module']) if 'module' in CFG.cfg_vars[var] else CFG
+        app_vars[var]=getattr(module,var)
+    app_vars['verbosity']=min(UI.verbosity,1)
+    tile.dem=None
+    nbr_workers=min(max_batch_workers,len(list_lat_lon))
+    UI.vprint(1,"-> Opening a pool of",nbr_workers,"tile building processes.")
+    ctx=multiprocessing.get_context('spawn')
+    stop_event=ctx.Event()
+    step_slots={step:ctx.BoundedSemaphore(slots) for (step,slots) in batch_step_slots.items() if slots}
+    dsf_processes=min(nbr_workers,batch_step_slots['dsf'] or nbr_workers)
+    # Masks are built from the meshes of the neighbouring tiles, and Step 3 may 
+    # remove the tile mesh (cleaning level), hence Step 2.5 waits for all meshes
+    # and Step 3 for all masks. Without masks the steps of a tile follow each other.
+    todo={'osm':do_osm,'mesh':do_mesh,'mask':do_mask,'dsf':do_dsf,'ovl':do_ovl}
+    phases=[('osm','mesh'),('mask',),('dsf','ovl')] if do_mask else [('osm','mesh','dsf','ovl')]
+    phases=[steps for steps in [tuple(step for step in phase if todo[step]) for phase in phases] if steps]
+    remaining=list(list_lat_lon)
+    failed=[]
+    (done,completed)=(0,0)
+    with concurrent.futures.ProcessPoolExecutor(nbr_workers,mp_context=ctx,initializer=batch_worker_init,
+            initargs=(app_vars,stop_event,step_slots,dsf_processes)) as executor:
+        for (k,steps) in enumerate(phases):
+            if not remaining or stop_event.is_set(): break
+            if len(phases)>1: UI.vprint(1,"-> Batch phase",k+1,"/",len(phases),":",', '.join(batch_step_names[step] for step in steps))
+            pending={}
+            try:
+                for (lat,lon) in remaining:
+                    pending[executor.submit(build_tile_in_process,tile,lat,lon,steps,do_ptc)]=(lat,lon)
+            except Exception as e:
+                # the pool is broken (a worker died in a previous phase)
+                UI.lvprint(0,"ERROR: Batch build processes are not available anymore :",e)
+                stop_event.set()
+            while pending:
+                if UI.red_flag: stop_event.set()
+                (finished,_)=concurrent.futures.wait(pending,timeout=0.5,return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    (lat,lon)=pending.pop(future)
+                    try:
+                        success=future.result()
+                    except Exception as e:
+                        # including BrokenProcessPool for all the pending tiles if a worker died
+                        UI.lvprint(0,"ERROR: Batch build crashed for tile",FNAMES.short_latlon(lat,lon),":",repr(e))
+                        success=0
+                    done+=1
+                    UI.progress_bar(1,int(100*done/(len(phases)*len(list_lat_lon))))
+                    if not success:
+                        failed.append(FNAMES.short_latlon(lat,lon))
+                        remaining.remove((lat,lon))
+                    elif k==len(phases)-1: 
+                        completed+=1
+                        UI.vprint(1,"Tile",FNAMES.short_latlon(lat,lon),"completed (",completed,"/",len(list_lat_lon),").")
+                        remove_from_todo_list(lat,lon)
+    UI.progress_bar(1,100)
+    if failed: 
+        UI.lvprint(0,"ERROR: Batch build failed for tile(s)",', '.join(failed))
+    return not (UI.red_flag or stop_event.is_set())
+##############################################################################
+
+##############################################################################
+def batch_worker_init(app_vars,stop_event,step_slots,dsf_processes):
+    global batch_stop_event, batch_slots
+    import O4_Config_Utils as CFG
+    for var in app_vars:
+        module=getattr(CFG,CFG.cfg_vars[var]['module']) if 'module' in CFG.cfg_vars[var] else CFG
+        setattr(module,var,app_vars[var])
+    UI.gui=None
+    # the imagery providers limits are shared by the processes in Step 3
+    IMG.download_processes=dsf_processes
+    if not IMG.providers_dict:
+        IMG.initialize_extents_dict()
+        IMG.initialize_color_filters_dict()
+        IMG.initialize_providers_dict()
+        IMG.initialize_combined_providers_dict()
+    batch_stop_event=stop_event
+    batch_slots=step_slots
+    def watch_stop_event():
+        # each step resets the red flag when it starts, hence the polling
+        stop_event.wait()
+        while True:
+            UI.red_flag=True
+            time.sleep(0.5)
+    threading.Thread(target=watch_stop_event,daemon=True).start()
+##############################################################################
+
+##############################################################################
+def build_tile_in_process(tile,lat,lon,steps,do_ptc):
+    # runs the given steps for the tile, 1 if all of them succeeded
+    (tile.lat,tile.lon)=(lat,lon)
+    tile.build_dir=FNAMES.build_dir(tile.lat,tile.lon,tile.custom_build_dir)
+    tile.dem=None
+    tasks={'osm':(VMAP.build_poly_file,(tile,)),'mesh':(MESH.build_mesh,(tile,)),'mask':(MASK.build_masks,(tile,)),
+           'dsf':(build_tile,(tile,)),'ovl':(OVL.build_overlay,(lat,lon))}
+    try:
+        if do_ptc: tile.read_from_config()
+        if {'osm','mesh','dsf'} & set(steps): tile.make_dirs()
+        for step in steps:
+            if batch_stop_event.is_set(): return 0
+            (task,args)=tasks[step]
+            slot=batch_slots.get(step)
+            if slot: slot.acquire()
+            try:
+                UI.is_working=0
+                task(*args)
+            finally:
+                if slot: slot.release()
+            if UI.red_flag: return 0
+    except Exception as e:
+        UI.lvprint(0,"ERROR: Batch build crashed for tile",FNAMES.short_latlon(lat,lon),":",e)
+        return 0
+    return 1
+##############################################################################
+
+##############################################################################
+def remove_from_todo_list(lat,lon):
+    try:
+        UI.gui.earth_window.canvas.delete(UI.gui.earth_window.dico_tiles_todo[(lat,lon)]) 
+        UI.gui.earth_window.dico_tiles_todo.pop((lat,lon),None)
+    except Exception as e:
+        print(e)
+##############################################################################
+
 ##############################################################################
 def remove_unwanted_textures(tile):
     texture_list=[]
@@ -163,7 +163,7 @@ def include_roads(vector_map,tile,apt_array,apt_area):
     #Need to evaluate if including bridges is better or worse
     tags_for_exclusion=set(["bridge","tunnel"]) 
     #tags_for_exclusion=set(["tunnel"]) 
-    road_layer=OSM.OSM_layer()
+    road_layer=OSM.OSM_layer(compact=True)
     queries=[
            'way["highway"="motorway"]',
            'way["highway"="trunk"]',
@@ -179,7 +179,7 @@ def include_roads(vector_map,tile,apt_array,apt_area):
             road_layer,tile.lat,tile.lon,tags_for_exclusion,road_is_too_much_banked) 
     if UI.red_flag: return 0
     if tile.road_level>=2:
-        road_layer=OSM.OSM_layer()
+        road_layer=OSM.OSM_layer(compact=True)
         queries=[\
            'way["highway"="tertiary"]']
         if tile.road_level>=3:
@@ -0,0 +1,94 @@
+import os
+import sys
+import array
+import random
+import struct
+import unittest
+from math import floor
+import numpy
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src'))
+import O4_DSF_Utils as DSF
+
+##############################################################################
+# Reference : the former writer of O4_DSF_Utils.build_dsf, one struct.pack per
+# value, against which the bulk encoders must be byte identical.
+##############################################################################
+def reference_pool_planes(pool,nbr_planes):
+    out=b''
+    for l in range(nbr_planes):
+        out+=struct.pack('<B',0)
+        for m in range(len(pool)//nbr_planes):
+            out+=struct.pack('<H',pool[nbr_planes*m+l])
+    return out
+
+def reference_patch_triangles(tris):
+    out=b''
+    blocks=floor(len(tris)/255)
+    for j in range(blocks):
+        out+=struct.pack('<B',23)
+        out+=struct.pack('<B',255)
+        for k in range(255):
+            out+=struct.pack('<H',tris[255*j+k])
+    remaining_tri_p=len(tris)%255
+    if remaining_tri_p != 0:
+        out+=struct.pack('<B',23)
+        out+=struct.pack('<B',remaining_tri_p)
+        for k in range(remaining_tri_p):
+            out+=struct.pack('<H',tris[255*blocks+k])
+    return out
+
+def reference_patch_triangles_cross_pool(tris,dico_new_dsf_pool):
+    out=b''
+    blocks=floor(len(tris)/510)
+    for j in range(blocks):
+        out+=struct.pack('<B',24)
+        out+=struct.pack('<B',255)
+        for k in range(255):
+            out+=struct.pack('<H',dico_new_dsf_pool[tris[510*j+2*k]])
+            out+=struct.pack('<H',tris[510*j+2*k+1])
+    remaining_tri_p=int((len(tris)%510)/2)
+    if remaining_tri_p != 0:
+        out+=struct.pack('<B',24)
+        out+=struct.pack('<B',remaining_tri_p)
+        for k in range(remaining_tri_p):
+            out+=struct.pack('<H',dico_new_dsf_pool[tris[510*blocks+2*k]])
+            out+=struct.pack('<H',tris[510*blocks+2*k+1])
+    return out
+##############################################################################
+
+# lengths around the 255 coordinates limit of a command
+lengths=(0,1,2,3,254,255,256,509,510,511,765,1000,3*255*7+4)
+
+class TestDSFEncoding(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(4)
+
+    def test_pool_planes(self):
+        for nbr_planes in (5,7,9):
+            for nbr_nodes in lengths:
+                pool=array.array('H',(random.randrange(65536) for _ in range(nbr_planes*nbr_nodes)))
+                self.assertEqual(DSF.encode_pool_planes(pool,nbr_planes),reference_pool_planes(pool,nbr_planes),(nbr_planes,nbr_nodes))
+
+    def test_patch_triangles(self):
+        for nbr_coords in lengths:
+            tris=array.array('H',(random.randrange(65536) for _ in range(nbr_coords)))
+            self.assertEqual(DSF.encode_patch_triangles(tris,23),reference_patch_triangles(tris),nbr_coords)
+
+    def test_patch_triangles_cross_pool(self):
+        # as in build_dsf : pairs (pool index, index in pool), pool indices renumbered
+        nbr_pools=300
+        new_dsf_pool_idx=numpy.array(random.sample(range(nbr_pools),nbr_pools),dtype=numpy.uint16)
+        dico_new_dsf_pool={k:int(new_dsf_pool_idx[k]) for k in range(nbr_pools)}
+        for nbr_coords in lengths:
+            tris=array.array('H')
+            for _ in range(nbr_coords):
+                tris.append(random.randrange(nbr_pools)); tris.append(random.randrange(65536))
+            coords=numpy.frombuffer(tris,dtype=numpy.uint16)
+            coords=coords[:2*(len(coords)//2)].reshape((-1,2)).copy()
+            coords[:,0]=new_dsf_pool_idx[coords[:,0]]
+            self.assertEqual(DSF.encode_patch_triangles(coords,24),reference_patch_triangles_cross_pool(tris,dico_new_dsf_pool),nbr_coords)
+
+if __name__=='__main__':
+    unittest.main()